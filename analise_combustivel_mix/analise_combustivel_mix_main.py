@@ -2,13 +2,28 @@
 # coding: utf-8
 
 ###################################################################################
-# Arquivo principal (main) que vai disparar subprocessos para o cáclulo do combustível
+# Arquivo principal (main) que vai distribuir os veículos para um pool de workers para o cáclulo do combustível
 ###################################################################################
-# Cada subprocesso calcula os dados das trips de um dia de um determinado veículo
+# Cada worker calcula os dados das trips de um dia de um determinado veículo
+# Os workers são processos de longa duração: partem do forkserver com as bibliotecas e o módulo de análise já
+# importados e o histórico de km/l já carregado (worker_preload.py, uma única vez por execução) e processam vários
+# veículos. As geometrias das linhas são construídas pelo primeiro worker que precisa de cada snapshot do KML e
+# salvas no cache em disco, de onde os demais workers as carregam.
+# Os veículos são enviados em lotes de MAX_VEICULOS_POR_WORKER veículos por worker, e o pool é recriado a cada lote
+# para limitar o crescimento da memória dos workers.
+# Se um worker morre (ex: falha de memória ou segfault do GEOS), o pool é recriado e os veículos pendentes são
+# reenviados (até MAX_QUEBRAS_POOL vezes); depois disso cada veículo restante roda isolado em seu próprio worker, de
+# forma que uma nova falha só perde o veículo que a causou.
+# O tempo de cada veículo é limitado em dois níveis: o worker verifica o prazo entre as trips (encerrando o veículo
+# sem perder as trips já salvas) e o processo pai mata o worker cujo veículo ultrapassa o prazo mais uma margem
+# (ex: query ou operação do GEOS travada). Nesse caso o veículo é reportado como timeout e os demais veículos
+# interrompidos com o pool são reenviados.
+# O subprocesso (analise_combustivel_mix_subprocess.py) continua podendo ser executado isoladamente pela linha de
+# comando.
 #
 # Requer como parâmetro de linha de comando a data que será utilizada:
 # --data_baixar="YYYY-MM-DD" (Ex: --data_baixar="2025-02-27")
-# Para cada data, o sistema dispara um subprocesso que analisa as trips e posições GPS do veículo naquele dia
+# Para cada data, o sistema envia para o pool cada veículo, que tem as trips e posições GPS analisadas naquele dia
 # e calcula o combustível utilizado, bem como a relação dele com os demais veículos na mesma linha
 #
 # Além deste parâmetro, o sistema requer um arquivo .env com as seguintes variáveis de ambiente:
@@ -27,7 +42,10 @@
 # Import de sistema
 import gc
 import os
-import subprocess
+import queue
+import time
+import signal
+import multiprocessing
 
 # CLI
 import click
@@ -55,28 +73,202 @@ load_dotenv(os.path.join(CURRENT_PATH, "..", ".env"))
 from db import PostgresSingleton
 from execution_logger import ExecutionLogger
 
-# Thread Pool
-from concurrent.futures import ThreadPoolExecutor, as_completed
+# Process Pool
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+
+# Análise de um veículo (importado uma única vez, os workers herdam o módulo já carregado)
+import analise_combustivel_mix_subprocess as analise_veiculo
+
+
+###################################################################################
+# Constantes e variáveis globais
+###################################################################################
+
+# Tempo máximo (em segundos) para processar um veículo (verificado entre as trips)
+TIMEOUT_VEICULO_SEGUNDOS = 900
+
+# Margem (em segundos) após o timeout antes do processo pai matar o worker do veículo
+MARGEM_TIMEOUT_SEGUNDOS = 120
+
+# Intervalo (em segundos) entre as verificações do processo pai
+INTERVALO_VERIFICACAO_SEGUNDOS = 5
+
+# Número de veículos (em média) processados por um worker antes de o pool ser recriado
+MAX_VEICULOS_POR_WORKER = 50
+
+# Número de vezes que o pool é recriado após a morte de um worker antes de isolar os veículos restantes
+MAX_QUEBRAS_POOL = 2
+
+# Módulo importado pelo forkserver antes de criar os workers (não é importado pelo processo pai)
+MODULO_PRELOAD_WORKERS = "worker_preload"
 
 
 ###################################################################################
-# Execução do subprocesso
+# Execução nos workers
 ###################################################################################
 
 
-def run_script(data_str, asset_id, timeout=900):
-    cmd = [
-        "python",
-        os.path.join(CURRENT_PATH, "analise_combustivel_mix_subprocess.py"),
-        f"--data_baixar={data_str}",
-        f"--vec_asset_id={asset_id}",
-    ]
+# Fila em que o worker avisa o início de cada veículo (asset_id, pid, timestamp) ao processo pai
+FILA_INICIOS = None
+
 
+# Inicializa o worker (executado uma única vez por processo)
+def inicializa_worker(fila_inicios):
+    global FILA_INICIOS
+    FILA_INICIOS = fila_inicios
+
+    # As conexões herdadas do forkserver não podem ser compartilhadas, descarta o pool sem fechá-las
+    analise_veiculo.pg_engine.dispose(close=False)
+
+
+# Processa um veículo no worker, retorna o mesmo código do subprocesso: 0 (ok), -999 (timeout) ou 1 (erro)
+# O prazo é verificado entre as trips, as viagens já concluídas são salvas mesmo em caso de timeout
+def run_worker(data_str, asset_id, timeout=TIMEOUT_VEICULO_SEGUNDOS):
+    FILA_INICIOS.put((asset_id, os.getpid(), time.time()))
     try:
-        result = subprocess.run(cmd, timeout=timeout)
-        return (asset_id, result.returncode)
-    except subprocess.TimeoutExpired:
+        analise_veiculo.analisa_veiculo_dia(asset_id, data_str, prazo=time.monotonic() + timeout)
+        return (asset_id, 0)
+    except analise_veiculo.TimeoutVeiculo:
         return (asset_id, -999)
+    except Exception as e:
+        print(f"Erro ao processar veículo {asset_id}: {e}")
+        return (asset_id, 1)
+    finally:
+        gc.collect()
+
+
+###################################################################################
+# Pool de workers
+###################################################################################
+
+
+# Cria o pool de workers
+# Os workers partem do forkserver (que pré-carrega o módulo da análise e o histórico de km/l), não herdam o estado
+# do processo pai. O forkserver é iniciado uma única vez por execução e reusado por todos os pools
+# A reciclagem dos workers é feita recriando o pool a cada lote (ver processa_veiculos), max_tasks_per_child deixa o
+# pool travado quando os workers são substituídos (ProcessPoolExecutor do CPython 3.11 a 3.13.0)
+def cria_executor(max_workers, mp_context, fila_inicios):
+    mp_context.set_forkserver_preload([MODULO_PRELOAD_WORKERS])
+
+    return ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=mp_context,
+        initializer=inicializa_worker,
+        initargs=(fila_inicios,),
+    )
+
+
+def imprime_status(asset_id, code):
+    if code == 0:
+        status = "✅ ok"
+    elif code == -999:
+        status = "🕒 timeout"
+    else:
+        status = f"❌ erro (code {code})"
+    print(f"Veículo {asset_id} -> {status}")
+
+
+# Mata o worker dos veículos em execução há mais de timeout segundos, retorna os veículos encerrados
+def encerra_veiculos_atrasados(futures, pendentes, inicios, timeout):
+    encerrados = set()
+    agora = time.time()
+
+    for future in pendentes:
+        asset_id = futures[future]
+        if asset_id not in inicios or future.done():
+            continue
+
+        pid, inicio = inicios[asset_id]
+        if agora - inicio > timeout:
+            print(f"🛑 Veículo {asset_id} ultrapassou {timeout} segundos, encerrando o worker {pid}")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            encerrados.add(asset_id)
+            del inicios[asset_id]
+
+    return encerrados
+
+
+# Executa os veículos em um pool, retorna (veículos não concluídos porque o pool quebrou, se o pool quebrou sem ter
+# sido por um veículo encerrado por timeout)
+# Se um worker morre o pool quebra e todos os veículos ainda não concluídos falham com BrokenProcessPool
+def executa_pool(dia_str, asset_ids, max_workers, timeout=TIMEOUT_VEICULO_SEGUNDOS + MARGEM_TIMEOUT_SEGUNDOS):
+    nao_concluidos = []
+    encerrados = set()
+    inicios = {}  # asset_id -> (pid, início)
+
+    mp_context = multiprocessing.get_context("forkserver")
+    fila_inicios = mp_context.Queue()
+    executor = cria_executor(max_workers, mp_context, fila_inicios)
+    try:
+        futures = {executor.submit(run_worker, dia_str, asset_id): asset_id for asset_id in asset_ids}
+        pendentes = set(futures)
+
+        while pendentes:
+            concluidos, pendentes = wait(pendentes, timeout=INTERVALO_VERIFICACAO_SEGUNDOS, return_when=FIRST_COMPLETED)
+
+            # Início dos veículos avisados pelos workers
+            try:
+                while True:
+                    asset_id, pid, inicio = fila_inicios.get_nowait()
+                    inicios[asset_id] = (pid, inicio)
+            except queue.Empty:
+                pass
+
+            for future in concluidos:
+                asset_id = futures[future]
+                inicios.pop(asset_id, None)
+                try:
+                    _, code = future.result()
+                except BrokenProcessPool:
+                    if asset_id in encerrados:
+                        imprime_status(asset_id, -999)
+                    else:
+                        nao_concluidos.append(asset_id)
+                    continue
+
+                imprime_status(asset_id, code)
+                gc.collect()
+
+            encerrados.update(encerra_veiculos_atrasados(futures, pendentes, inicios, timeout))
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        fila_inicios.close()
+
+    return nao_concluidos, len(nao_concluidos) > 0 and len(encerrados) == 0
+
+
+# Processa um lote de veículos, recriando o pool quando um worker morre ou é encerrado por timeout
+# Após MAX_QUEBRAS_POOL quebras (sem contar os encerramentos por timeout), cada veículo restante do lote roda isolado
+# (como no antigo subprocesso por veículo)
+def processa_lote(dia_str, asset_ids, max_workers):
+    pendentes = list(asset_ids)
+    quebras = 0
+
+    while pendentes and quebras <= MAX_QUEBRAS_POOL:
+        pendentes, quebrou = executa_pool(dia_str, pendentes, max_workers)
+        if quebrou:
+            quebras += 1
+            print(f"♻️ Pool de workers quebrou, {len(pendentes)} veículos não concluídos")
+        elif pendentes:
+            print(f"♻️ Pool de workers recriado após timeout, reenviando {len(pendentes)} veículos")
+
+    for asset_id in pendentes:
+        restantes, _ = executa_pool(dia_str, [asset_id], 1)
+        if restantes:
+            # O worker morreu processando este veículo
+            imprime_status(asset_id, -1)
+
+
+# Processa os veículos em lotes, com um pool novo por lote
+# Recicla os workers a cada MAX_VEICULOS_POR_WORKER veículos (em média) por worker
+def processa_veiculos(dia_str, asset_ids, max_workers):
+    tamanho_lote = max_workers * MAX_VEICULOS_POR_WORKER
+    for inicio in range(0, len(asset_ids), tamanho_lote):
+        processa_lote(dia_str, asset_ids[inicio : inicio + tamanho_lote], max_workers)
 
 
 ###################################################################################
@@ -106,22 +298,14 @@ def main(data_baixar):
     print("-------------------------------------------------------------------------------------")
     print(f"🚍 Processando {total_veiculos} veículos para o dia: {dia_str}")
 
-    # Limite de subprocessos paralelos
-    max_workers = int(os.cpu_count() * 0.8)
-
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(run_script, dia_str, row["AssetId"]) for _, row in df_veiculos.iterrows()]
-
-        for future in as_completed(futures):
-            asset_id, code = future.result()
-            if code == 0:
-                status = "✅ ok"
-            elif code == -999:
-                status = "🕒 timeout"
-            else:
-                status = f"❌ erro (code {code})"
-            print(f"Veículo {asset_id} -> {status}")
-            gc.collect()
+    # O processo pai não usa mais as conexões do módulo de análise
+    analise_veiculo.pg_engine.dispose()
+    pg_engine.dispose()
+
+    # Limite de workers paralelos
+    max_workers = max(1, int(os.cpu_count() * 0.8))
+
+    processa_veiculos(dia_str, df_veiculos["AssetId"].tolist(), max_workers)
 
 
 if __name__ == "__main__":
@@ -22,6 +22,7 @@
 # Requer como parâmetro de linha de comando a data que será utilizada:
 # --data_baixar="YYYY-MM-DD" (Ex: --data_baixar="2025-02-27")
 # --vec_asset_id=ID_VEICULO_MIX (Ex: 1581106874799685632)
+# --modo_descoberta=overlap|linear (opcional, padrão: variável MODO_DESCOBERTA)
 #
 # Além deste parâmetro, o sistema requer um arquivo .env com as seguintes variáveis de ambiente:
 # - DB_HOST: Endereço do banco
@@ -30,6 +31,9 @@
 # - DB_PASS: Senha do usuário
 # - DB_NAME: Nome do banco de dados
 # - DEBUG: Se deve ou não imprimir na tela informações de DEBUG
+# - CACHE_DIR: Diretório do cache em disco das geometrias das linhas (opcional)
+# - MODO_DESCOBERTA: "overlap" (padrão, sobreposição das áreas dos buffers) ou "linear" (referenciamento linear,
+#   cobertura ao longo do comprimento das linhas) (opcional)
 ###################################################################################
 
 ###################################################################################
@@ -39,6 +43,7 @@
 # Import de sistema
 import gc
 import os
+import time
 
 # DotEnv
 from dotenv import load_dotenv
@@ -64,8 +69,9 @@ import datetime as dt
 from datetime import datetime, timedelta
 
 # Biblioteca espaciais
+import numpy as np
 import geopandas as gpd
-from shapely.geometry import Point
+import shapely
 from shapely.ops import unary_union
 from shapely.geometry import shape, MultiLineString, MultiPolygon
 
@@ -75,8 +81,22 @@ from db import PostgresSingleton
 
 # Módulos locais
 from discover_bus_line import DiscoverBusLinesAlgorithm
+from geometry_cache import BusLineGeometries, CACHE_GEOMETRIAS_LINHAS
+from vehicle_day_data import VehicleDayData
+from fuel_integration import calcula_combustivel_df
 from bus_line_trip import BusLineInMixTrip
 from bus_line_comb_analyzer import BusLineCombAnalyzer
+from baseline_index import FuelBaselineIndex
+from result_writer import BufferedResultWriter
+from projection import projeta_xy, CRS_METRICO
+from line_metrics import (
+    TABELA_KML_DERIVADO,
+    COLUNAS_EXTREMOS,
+    COLUNA_TAMANHO,
+    COLUNA_GEOMETRIA_METRICA,
+    completa_metricas_linhas,
+    get_geometrias_metricas,
+)
 
 
 ###################################################################################
@@ -89,6 +109,12 @@ DEBUG = os.getenv("DEBUG", "True").lower() in ("true", "1", "yes")
 pgDB = PostgresSingleton.get_instance()
 pg_engine = pgDB.get_engine()
 
+# Índice em memória do histórico de km/l (carregado uma vez por processo, ou no forkserver pelo worker_preload)
+INDICE_BASELINE = FuelBaselineIndex(pgDB)
+
+# Escritor em lote dos resultados (salvo ao final de cada veículo ou ao atingir os limites do lote)
+ESCRITOR_RESULTADOS = BufferedResultWriter(pgDB, "rmtc_viagens_analise_mix")
+
 # Buffer da linha em metros
 TAMANHO_BUFFER_LINHA = 15
 
@@ -110,6 +136,24 @@ THRESHOLD_OVERLAP = 90
 # Tempo mínimo da viagem em segundos
 TEMPO_MINIMO_VIAGEM_SEGUNDOS = 60 * 10
 
+# Modo de descoberta das linhas
+MODO_OVERLAP = "overlap"
+MODO_LINEAR = "linear"
+MODO_DESCOBERTA = os.getenv("MODO_DESCOBERTA", MODO_OVERLAP).lower()
+
+
+# Exceção levantada quando o prazo do veículo (timeout dos workers do main) se esgota
+# O prazo só é verificado entre as trips, nunca no meio de uma escrita no banco ou da construção do cache das geometrias
+# Herda de BaseException para não ser capturada pelos "except Exception" do processamento do veículo
+class TimeoutVeiculo(BaseException):
+    pass
+
+
+# Levanta TimeoutVeiculo se o prazo (time.monotonic) já passou
+def verifica_prazo(prazo):
+    if prazo is not None and time.monotonic() > prazo:
+        raise TimeoutVeiculo()
+
 
 ###################################################################################
 # Etapa de Leitura de Dados
@@ -117,24 +161,23 @@ TEMPO_MINIMO_VIAGEM_SEGUNDOS = 60 * 10
 ###################################################################################
 
 
-# Função que verifica se uma determinada viagem já foi processada
-def verifica_viagem_processada(dia, vec_asset_id, num_viagem):
+# Função que retorna o conjunto de viagens (num_viagem) já processadas do veículo no dia
+def get_viagens_processadas(dia, vec_asset_id):
     """
-    Função que verifica se uma determinada viagem já foi processada
+    Função que retorna o conjunto de viagens (num_viagem) já processadas do veículo no dia
     """
     query = f"""
     SELECT 
-        *
+        num_viagem
     FROM 
         rmtc_viagens_analise_mix
     WHERE 
         dia = '{dia}'
         AND vec_asset_id = '{vec_asset_id}'
-        AND num_viagem = {num_viagem}
     """
-    df_viagem = pgDB.read_sql_safe(query)
+    df_viagens = pgDB.read_sql_safe(query)
 
-    return not df_viagem.empty
+    return set(df_viagens["num_viagem"].astype(int))
 
 
 # Função que retorna as trips MIX de um veículo em um determinado dia
@@ -177,14 +220,40 @@ def parse_geojson(geojson_str):
         return geometries  # Retorna uma lista com os tipos mistos
 
 
+# Verifica se a tabela com as métricas derivadas do KML (tamanho, extremos e geometria métrica) já existe
+# Ela é criada pela ingestão do KML (ra_update_linhas_kml)
+def existe_kml_derivado():
+    df_existe = pgDB.read_sql_safe(f"SELECT to_regclass('{TABELA_KML_DERIVADO}') IS NOT NULL AS existe")
+    return bool(df_existe["existe"].iloc[0])
+
+
 # Função para obter o KML da linha
 def get_linhas_kml(mix_timestamp_inicio):
     """
-    Função que retorna o KML da linha (geopanadas)
+    Função que retorna o KML da linha (geopanadas), com as métricas derivadas (tamanho, extremos e geometria
+    métrica) salvas na ingestão do KML ou, na falta delas, calculadas a partir do GeoJSON
     """
+    # Métricas pré-calculadas
+    colunas_derivadas = ""
+    join_derivado = ""
+    if existe_kml_derivado():
+        colunas_derivadas = """,
+        d.tamanho_m,
+        d.start_longitude,
+        d.start_latitude,
+        d.end_longitude,
+        d.end_latitude,
+        d.geometria_metrica_wkb"""
+        join_derivado = f"""
+    LEFT JOIN {TABELA_KML_DERIVADO} d ON d.origem = linhas.origem AND d.id_kml = linhas.id"""
+
     # Query
-    query_linha = f"""    
+    query_linha = f"""
     SELECT
+        linhas.*{colunas_derivadas}
+    FROM (
+    SELECT
+        'via_ra' AS origem,
         id,
         diahorario,
         numero,
@@ -204,6 +273,7 @@ def get_linhas_kml(mix_timestamp_inicio):
 
     -- Parte 2: dados do kml (com valores fixos para colunas ausentes)
     SELECT
+        'kml' AS origem,
         id,
         diahorario,
         numero,
@@ -220,7 +290,8 @@ def get_linhas_kml(mix_timestamp_inicio):
             SELECT DISTINCT numero FROM rmtc_kml_via_ra
         )
         ORDER BY numero, sentido, ABS(EXTRACT(EPOCH FROM (rk.diahorario::timestamptz - '{mix_timestamp_inicio}'::timestamptz)))
-    ) AS kml;
+    ) AS kml
+    ) AS linhas{join_derivado};
     """
     df_linha_raw = pgDB.read_sql_safe(query_linha)
 
@@ -233,144 +304,138 @@ def get_linhas_kml(mix_timestamp_inicio):
     # Cria o GeoDF
     gdf_linha_raw = gpd.GeoDataFrame(df_linha_raw, geometry="geometry", crs="EPSG:4326")  # WGS84 CRS
 
-    return gdf_linha_raw
+    # Completa as métricas das linhas que ainda não estão na tabela derivada
+    return completa_metricas_linhas(gdf_linha_raw)
 
 
-# Função principal para obter linha com buffer
-def get_linha_buffer_gdf(linhagdf, tamanho_buffer_linha=TAMANHO_BUFFER_LINHA):
-    gdf_linha_buffer = linhagdf.copy()
-
-    # Converte para 5641
-    gdf_linha_buffer = gdf_linha_buffer.to_crs("EPSG:5641")
-
-    # Aplica buffer
-    gdf_linha_buffer["geometry"] = gdf_linha_buffer["geometry"].buffer(tamanho_buffer_linha)
-
-    return gdf_linha_buffer
-
+# Função que retorna os ids dos KMLs selecionados por get_linhas_kml (snapshot do KML)
+def get_ids_linhas_kml(mix_timestamp_inicio):
+    """
+    Função que retorna a chave (origem, id) dos KMLs que seriam selecionados para o timestamp (sem o geojson)
+    """
+    # Query (mesma seleção de get_linhas_kml)
+    query_ids = f"""
+    SELECT 'via_ra' AS origem, id
+    FROM (
+        SELECT DISTINCT ON (numero_sublinha, sentido) id
+        FROM rmtc_kml_via_ra kml
+        ORDER BY numero_sublinha, sentido, ABS(EXTRACT(EPOCH FROM (kml.diahorario::timestamptz - '{mix_timestamp_inicio}'::timestamptz)))
+    ) AS via_ra
 
-# Função para buffer condicional
-def buffer_start_point(row):
-    # Se a linha for menor que 10km, o buffer é de 150m
-    # Senão, o buffer é de 300m
-    if row["tamanhokm"] < 10:
-        return row["start_point"].buffer(TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_PEQUENA)
-    else:
-        return row["start_point"].buffer(TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_GRANDE)
+    UNION ALL
 
+    SELECT 'kml' AS origem, id
+    FROM (
+        SELECT DISTINCT ON (numero, sentido) id
+        FROM rmtc_kml rk
+        WHERE rk.numero NOT IN (
+            SELECT DISTINCT numero FROM rmtc_kml_via_ra
+        )
+        ORDER BY numero, sentido, ABS(EXTRACT(EPOCH FROM (rk.diahorario::timestamptz - '{mix_timestamp_inicio}'::timestamptz)))
+    ) AS kml;
+    """
+    df_ids = pgDB.read_sql_safe(query_ids)
 
-def buffer_end_point(row):
-    # Se a linha for menor que 10km, o buffer é de 150m
-    # Senão, o buffer é de 300m
-    if row["tamanhokm"] < 10:
-        return row["end_point"].buffer(TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_PEQUENA)
-    else:
-        return row["end_point"].buffer(TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_GRANDE)
+    return tuple(sorted(zip(df_ids["origem"], df_ids["id"])))
 
 
-# Função para obter os pontos extremos da linha
-def get_pontos_extremos_buffers_gdf(linhagdf):
-    # Extraí o primeiro e último ponto de cada linha
-    extremes = []
-    for _, row in linhagdf.iterrows():
-        line = row["geometry"]
-        if not line.is_empty:
-            start_point = line.coords[0]  # Primeiro Ponto
-            end_point = line.coords[-1]  # Último Ponto
-            extremes.append(
-                {
-                    "numero": row["numero"],
-                    "numero_sublinha": row["numero_sublinha"],
-                    "sentido": row["sentido"],
-                    "tamanhokm": row["tamanhokm"],
-                    "start_point": Point(start_point),
-                    "START_LATITUDE": start_point[1],
-                    "START_LONGITUDE": start_point[0],
-                    "end_point": Point(end_point),
-                    "END_LATITUDE": end_point[1],
-                    "END_LONGITUDE": end_point[0],
-                }
-            )
+# Função que retorna as geometrias (raw, buffers e pontos extremos) das linhas, usando o cache do processo
+def get_geometrias_linhas(mix_timestamp_inicio):
+    """
+    Função que retorna as geometrias preparadas das linhas para o snapshot do KML vigente no timestamp
+    """
 
-    gdf_linhas_extremo_start = gpd.GeoDataFrame(extremes, geometry="start_point")
-    gdf_linhas_extremo_start.set_crs(epsg=4326, inplace=True)
+    def constroi_geometrias():
+        # Linhas KML
+        gdf_linha_raw = get_linhas_kml(mix_timestamp_inicio)
 
-    gdf_linhas_extremo_end = gpd.GeoDataFrame(extremes, geometry="end_point")
-    gdf_linhas_extremo_end.set_crs(epsg=4326, inplace=True)
+        # Buffer das linhas
+        gdf_linha_buffer = get_linha_buffer_gdf(gdf_linha_raw, TAMANHO_BUFFER_LINHA)
 
-    # Cria os buffers
-    gdf_linhas_extremo_start_buffer = gdf_linhas_extremo_start.copy()
-    gdf_linhas_extremo_start_buffer = gdf_linhas_extremo_start_buffer.to_crs("EPSG:5641")
-    gdf_linhas_extremo_start_buffer["start_point"] = gdf_linhas_extremo_start_buffer.apply(buffer_start_point, axis=1)
+        # Pontos extremos
+        gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer = get_pontos_extremos_buffers_gdf(gdf_linha_raw)
 
-    gdf_linhas_extremo_end_buffer = gdf_linhas_extremo_end.copy()
-    gdf_linhas_extremo_end_buffer = gdf_linhas_extremo_end_buffer.to_crs("EPSG:5641")
-    gdf_linhas_extremo_end_buffer["end_point"] = gdf_linhas_extremo_end_buffer.apply(buffer_end_point, axis=1)
+        return BusLineGeometries(
+            gdf_linha_raw, gdf_linha_buffer, gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer
+        )
 
-    return gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer
+    # A chave inclui os tamanhos de buffer, pois o cache também é persistido em disco
+    chave_snapshot = (
+        get_ids_linhas_kml(mix_timestamp_inicio),
+        TAMANHO_BUFFER_LINHA,
+        TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_PEQUENA,
+        TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_GRANDE,
+    )
 
+    return CACHE_GEOMETRIAS_LINHAS.get_geometrias(chave_snapshot, constroi_geometrias)
 
-# Função auxiliar para obter o combustível
-def get_combustivel(asset_id, data_trip_inicio, data_trip_final, tempo_buffer=TEMPO_BUFFER):
-    # Converte datas para datetime
-    data_trip_inicio_dt = pd.to_datetime(data_trip_inicio)
-    data_trip_final_dt = pd.to_datetime(data_trip_final)
 
-    # Adiciona buffer para o período, como o combustível é lido de 5 em 5 minutos adicionamos 10 minutos para cada lado
-    # para uma boa margem de segurança
-    data_trip_inicio_buffer_dt = data_trip_inicio_dt - pd.Timedelta(minutes=tempo_buffer)
-    data_trip_final_buffer_dt = data_trip_final_dt + pd.Timedelta(minutes=tempo_buffer)
+# Função principal para obter linha com buffer
+def get_linha_buffer_gdf(linhagdf, tamanho_buffer_linha=TAMANHO_BUFFER_LINHA):
+    # Geometrias já projetadas para 5641 (tabela derivada do KML)
+    geometrias_metricas = get_geometrias_metricas(linhagdf)
+
+    # Aplica buffer (mesma resolução padrão do GeoSeries.buffer)
+    gdf_linha_buffer = gpd.GeoDataFrame(
+        linhagdf.drop(columns=["geometry", COLUNA_GEOMETRIA_METRICA], errors="ignore"),
+        geometry=shapely.buffer(geometrias_metricas, tamanho_buffer_linha, quad_segs=16),
+        crs=CRS_METRICO,
+    )
 
-    # Converte para formato ISO
-    inicio_str = data_trip_inicio_buffer_dt.isoformat()
-    fim_str = data_trip_final_buffer_dt.isoformat()
+    return gdf_linha_buffer
 
-    query_combustivel = f"""
-    SELECT 
-        *
-    FROM 
-        tst_combs tc 
-    WHERE 
-        tc."AssetId" = {asset_id}
-        AND
-        CAST(tc."StartDateTime" AS TIMESTAMPTZ) BETWEEN '{inicio_str}'::TIMESTAMPTZ AND '{fim_str}'::TIMESTAMPTZ
-    """
 
-    df_comb = pgDB.read_sql_safe(query_combustivel)
-    df_comb_sort = df_comb.sort_values(by="StartDateTime")
+# Buffer condicional dos pontos extremos
+# Se a linha for menor que 10km, o buffer é de TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_PEQUENA
+# Senão, o buffer é de TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_GRANDE
+def get_tamanhos_buffer_extremos(tamanhokm):
+    return np.where(
+        np.asarray(tamanhokm, dtype=float) < 10,
+        TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_PEQUENA,
+        TAMANHO_BUFFER_PONTOS_EXTREMOS_LINHA_GRANDE,
+    )
 
-    return df_comb_sort
 
+# Buffer (5641) dos pontos extremos a partir das coordenadas (longitude/latitude)
+def get_buffer_extremos(longitudes, latitudes, tamanhos_buffer):
+    x, y = projeta_xy(longitudes, latitudes)
+    return shapely.buffer(shapely.points(x, y), tamanhos_buffer, quad_segs=16)
 
-# Função auxiliar para obtenção da posição do veículo
-def get_posicoes_gps(asset_id, data_trip_inicio, data_trip_final):
-    # Converte datas para datetime
-    data_trip_inicio_dt = pd.to_datetime(data_trip_inicio)
-    data_trip_final_dt = pd.to_datetime(data_trip_final)
 
-    # Adiciona buffer para o período, adicionamos 10 minutos para cada lado para uma boa margem de segurança
-    data_trip_inicio_buffer_dt = data_trip_inicio_dt - pd.Timedelta(minutes=10)
-    data_trip_final_buffer_dt = data_trip_final_dt + pd.Timedelta(minutes=10)
+# Função para obter os pontos extremos da linha
+# Os extremos (primeiro e último ponto) vêm da tabela derivada do KML (ou são calculados em get_linhas_kml)
+def get_pontos_extremos_buffers_gdf(linhagdf):
+    # Descarta as linhas vazias (sem extremos)
+    colunas = ["numero", "numero_sublinha", "sentido", "tamanhokm"] + COLUNAS_EXTREMOS
+    df_extremos = pd.DataFrame(linhagdf.loc[linhagdf["START_LONGITUDE"].notna(), colunas]).reset_index(drop=True)
 
-    # Converte para formato ISO
-    inicio_str = data_trip_inicio_buffer_dt.isoformat()
-    fim_str = data_trip_final_buffer_dt.isoformat()
+    # Pontos (EPSG:4326) e tamanho do buffer de cada linha
+    pontos_inicio = shapely.points(df_extremos["START_LONGITUDE"], df_extremos["START_LATITUDE"])
+    pontos_fim = shapely.points(df_extremos["END_LONGITUDE"], df_extremos["END_LATITUDE"])
+    tamanhos_buffer = get_tamanhos_buffer_extremos(df_extremos["tamanhokm"])
 
-    query_gps = f"""
-    SELECT 
-        *
-    FROM 
-        posicao_gps pg 
-    WHERE 
-        pg."AssetId" = '{asset_id}'
-        AND
-        CAST(pg."Timestamp" AS TIMESTAMPTZ) BETWEEN '{inicio_str}'::TIMESTAMPTZ AND '{fim_str}'::TIMESTAMPTZ
-    """
+    # Cria os buffers
+    gdf_linhas_extremo_start_buffer = gpd.GeoDataFrame(
+        df_extremos.assign(
+            start_point=get_buffer_extremos(
+                df_extremos["START_LONGITUDE"], df_extremos["START_LATITUDE"], tamanhos_buffer
+            ),
+            end_point=pontos_fim,
+        ),
+        geometry="start_point",
+        crs=CRS_METRICO,
+    )
 
-    df_gps = pgDB.read_sql_safe(query_gps)
-    df_gps_sort = df_gps.sort_values("Timestamp")
+    gdf_linhas_extremo_end_buffer = gpd.GeoDataFrame(
+        df_extremos.assign(
+            start_point=pontos_inicio,
+            end_point=get_buffer_extremos(df_extremos["END_LONGITUDE"], df_extremos["END_LATITUDE"], tamanhos_buffer),
+        ),
+        geometry="end_point",
+        crs=CRS_METRICO,
+    )
 
-    return df_gps_sort
+    return gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer
 
 
 ###################################################################################
@@ -378,19 +443,12 @@ def get_posicoes_gps(asset_id, data_trip_inicio, data_trip_final):
 ###################################################################################
 
 
+# Obtém o tamanho da linha (metros, UTM), pré-calculado na ingestão do KML
 def get_tamanho_linha(gdf_linha_raw, sentido_linha_overlap, sublinha_overlap):
-# Obtém o tamanho da linha
-    # Copia e joga para UTM
-    gdf_linhas_metros = gdf_linha_raw.copy().to_crs(epsg=31982)  # Substitua 31982 pela zona UTM correta, se necessário
-
-    # Calcular o comprimento de cada linha em metros
-    gdf_linhas_metros["length_m"] = gdf_linhas_metros["geometry"].length
-    gdf_linhas_metros[gdf_linhas_metros["sentido"] == sentido_linha_overlap]
-
-    tam_linha_metros = gdf_linhas_metros[
-        (gdf_linhas_metros["sentido"] == sentido_linha_overlap)
-        & (gdf_linhas_metros["numero_sublinha"] == sublinha_overlap)
-    ]["length_m"].sum()
+    tam_linha_metros = gdf_linha_raw[
+        (gdf_linha_raw["sentido"] == sentido_linha_overlap)
+        & (gdf_linha_raw["numero_sublinha"] == sublinha_overlap)
+    ][COLUNA_TAMANHO].sum()
 
     return tam_linha_metros
 
@@ -448,49 +506,6 @@ def get_duracao_viagem(df_gps_sort, linha_analise):
     return timestamp_inicio, timestamp_final, tempo_viagem_segundos, dt_start_round_timestamp, dt_end_round_timestamp
 
 
-# Calcula a quantidade de combustível utilizada
-def calcula_combustivel(df_comb_filtered, timestamp_inicio, timestamp_final):
-    # Verifica se o DataFrame está vazio
-    # ou
-    # só tem um único dado (impossibilita calcular pq fazemos o calculo pela diferença entre dados subsequenetos)
-    if df_comb_filtered.empty or len(df_comb_filtered) == 1:
-        return 0
-
-    # Primeira parte (buffer até inicial)
-    first_part_diff_seconds = (
-        300 - (pd.to_datetime(timestamp_inicio) - df_comb_filtered.iloc[0]["StartDateTime"]).total_seconds()
-    )
-    first_part_diff_comb = df_comb_filtered.iloc[1]["Value"] - df_comb_filtered.iloc[0]["Value"]
-    first_part_comb = first_part_diff_comb * first_part_diff_seconds / 300
-
-    # Parte do meio
-    middle_comb = 0
-    total_rows = len(df_comb_filtered)
-
-    for i in range(1, total_rows - 2):
-        df_comb_antes = df_comb_filtered.iloc[i]
-        df_comb_depois = df_comb_filtered.iloc[i + 1]
-
-        diff_comb = df_comb_depois["Value"] - df_comb_antes["Value"]
-
-        if diff_comb > 0:
-            middle_comb = middle_comb + (df_comb_depois["Value"] - df_comb_antes["Value"])
-        else:
-            middle_comb = middle_comb + (df_comb_depois["Value"])
-
-    # Última parte
-    last_part_diff_seconds = (
-        300 - (df_comb_filtered.iloc[-1]["StartDateTime"] - pd.to_datetime(timestamp_final)).total_seconds()
-    )
-    last_part_diff_comb = df_comb_filtered.iloc[-1]["Value"] - df_comb_filtered.iloc[-2]["Value"]
-    last_part_comb = last_part_diff_comb * last_part_diff_seconds / 300
-
-    # Combustível total
-    total_comb = first_part_comb + middle_comb + last_part_comb
-
-    return total_comb
-
-
 ###################################################################################
 # MAIN
 ####################################################################################
@@ -521,7 +536,7 @@ def pos_processa_linha(
     df_comb_filtered["StartDateTime"] = pd.to_datetime(df_comb_filtered["StartDateTime"])
 
     # Calcula quantidade de combustível utilizada
-    total_comb = calcula_combustivel(df_comb_filtered, timestamp_inicio, timestamp_final)
+    total_comb = calcula_combustivel_df(df_comb_filtered, timestamp_inicio, timestamp_final)
 
     # Computa km / l (convertendo para km e L só por desencargo)
     tam_linha_km = tam_linha_metros / 1000
@@ -576,16 +591,29 @@ def pos_processa_linha(
 
 
 # Processa as viagens de um veículo
-def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia):
+def processa_viagem(
+    vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia, modo_descoberta=MODO_DESCOBERTA, prazo=None
+):
     # Prepara os dados espaciais
-    # Linhas KML
-    gdf_linha_raw = get_linhas_kml(df_trips_dia_mix["TripStart"].min())
-
-    # Buffer das linhas
-    gdf_linha_buffer = get_linha_buffer_gdf(gdf_linha_raw, TAMANHO_BUFFER_LINHA)
+    # Linhas KML, buffers e pontos extremos vêm do cache do processo (somente leitura, não devem ser alterados)
+    geometrias_linhas = get_geometrias_linhas(df_trips_dia_mix["TripStart"].min())
+
+    # No modo linear, a descoberta usa o índice de referenciamento linear das linhas (também em cache)
+    indice_linear = geometrias_linhas.get_indice_linear() if modo_descoberta == MODO_LINEAR else None
+
+    # Pré-carrega as posições GPS e o combustível do veículo no dia (uma query para cada), cada trip é recortada em memória
+    dados_veiculo_dia = VehicleDayData(
+        pgDB,
+        vec_asset_id,
+        df_trips_dia_mix["TripStart"].min(),
+        df_trips_dia_mix["TripEnd"].max(),
+        tempo_buffer_gps=TEMPO_BUFFER,
+        tempo_buffer_combustivel=TEMPO_BUFFER,
+    )
 
-    # Pontos extremos
-    gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer = get_pontos_extremos_buffers_gdf(gdf_linha_raw)
+    # Viagens já processadas do veículo no dia (uma única query)
+    # A numeração depende da descoberta das linhas, por isso a verificação é feita após descobrir cada linha
+    viagens_processadas = get_viagens_processadas(dia, vec_asset_id)
 
     # Conta o número de viagens
     count_viagem = 1
@@ -595,26 +623,31 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia):
     discover_algorithm = DiscoverBusLinesAlgorithm(pgDB, DEBUG, vec_num_id, vec_asset_id, vec_model, dia)
 
     for _, row_trip in df_trips_dia_mix.iterrows():
+        # Timeout do veículo (verificado apenas entre as trips)
+        verifica_prazo(prazo)
+
         try:
             mix_trip_inicio = row_trip["TripStart"]
             mix_trip_fim = row_trip["TripEnd"]
 
             # Combustível
-            df_comb_sort = get_combustivel(vec_asset_id, mix_trip_inicio, mix_trip_fim, TEMPO_BUFFER)
+            df_comb_sort = dados_veiculo_dia.get_combustivel(mix_trip_inicio, mix_trip_fim)
 
             # Posições do GPS
-            df_gps_sort = get_posicoes_gps(vec_asset_id, mix_trip_inicio, mix_trip_fim)
+            df_gps_sort = dados_veiculo_dia.get_posicoes_gps(mix_trip_inicio, mix_trip_fim)
 
             # Descobre as linhas
             linhas_onibus = discover_algorithm.discover_bus_lines(
                 df_gps_sort,
                 df_comb_sort,
-                gdf_linha_buffer.copy(),
-                gdf_linhas_extremo_start_buffer.copy(),
-                gdf_linhas_extremo_end_buffer.copy(),
+                geometrias_linhas.gdf_linha_buffer,
+                geometrias_linhas.gdf_linhas_extremo_start_buffer,
+                geometrias_linhas.gdf_linhas_extremo_end_buffer,
                 TAMANHO_BUFFER_POSICAO_VEICULO,
                 THRESHOLD_OVERLAP,
-                TEMPO_MINIMO_VIAGEM_SEGUNDOS
+                TEMPO_MINIMO_VIAGEM_SEGUNDOS,
+                geometrias_linhas.indice_linhas,
+                indice_linear,
             )
 
             # Verifica se encontrou alguma linha nas trips
@@ -627,7 +660,7 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia):
                     linha_analise.set_num_viagem(count_viagem)
 
                     # Verifica se a linha já foi processada
-                    viagem_ja_foi_processada = linha_analise.viagem_ja_foi_processada()
+                    viagem_ja_foi_processada = linha_analise.viagem_ja_foi_processada(viagens_processadas)
 
                     # Verifica a duração da viagem
                     tempo_viagem_segundos = linha_analise.get_tempo_viagem_segundos()
@@ -638,14 +671,21 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia):
                     else:
                         # Caso contrário, vamos processar
                         # Calcula tamanho da linha
-                        linha_analise.computa_tamanho_linha(gdf_linha_raw)
+                        linha_analise.computa_tamanho_linha(geometrias_linhas.get_tamanhos_linhas_metros())
 
                         # Calcula o combustível gasto nesta linha
                         linha_analise.computa_combustivel()
 
                         # Agora, compara os valores de combustível
                         # Separamos em outra classe para facilitar a compreensão do código
-                        analise_combustivel = BusLineCombAnalyzer(pgDB, DEBUG, linha_analise, count_viagem)
+                        analise_combustivel = BusLineCombAnalyzer(
+                            pgDB,
+                            DEBUG,
+                            linha_analise,
+                            count_viagem,
+                            indice_baseline=INDICE_BASELINE,
+                            escritor=ESCRITOR_RESULTADOS,
+                        )
 
                         # Classifica o combustível calculado
                         analise_combustivel.classifica_combustivel_gasto()
@@ -665,7 +705,7 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia):
         gc.collect()
 
 
-def processa_veiculo(row, dia):
+def processa_veiculo(row, dia, modo_descoberta=MODO_DESCOBERTA, prazo=None):
     vec_num_id = row["Description"]
     vec_asset_id = row["AssetId"]
     vec_model = row["Model"]
@@ -675,7 +715,7 @@ def processa_veiculo(row, dia):
 
         # Se possuí viagens nesse dia
         if len(df_trips_dia_mix) > 0:
-            processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia)
+            processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia_mix, dia, modo_descoberta, prazo)
 
     except Exception as e:
         print(f"Erro ao processar veículo: {vec_num_id} - {vec_asset_id} - {vec_model}")
@@ -685,16 +725,9 @@ def processa_veiculo(row, dia):
     gc.collect()
 
 
-@click.command()
-@click.option("--data_baixar", type=str, help="Data para baixar")
-@click.option("--vec_asset_id", type=int, help="ID do veículo")
-def main(data_baixar, vec_asset_id):
-    df_veiculos = pd.DataFrame()
-
-    # Debug variables
-    # data_baixar = "2025-09-12"
-    # vec_asset_id = 1344837246205296640 # 5017
-    
+# Analisa um único veículo em um único dia
+# Usado tanto pela linha de comando quanto pelos workers do main (que informam o prazo do veículo)
+def analisa_veiculo_dia(vec_asset_id, dia_str, modo_descoberta=MODO_DESCOBERTA, prazo=None):
     # Obtém o veículo a ser processado
     df_veiculos = pgDB.read_sql_safe(
         f"""
@@ -702,6 +735,29 @@ def main(data_baixar, vec_asset_id):
         """,
     )
 
+    # Dado do veículo
+    row_veiculo = df_veiculos.iloc[0]
+    try:
+        processa_veiculo(row_veiculo, dia_str, modo_descoberta, prazo)
+    finally:
+        # Salva as viagens pendentes do veículo (inclusive as concluídas antes de um timeout)
+        ESCRITOR_RESULTADOS.flush()
+
+
+@click.command()
+@click.option("--data_baixar", type=str, help="Data para baixar")
+@click.option("--vec_asset_id", type=int, help="ID do veículo")
+@click.option(
+    "--modo_descoberta",
+    type=click.Choice([MODO_OVERLAP, MODO_LINEAR]),
+    default=MODO_DESCOBERTA,
+    help="Sobreposição das áreas (overlap) ou referenciamento linear (linear)",
+)
+def main(data_baixar, vec_asset_id, modo_descoberta):
+    # Debug variables
+    # data_baixar = "2025-09-12"
+    # vec_asset_id = 1344837246205296640 # 5017
+
     # Obtem a data a ser processada, assume hoje caso não seja informado
     dia_dt = dt.datetime.now()
 
@@ -710,9 +766,7 @@ def main(data_baixar, vec_asset_id):
 
     dia_str = dia_dt.strftime("%Y-%m-%d")
 
-    # Dado do veículo
-    row_veiculo = df_veiculos.iloc[0]
-    processa_veiculo(row_veiculo, dia_str)
+    analisa_veiculo_dia(vec_asset_id, dia_str, modo_descoberta)
 
 
 if __name__ == "__main__":
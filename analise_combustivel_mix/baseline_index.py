@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Índice em memória do histórico de km/l usado como referência (baseline) na classificação do combustível
+# - O histórico de rmtc_viagens_analise_mix é carregado uma única vez por processo (no pool de workers do main,
+#   uma única vez no forkserver, herdado por todos os workers)
+# - As viagens são agrupadas por (modelo padronizado, sublinha, sentido, slot de horário, dia da semana, feriado),
+#   com as mesmas regras da query que BusLineCombAnalyzer executava para cada viagem
+# - As viagens do dia em processamento são relidas periodicamente (outros processos também salvam viagens nesse dia)
+#   e as viagens salvas por este processo são adicionadas de forma incremental
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import time
+import numpy as np
+import pandas as pd
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Formato do timestamp salvo (mesmo do TO_TIMESTAMP da query)
+FORMATO_TIMESTAMP = "%Y-%m-%dT%H:%M:%SZ"
+
+# Deslocamento usado pela query para obter o horário local
+DESLOCAMENTO_HORARIO_LOCAL = pd.Timedelta(hours=3)
+
+# Limites de km/l considerados válidos para a referência
+KM_POR_LITRO_MINIMO = 0.5
+KM_POR_LITRO_MAXIMO = 10
+
+# Municípios considerados na tabela de feriados
+MUNICIPIOS_FERIADOS = ("Brasil", "Goiás", "Goiânia")
+
+# Intervalo (em segundos) para reler as viagens do dia em processamento
+TEMPO_ATUALIZACAO_DIA_SEGUNDOS = 60
+
+# Padronização do modelo do veículo (prefixo, sem diferenciar maiúsculas, -> modelo padronizado)
+MODELOS_PADRONIZADOS = [
+    ("MB OF 1721", "MB OF 1721 MPOLO TORINO U"),
+    ("IVECO/MASCA", "IVECO/MASCA GRAN VIA"),
+    ("VW 17230 APACHE VIP", "VW 17230 APACHE VIP-SC"),
+    ("O500", "O500"),
+    ("ELETRA INDUSCAR MILLENNIUM", "ELETRA INDUSCAR MILLENNIUM"),
+    ("Induscar", "INDUSCAR"),
+    ("VW 22.260 CAIO INDUSCAR", "VW 22.260 CAIO INDUSCAR"),
+]
+
+# Colunas lidas do histórico
+COLUNAS_HISTORICO = [
+    "dia",
+    "num_viagem",
+    "vec_asset_id",
+    "vec_num_id",
+    "vec_model",
+    "encontrou_linha",
+    "encontrou_numero_sublinha",
+    "encontrou_sentido_linha",
+    "encontrou_timestamp_inicio",
+    "km_por_litro",
+]
+
+# Colunas que formam a chave do grupo
+COLUNAS_GRUPO = ["modelo_padronizado", "sublinha", "sentido", "slot_horario", "dow", "feriado"]
+
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Função que padroniza o modelo do veículo (equivalente ao CASE ... ILIKE da query)
+def padroniza_modelo(vec_model):
+    if vec_model is None or pd.isnull(vec_model):
+        return None
+
+    vec_model_upper = str(vec_model).upper()
+    for prefixo, modelo_padronizado in MODELOS_PADRONIZADOS:
+        if vec_model_upper.startswith(prefixo.upper()):
+            return modelo_padronizado
+
+    return vec_model
+
+
+# Função que retorna os DOWs (PostgreSQL, 0 = domingo) aceitos para o dia da viagem
+# Reproduz o filtro da query original: dia útil -> DOW 2 a 6, sábado -> DOW 7 (nenhum), domingo -> sem filtro
+def get_dows_permitidos(dia_numerico):
+    if dia_numerico in [2, 3, 4, 5, 6]:
+        return [2, 3, 4, 5, 6]
+    elif dia_numerico == 7:
+        return [7]
+    elif dia_numerico == 0:
+        return [1]
+
+    return list(range(0, 7))
+
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class FuelBaselineIndex(object):
+    def __init__(self, pgDB, tempo_atualizacao_dia=TEMPO_ATUALIZACAO_DIA_SEGUNDOS):
+        self.pgDB = pgDB
+        self.tempo_atualizacao_dia = tempo_atualizacao_dia
+
+        self.carregado = False
+        self.feriados = set()               # datas (locais) de feriado
+        self.modelos_veiculos = dict()      # vec_num_id -> modelo padronizado
+        self.grupos = dict()                # chave do grupo -> (dias, km_por_litro) do histórico carregado
+        self.viagens_dia = dict()           # dia -> {"atualizado_em": ..., "viagens": {pk: (chave, dia, km/l)}}
+
+    # Carrega o histórico (uma única vez por processo)
+    def carrega(self):
+        if self.carregado:
+            return
+
+        df_feriados = self.pgDB.read_sql_safe(
+            f"""
+            SELECT DISTINCT data
+            FROM feriados_goias
+            WHERE municipio IN {MUNICIPIOS_FERIADOS}
+            """
+        )
+        self.feriados = set(pd.to_datetime(df_feriados["data"]))
+
+        df_historico = self.pgDB.read_sql_safe(
+            f"""
+            SELECT {", ".join(COLUNAS_HISTORICO)}
+            FROM rmtc_viagens_analise_mix
+            """
+        )
+        self.__atualiza_modelos_veiculos(df_historico)
+
+        df_grupos = self.__prepara_viagens(df_historico)
+        for chave, df_grupo in df_grupos.groupby(COLUNAS_GRUPO, sort=False):
+            self.grupos[chave] = (df_grupo["dia"].to_numpy(), df_grupo["km_por_litro"].to_numpy(dtype=np.float64))
+
+        self.carregado = True
+
+    # Retorna as viagens (dia, km_por_litro) na mesma configuração da viagem (bus_line), no slot informado
+    def get_viagens_mesma_config(self, bus_line, time_slot_viagem):
+        self.carrega()
+
+        dia_dt = pd.to_datetime(bus_line.dia)
+        self.__atualiza_viagens_dia(dia_dt)
+
+        # Modelo do veículo, obtido do seu próprio histórico (sem histórico não há referência)
+        modelo_padronizado = self.modelos_veiculos.get(str(bus_line.vec_num_id))
+
+        chaves = set()
+        if modelo_padronizado is not None:
+            for dow in get_dows_permitidos(bus_line.dia_numerico):
+                chaves.add(
+                    (
+                        modelo_padronizado,
+                        str(bus_line.numero_sublinha),
+                        str(bus_line.sentido_linha_overlap),
+                        time_slot_viagem,
+                        dow,
+                        bool(bus_line.dia_eh_feriado),
+                    )
+                )
+
+        # Histórico carregado (sem o dia em processamento, que vem das viagens do dia)
+        dias, kmls = [], []
+        for chave in chaves:
+            if chave in self.grupos:
+                dias_grupo, kmls_grupo = self.grupos[chave]
+                mascara = dias_grupo != dia_dt
+                dias.append(dias_grupo[mascara])
+                kmls.append(kmls_grupo[mascara])
+
+        # Viagens do dia em processamento
+        for chave, dia_viagem, kml_viagem in self.viagens_dia[dia_dt]["viagens"].values():
+            if chave in chaves:
+                dias.append(np.array([dia_viagem], dtype="datetime64[ns]"))
+                kmls.append(np.array([kml_viagem]))
+
+        if len(dias) == 0:
+            return pd.DataFrame({"dia": pd.Series(dtype="datetime64[ns]"), "km_por_litro": pd.Series(dtype=float)})
+
+        return pd.DataFrame({"dia": np.concatenate(dias), "km_por_litro": np.concatenate(kmls)})
+
+    # Adiciona uma viagem recém salva (mesmas colunas da tabela)
+    def adiciona_viagem(self, viagem_dict):
+        df_viagem = pd.DataFrame([{coluna: viagem_dict.get(coluna) for coluna in COLUNAS_HISTORICO}])
+        self.__atualiza_modelos_veiculos(df_viagem)
+
+        dia_dt = pd.to_datetime(viagem_dict["dia"])
+        if dia_dt not in self.viagens_dia:
+            self.viagens_dia[dia_dt] = {"atualizado_em": None, "viagens": dict()}
+
+        self.__adiciona_viagens_dia(dia_dt, df_viagem)
+
+    # Relê as viagens do dia caso a última leitura tenha mais de tempo_atualizacao_dia segundos
+    def __atualiza_viagens_dia(self, dia_dt):
+        viagens_dia = self.viagens_dia.setdefault(dia_dt, {"atualizado_em": None, "viagens": dict()})
+        agora = time.monotonic()
+
+        if viagens_dia["atualizado_em"] is not None and agora - viagens_dia["atualizado_em"] < self.tempo_atualizacao_dia:
+            return
+
+        df_dia = self.pgDB.read_sql_safe(
+            f"""
+            SELECT {", ".join(COLUNAS_HISTORICO)}
+            FROM rmtc_viagens_analise_mix
+            WHERE dia = '{dia_dt.strftime("%Y-%m-%d")}'
+            """
+        )
+        self.__atualiza_modelos_veiculos(df_dia)
+        self.__adiciona_viagens_dia(dia_dt, df_dia)
+
+        viagens_dia["atualizado_em"] = agora
+
+    def __adiciona_viagens_dia(self, dia_dt, df):
+        df_validas = self.__prepara_viagens(df)
+        viagens = self.viagens_dia[dia_dt]["viagens"]
+
+        for row in df_validas.itertuples(index=False):
+            pk = (row.num_viagem, str(row.vec_asset_id))
+            chave = tuple(getattr(row, coluna) for coluna in COLUNAS_GRUPO)
+            viagens[pk] = (chave, row.dia, row.km_por_litro)
+
+    # Modelo padronizado de cada veículo (o primeiro encontrado, como o LIMIT 1 da query)
+    def __atualiza_modelos_veiculos(self, df):
+        for vec_num_id, vec_model in zip(df["vec_num_id"], df["vec_model"]):
+            self.modelos_veiculos.setdefault(str(vec_num_id), padroniza_modelo(vec_model))
+
+    # Filtra as viagens válidas e calcula as colunas da chave do grupo
+    def __prepara_viagens(self, df):
+        df = df.copy()
+        df["km_por_litro"] = pd.to_numeric(df["km_por_litro"], errors="coerce")
+        df = df[
+            (df["encontrou_linha"] == True)
+            & (df["km_por_litro"] > KM_POR_LITRO_MINIMO)
+            & (df["km_por_litro"] < KM_POR_LITRO_MAXIMO)
+        ].copy()
+
+        # Horário local como na query (TO_TIMESTAMP(...) - INTERVAL '3 hours')
+        local = pd.to_datetime(df["encontrou_timestamp_inicio"], format=FORMATO_TIMESTAMP, errors="coerce")
+        local = local - DESLOCAMENTO_HORARIO_LOCAL
+        df = df[local.notna()].copy()
+        local = local[local.notna()]
+
+        # Slot: hora truncada + ROUND(minuto / 30) * 30 minutos (ROUND do PostgreSQL arredonda 0.5 para cima)
+        minutos_slot = np.floor(local.dt.minute / 30.0 + 0.5) * 30
+        slot = local.dt.floor("h") + pd.to_timedelta(minutos_slot, unit="m")
+
+        df["dia"] = pd.to_datetime(df["dia"])
+        df["modelo_padronizado"] = df["vec_model"].map(padroniza_modelo)
+        df["sublinha"] = df["encontrou_numero_sublinha"].astype(str)
+        df["sentido"] = df["encontrou_sentido_linha"].astype(str)
+        df["slot_horario"] = slot.dt.strftime("%H:%M")
+        df["dow"] = (local.dt.dayofweek + 1) % 7  # PostgreSQL: domingo = 0
+        df["feriado"] = local.dt.normalize().isin(self.feriados)
+
+        return df
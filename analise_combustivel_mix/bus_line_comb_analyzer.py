@@ -18,18 +18,27 @@ from sqlalchemy.dialects.postgresql import insert
 
 # Módulos Específicos
 from bus_line_trip import BusLineInMixTrip
+from result_writer import CHAVES_CONFLITO
 
 ###################################################################################
 # Classe
 ###################################################################################
 
 class BusLineCombAnalyzer(object):
-    def __init__(self, pgDB, debug, bus_line: BusLineInMixTrip, count_num_viagem):
+    def __init__(
+        self, pgDB, debug, bus_line: BusLineInMixTrip, count_num_viagem, indice_baseline=None, escritor=None
+    ):
         # Credenciais e debug
         self.pgDB = pgDB
         self.debug = debug
         self.bus_line = bus_line
 
+        # Índice em memória do histórico (FuelBaselineIndex), se não houver consulta o banco a cada viagem
+        self.indice_baseline = indice_baseline
+
+        # Escritor em lote dos resultados (BufferedResultWriter), se não houver salva cada viagem individualmente
+        self.escritor = escritor
+
         # Dados de combustível
         self.total_comb_l = bus_line.total_comb_l
         self.km_por_litro = bus_line.km_por_litro
@@ -43,103 +52,21 @@ class BusLineCombAnalyzer(object):
         # Dados comparativos
         self.analise_dict = dict()
 
-    def computa_combustivel(self):
-        # Computa o tempo de viagem
-        # Salva na classe os timestamps da viagens que serão usados a seguir e também na hora de salvar
-        # Destaca-se que o dt_start_round_timestamp > timestamp_inicio uma vez que
-        # - Isso porque dt_start_round_timestamp arredonda o tempo a fração de 5 minutos anterior
-        # - Isso é feito porque o sistema retorna o combustível de 5 em 5 minutos, assim, precisamos disso para pegar o
-        #   combustível que ocorre no intervalo. Fazemos a interpolação para considerar esse consumo.
-        self.bus_line.computa_duracao_viagem()
-
-        # Filtra os dados de combustível
-        df_comb_filtered = self.bus_line.df_comb_sort[
-            (self.bus_line.df_comb_sort["StartDateTime"] >= self.dt_start_round_timestamp)
-            & (self.bus_line.df_comb_sort["StartDateTime"] <= self.dt_end_round_timestamp)
-        ].copy()
-        df_comb_filtered["StartDateTime"] = pd.to_datetime(df_comb_filtered["StartDateTime"])
-
-        # Calcula quantidade de combustível utilizada
-        # Soma o consumo de 5 em 5 minutos e faz a interpolação para a parte inicial e final
-        total_comb = self.__calcula_combustivel(
-            df_comb_filtered, self.bus_line.timestamp_inicio, self.bus_line.timestamp_final
-        )
-
-        # Computa km / l (convertendo para km e L)
-        tam_linha_km = self.bus_line.tam_linha_metros / 1000
-        self.total_comb_L = total_comb / 1000
-
-        # Caso o modelo do veículo seja VW dividimos o total de combustível por 5614
-        if self.vec_model == "VW 17230 APACHE VIP-SC " or self.vec_model == "VW 17230 APACHE VIP-SC":
-            self.total_comb_L = total_comb / 5614
-
-        # Computa km / l
-        tam_linha_km_sobreposicao = tam_linha_km * (self.bus_line.overlap_final / 100)
-
-        # Caso total_comb_L seja != 0, computa km por litro
-        if self.total_comb_L != 0:
-            self.km_por_litro = tam_linha_km_sobreposicao / self.total_comb_L
-        else:
-            self.km_por_litro = None
-            self.total_comb_L = None
-
-        return self.total_comb_L, self.km_por_litro
-
-    # Calcula a quantidade de combustível utilizada
-    def __calcula_combustivel(df_comb_filtered, timestamp_inicio, timestamp_final):
-        # Verifica se o DataFrame está vazio
-        # ou
-        # só tem um único dado (impossibilita calcular pq fazemos o calculo pela diferença entre dados subsequenetos)
-        if df_comb_filtered.empty or len(df_comb_filtered) == 1:
-            return 0
-
-        # Primeira parte (buffer até inicial)
-        # 300 = 5 minutos antes até o tempo inicial, para interpolar e pegar o combustível ponderado
-        first_part_diff_seconds = (
-            300 - (pd.to_datetime(timestamp_inicio) - df_comb_filtered.iloc[0]["StartDateTime"]).total_seconds()
-        )
-        first_part_diff_comb = df_comb_filtered.iloc[1]["Value"] - df_comb_filtered.iloc[0]["Value"]
-        first_part_comb = first_part_diff_comb * first_part_diff_seconds / 300
-
-        # Parte do meio
-        middle_comb = 0
-        total_rows = len(df_comb_filtered)
-
-        for i in range(1, total_rows - 2):
-            df_comb_antes = df_comb_filtered.iloc[i]
-            df_comb_depois = df_comb_filtered.iloc[i + 1]
-
-            diff_comb = df_comb_depois["Value"] - df_comb_antes["Value"]
-
-            if diff_comb > 0:
-                middle_comb = middle_comb + (df_comb_depois["Value"] - df_comb_antes["Value"])
-            else:
-                middle_comb = middle_comb + (df_comb_depois["Value"])
-
-        # Última parte
-        last_part_diff_seconds = (
-            300 - (df_comb_filtered.iloc[-1]["StartDateTime"] - pd.to_datetime(timestamp_final)).total_seconds()
-        )
-        last_part_diff_comb = df_comb_filtered.iloc[-1]["Value"] - df_comb_filtered.iloc[-2]["Value"]
-        last_part_comb = last_part_diff_comb * last_part_diff_seconds / 300
-
-        # Combustível total
-        total_comb = first_part_comb + middle_comb + last_part_comb
-
-        return total_comb
-
     def classifica_combustivel_gasto(self):
         # Função que classifica o combustível gasto nesta viagem
 
         # Primeiro identifica o time slot da viagem
         self.time_slot_viagem = self.__get_time_slot_viagem()
 
-        # Segundo, constrói a query para retornar TODAS as viagens com a mesma configuração
+        # Segundo, retorna TODAS as viagens com a mesma configuração
         # dia da semana + time slot + linha + sentido + modelo do veículo
-        query = self.__get_texto_query_viagens_na_mesma_configuracao_horario_linha_modelo()
-
-        # Executa a query
-        df_viagens_mesma_config = self.pgDB.read_sql_safe(query)
+        if self.indice_baseline is not None:
+            df_viagens_mesma_config = self.indice_baseline.get_viagens_mesma_config(
+                self.bus_line, self.time_slot_viagem
+            )
+        else:
+            query = self.__get_texto_query_viagens_na_mesma_configuracao_horario_linha_modelo()
+            df_viagens_mesma_config = self.pgDB.read_sql_safe(query)
 
         # Analisa as viagens
         self.analise_dict = self.__analisa_viagens_mesma_config(df_viagens_mesma_config)
@@ -185,18 +112,26 @@ class BusLineCombAnalyzer(object):
         # Cria o dataframe
         df_salvar = pd.DataFrame(dict_final, index=[0])
 
-        # Pega a engine
-        pg_engine = self.pgDB.get_engine()
-
-        # Salva no banco de dado PostgreSQL
-        metadata = MetaData()
-        tabela_rmtc_viagens_analise = Table(table_name, metadata, autoload_with=pg_engine)
-        
-        with pg_engine.begin() as conn:
-            # Faz o insert
-            stmt = insert(tabela_rmtc_viagens_analise).values(df_salvar.to_dict(orient="records"))
-            stmt = stmt.on_conflict_do_nothing(index_elements=["dia", "num_viagem", "vec_asset_id"])
-            conn.execute(stmt)
+        # Salva em lote (o escritor reflete a tabela uma única vez)
+        if self.escritor is not None:
+            self.escritor.adiciona(df_salvar.to_dict(orient="records")[0])
+        else:
+            # Pega a engine
+            pg_engine = self.pgDB.get_engine()
+
+            # Salva no banco de dado PostgreSQL
+            metadata = MetaData()
+            tabela_rmtc_viagens_analise = Table(table_name, metadata, autoload_with=pg_engine)
+
+            with pg_engine.begin() as conn:
+                # Faz o insert
+                stmt = insert(tabela_rmtc_viagens_analise).values(df_salvar.to_dict(orient="records"))
+                stmt = stmt.on_conflict_do_nothing(index_elements=CHAVES_CONFLITO)
+                conn.execute(stmt)
+
+        # Atualiza o índice em memória com a viagem salva
+        if self.indice_baseline is not None:
+            self.indice_baseline.adiciona_viagem(dict_final)
 
     def __get_time_slot_viagem(self):
         data_str = self.bus_line.timestamp_inicio
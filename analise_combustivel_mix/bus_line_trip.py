@@ -10,6 +10,9 @@ import pandas as pd
 from datetime import datetime
 import holidays
 
+# Integração do combustível
+from fuel_integration import calcula_combustivel_df
+
 ###################################################################################
 # Função utilitária e constantes
 ###################################################################################
@@ -136,7 +139,11 @@ class BusLineInMixTrip:
         self.num_viagem = num_viagem
 
     # Função que verifica se a linha já foi processada
-    def viagem_ja_foi_processada(self):
+    # Caso receba o conjunto de viagens já processadas no dia (num_viagem), verifica em memória
+    def viagem_ja_foi_processada(self, viagens_processadas=None):
+        if viagens_processadas is not None:
+            return self.num_viagem in viagens_processadas
+
         query = f"""
         SELECT 
             *
@@ -182,21 +189,10 @@ class BusLineInMixTrip:
         )
 
     # Computa o tamanho da linha
-    # Recebe como parâmetro o banco de linha (geopandas)
-    # Usamos o banco para filtar a linha identificada e projetá-la em outro sistema de coordenada para calcular o tamanho
-    def computa_tamanho_linha(self, gdf_linha_raw):
-        # Copia e joga para UTM
-        gdf_linhas_metros = gdf_linha_raw.copy().to_crs(
-            epsg=31982
-        )  # Substitua 31982 pela zona UTM correta, se necessário
-
-        # Calcular o comprimento de cada linha em metros
-        gdf_linhas_metros["length_m"] = gdf_linhas_metros["geometry"].length
-
-        tam_linha_metros = gdf_linhas_metros[
-            (gdf_linhas_metros["sentido"] == self.sentido_linha_overlap)
-            & (gdf_linhas_metros["numero_sublinha"] == self.numero_sublinha)
-        ]["length_m"].sum()
+    # Recebe como parâmetro o tamanho (metros, UTM) de cada (numero_sublinha, sentido), projetado uma única vez por
+    # snapshot do KML (BusLineGeometries.get_tamanhos_linhas_metros)
+    def computa_tamanho_linha(self, tamanhos_linhas_metros):
+        tam_linha_metros = tamanhos_linhas_metros.get((self.numero_sublinha, self.sentido_linha_overlap), 0)
 
         self.tam_linha_metros = tam_linha_metros
 
@@ -227,7 +223,7 @@ class BusLineInMixTrip:
 
         # Calcula quantidade de combustível utilizada
         # Soma o consumo de 5 em 5 minutos e faz a interpolação para a parte inicial e final
-        total_comb = self.__calcula_combustivel(df_comb_filtered, self.timestamp_inicio, self.timestamp_final)
+        total_comb = calcula_combustivel_df(df_comb_filtered, self.timestamp_inicio, self.timestamp_final)
 
         # Computa km / l (convertendo para km e L)
         tam_linha_km = self.tam_linha_metros / 1000
@@ -249,49 +245,6 @@ class BusLineInMixTrip:
 
         return self.total_comb_l, self.km_por_litro
 
-    # Calcula a quantidade de combustível utilizada
-    def __calcula_combustivel(self, df_comb_filtered, timestamp_inicio, timestamp_final):
-        # Verifica se o DataFrame está vazio
-        # ou
-        # só tem um único dado (impossibilita calcular pq fazemos o calculo pela diferença entre dados subsequenetos)
-        if df_comb_filtered.empty or len(df_comb_filtered) == 1:
-            return 0
-
-        # Primeira parte (buffer até inicial)
-        # 300 = 5 minutos antes até o tempo inicial, para interpolar e pegar o combustível ponderado
-        first_part_diff_seconds = (
-            300 - (pd.to_datetime(timestamp_inicio) - df_comb_filtered.iloc[0]["StartDateTime"]).total_seconds()
-        )
-        first_part_diff_comb = df_comb_filtered.iloc[1]["Value"] - df_comb_filtered.iloc[0]["Value"]
-        first_part_comb = first_part_diff_comb * first_part_diff_seconds / 300
-
-        # Parte do meio
-        middle_comb = 0
-        total_rows = len(df_comb_filtered)
-
-        for i in range(1, total_rows - 2):
-            df_comb_antes = df_comb_filtered.iloc[i]
-            df_comb_depois = df_comb_filtered.iloc[i + 1]
-
-            diff_comb = df_comb_depois["Value"] - df_comb_antes["Value"]
-
-            if diff_comb > 0:
-                middle_comb = middle_comb + (df_comb_depois["Value"] - df_comb_antes["Value"])
-            else:
-                middle_comb = middle_comb + (df_comb_depois["Value"])
-
-        # Última parte
-        last_part_diff_seconds = (
-            300 - (df_comb_filtered.iloc[-1]["StartDateTime"] - pd.to_datetime(timestamp_final)).total_seconds()
-        )
-        last_part_diff_comb = df_comb_filtered.iloc[-1]["Value"] - df_comb_filtered.iloc[-2]["Value"]
-        last_part_comb = last_part_diff_comb * last_part_diff_seconds / 300
-
-        # Combustível total
-        total_comb = first_part_comb + middle_comb + last_part_comb
-
-        return total_comb
-
     def __str__(self):
         return f"""
 ---------
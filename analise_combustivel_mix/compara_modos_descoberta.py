@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+###################################################################################
+# Compara os modos de descoberta das linhas (overlap x linear) nas mesmas trips
+###################################################################################
+# Para cada trip dos veículos informados, executa a descoberta das linhas com a sobreposição das áreas dos buffers
+# (overlap, modo atual) e com o referenciamento linear (linear), e compara:
+# - Número de linhas encontradas, sublinha, sentido, posições inicial e final e a % de sobreposição final
+# - Tempo de execução de cada modo
+#
+# Nada é salvo no banco, o resultado (uma linha por linha encontrada no modo overlap ou linear) é salvo em CSV
+#
+# Parâmetros:
+# --data_baixar="YYYY-MM-DD" (Ex: --data_baixar="2025-02-27")
+# --vec_asset_id=ID_VEICULO_MIX (pode ser repetido) ou --num_veiculos=N (primeiros N veículos do veiculos_api)
+# --saida=arquivo.csv (opcional)
+###################################################################################
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Import de sistema
+import time
+
+# CLI
+import click
+
+# Imports básicos
+import numpy as np
+import pandas as pd
+
+# Análise (mesmas funções, constantes e cache de geometrias do subprocesso)
+import analise_combustivel_mix_subprocess as analise_veiculo
+from discover_bus_line import DiscoverBusLinesAlgorithm
+from vehicle_day_data import VehicleDayData
+
+###################################################################################
+# Funções
+###################################################################################
+
+
+# Descobre as linhas da trip com o modo informado, retorna as linhas e o tempo gasto (segundos)
+def descobre_linhas(discover_algorithm, df_gps_sort, df_comb_sort, geometrias_linhas, modo_descoberta):
+    inicio = time.perf_counter()
+
+    indice_linear = None
+    if modo_descoberta == analise_veiculo.MODO_LINEAR:
+        indice_linear = geometrias_linhas.get_indice_linear()
+
+    linhas_onibus = discover_algorithm.discover_bus_lines(
+        df_gps_sort,
+        df_comb_sort,
+        geometrias_linhas.gdf_linha_buffer,
+        geometrias_linhas.gdf_linhas_extremo_start_buffer,
+        geometrias_linhas.gdf_linhas_extremo_end_buffer,
+        analise_veiculo.TAMANHO_BUFFER_POSICAO_VEICULO,
+        analise_veiculo.THRESHOLD_OVERLAP,
+        analise_veiculo.TEMPO_MINIMO_VIAGEM_SEGUNDOS,
+        geometrias_linhas.indice_linhas,
+        indice_linear,
+    )
+
+    return linhas_onibus, time.perf_counter() - inicio
+
+
+def resume_linha(linha_onibus, prefixo):
+    if linha_onibus is None:
+        return {f"{prefixo}_{c}": None for c in ["sublinha", "sentido", "start_idx", "end_idx", "overlap_final"]}
+
+    return {
+        f"{prefixo}_sublinha": linha_onibus.numero_sublinha,
+        f"{prefixo}_sentido": linha_onibus.sentido_linha_overlap,
+        f"{prefixo}_start_idx": linha_onibus.start_idx,
+        f"{prefixo}_end_idx": linha_onibus.end_idx,
+        f"{prefixo}_overlap_final": linha_onibus.overlap_final,
+    }
+
+
+# Compara os dois modos em todas as trips do veículo no dia
+def compara_veiculo(row_veiculo, dia):
+    vec_num_id = row_veiculo["Description"]
+    vec_asset_id = row_veiculo["AssetId"]
+    vec_model = row_veiculo["Model"]
+
+    df_trips_dia_mix = analise_veiculo.get_trips_mix_dia(vec_asset_id, dia)
+    if df_trips_dia_mix.empty:
+        return []
+
+    geometrias_linhas = analise_veiculo.get_geometrias_linhas(df_trips_dia_mix["TripStart"].min())
+    dados_veiculo_dia = VehicleDayData(
+        analise_veiculo.pgDB,
+        vec_asset_id,
+        df_trips_dia_mix["TripStart"].min(),
+        df_trips_dia_mix["TripEnd"].max(),
+        tempo_buffer_gps=analise_veiculo.TEMPO_BUFFER,
+        tempo_buffer_combustivel=analise_veiculo.TEMPO_BUFFER,
+    )
+    discover_algorithm = DiscoverBusLinesAlgorithm(analise_veiculo.pgDB, False, vec_num_id, vec_asset_id, vec_model, dia)
+
+    resultados = []
+    for _, row_trip in df_trips_dia_mix.iterrows():
+        df_comb_sort = dados_veiculo_dia.get_combustivel(row_trip["TripStart"], row_trip["TripEnd"])
+        df_gps_sort = dados_veiculo_dia.get_posicoes_gps(row_trip["TripStart"], row_trip["TripEnd"])
+        if df_gps_sort.empty:
+            continue
+
+        try:
+            linhas_overlap, tempo_overlap = descobre_linhas(
+                discover_algorithm, df_gps_sort, df_comb_sort, geometrias_linhas, analise_veiculo.MODO_OVERLAP
+            )
+            linhas_linear, tempo_linear = descobre_linhas(
+                discover_algorithm, df_gps_sort, df_comb_sort, geometrias_linhas, analise_veiculo.MODO_LINEAR
+            )
+        except Exception as e:
+            print(f"Erro na trip {row_trip['TripId']}: {e}")
+            continue
+
+        # Linhas pareadas pela ordem em que foram encontradas na trip
+        for i in range(max(len(linhas_overlap), len(linhas_linear), 1)):
+            resultado = {
+                "vec_num_id": vec_num_id,
+                "vec_asset_id": vec_asset_id,
+                "trip_id": row_trip["TripId"],
+                "num_posicoes": len(df_gps_sort),
+                "linha_na_trip": i + 1,
+                "num_linhas_overlap": len(linhas_overlap),
+                "num_linhas_linear": len(linhas_linear),
+                "tempo_overlap_s": tempo_overlap,
+                "tempo_linear_s": tempo_linear,
+            }
+            resultado.update(resume_linha(linhas_overlap[i] if i < len(linhas_overlap) else None, "overlap"))
+            resultado.update(resume_linha(linhas_linear[i] if i < len(linhas_linear) else None, "linear"))
+            resultados.append(resultado)
+
+    return resultados
+
+
+def imprime_resumo(df):
+    df_trips = df.drop_duplicates(subset=["vec_asset_id", "trip_id"])
+    df_pares = df[df["overlap_sublinha"].notna() & df["linear_sublinha"].notna()]
+
+    print("-------------------------------------------------------------------------------------")
+    print("TRIPS COMPARADAS", len(df_trips))
+    print("MESMO NÚMERO DE LINHAS (%)", 100 * np.mean(df_trips["num_linhas_overlap"] == df_trips["num_linhas_linear"]))
+    print("LINHAS PAREADAS", len(df_pares), "DE", len(df))
+
+    if not df_pares.empty:
+        print("MESMA SUBLINHA (%)", 100 * np.mean(df_pares["overlap_sublinha"] == df_pares["linear_sublinha"]))
+        print("MESMO SENTIDO (%)", 100 * np.mean(df_pares["overlap_sentido"] == df_pares["linear_sentido"]))
+        print("DIFERENÇA MÉDIA START_IDX", (df_pares["overlap_start_idx"] - df_pares["linear_start_idx"]).abs().mean())
+        print("DIFERENÇA MÉDIA END_IDX", (df_pares["overlap_end_idx"] - df_pares["linear_end_idx"]).abs().mean())
+        print(
+            "DIFERENÇA MÉDIA OVERLAP FINAL (p.p.)",
+            (df_pares["overlap_overlap_final"] - df_pares["linear_overlap_final"]).abs().mean(),
+        )
+
+    tempo_overlap = df_trips["tempo_overlap_s"].sum()
+    tempo_linear = df_trips["tempo_linear_s"].sum()
+    print(f"TEMPO OVERLAP {tempo_overlap:.1f}s LINEAR {tempo_linear:.1f}s")
+    if tempo_linear > 0:
+        print(f"SPEEDUP {tempo_overlap / tempo_linear:.2f}x")
+
+
+@click.command()
+@click.option("--data_baixar", type=str, required=True, help="Data que será comparada")
+@click.option("--vec_asset_id", type=int, multiple=True, help="ID do veículo (pode ser repetido)")
+@click.option("--num_veiculos", type=int, default=10, help="Número de veículos, caso nenhum ID seja informado")
+@click.option("--saida", type=str, default="compara_modos_descoberta.csv", help="Arquivo CSV com o resultado")
+def main(data_baixar, vec_asset_id, num_veiculos, saida):
+    dia_str = pd.to_datetime(data_baixar).strftime("%Y-%m-%d")
+
+    if vec_asset_id:
+        ids = ", ".join(str(asset_id) for asset_id in vec_asset_id)
+        df_veiculos = analise_veiculo.pgDB.read_sql_safe(f'SELECT * FROM veiculos_api WHERE "AssetId" IN ({ids})')
+    else:
+        df_veiculos = analise_veiculo.pgDB.read_sql_safe(f"SELECT * FROM veiculos_api LIMIT {num_veiculos}")
+
+    resultados = []
+    for _, row_veiculo in df_veiculos.iterrows():
+        print(f"Comparando veículo {row_veiculo['Description']} ({row_veiculo['AssetId']})")
+        try:
+            resultados.extend(compara_veiculo(row_veiculo, dia_str))
+        except Exception as e:
+            print(f"Erro ao comparar veículo {row_veiculo['AssetId']}: {e}")
+
+    if not resultados:
+        print("NENHUMA TRIP COMPARADA")
+        return
+
+    df_resultados = pd.DataFrame(resultados)
+    df_resultados.to_csv(saida, index=False)
+    print("RESULTADO SALVO EM", saida)
+
+    imprime_resumo(df_resultados)
+
+
+if __name__ == "__main__":
+    main()
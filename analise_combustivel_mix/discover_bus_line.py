@@ -8,15 +8,28 @@
 ###################################################################################
 
 # Imports básicos
+import numpy as np
 import pandas as pd
 
 # Biblioteca espaciais
-import geopandas as gpd
-from shapely.ops import unary_union
+import shapely
+
+# Projeção das posições
+from projection import get_pontos_projetados
 
 # Classe com a estrutura da linha
 from bus_line_trip import BusLineInMixTrip
 
+# Índice espacial das linhas e trajetória bufferizada de forma incremental
+from line_index import BusLineSpatialIndex
+from trajectory_buffer import IncrementalTrajectoryBuffer
+
+# Trajetória por referenciamento linear (modo de descoberta "linear")
+from linear_referencing import LinearReferencingTrajectory
+
+# Afinamento da trajetória GPS
+from gps_thinning import afina_trajetoria, FRACAO_BUFFER_AFINAMENTO
+
 ###################################################################################
 # Constantes e variáveis globais
 ###################################################################################
@@ -52,90 +65,58 @@ class DiscoverBusLinesAlgorithm(object):
     ###################################################################################
 
     # Gera o shape a partir de um conjunto de posicoes
+    # As posições são projetadas com o Transformer reusado (ou vêm das colunas x/y já projetadas do dia)
     def gera_shape_posicoes(self, df_posicoes, tam_buffer_positions=TAMANHO_BUFFER_POSICAO_VEICULO):
-        geodf_positions = gpd.GeoDataFrame(
-            df_posicoes, geometry=gpd.points_from_xy(df_posicoes["Longitude"], df_posicoes["Latitude"])
-        )
+        pontos = get_pontos_projetados(df_posicoes)
 
-        # Reseta as coordenadas para facilitar o processamento
-        geodf_positions.set_crs(epsg=4326, inplace=True)
-        geodf_positions_buffer = geodf_positions.to_crs("EPSG:5641").copy()
-
-        # Gera o buffer
-        geodf_positions_buffer["geometry"] = geodf_positions_buffer.geometry.buffer(tam_buffer_positions)
-        geodf_positions_buffer.head()
+        # Gera o buffer (mesma resolução padrão do GeoSeries.buffer)
+        buffers = shapely.buffer(pontos, tam_buffer_positions, quad_segs=16)
 
         # Gera a geometria da união do buffer
-        geometria_trajetoria_veiculo_buffer = unary_union(geodf_positions_buffer.geometry)
+        geometria_trajetoria_veiculo_buffer = shapely.union_all(buffers)
 
         return geometria_trajetoria_veiculo_buffer
 
     # Calcula a sobreposição de uma trajetória com as linhas em análise
-    def calcula_overlap(self, geometria_trajetoria_veiculo_buffer, gdf_linhas_buffer):
-        # Lista para armazenar as porcentagens de sobreposição
-        overlap_percentages = []
-
-        gdf_linhas_buffer_veiculo = gdf_linhas_buffer.copy()
+    # Só as linhas candidatas da STRtree são intersectadas, as demais ficam com 0%
+    def calcula_overlap(self, geometria_trajetoria_veiculo_buffer, gdf_linhas_buffer, indice_linhas=None):
+        if indice_linhas is None:
+            indice_linhas = BusLineSpatialIndex(gdf_linhas_buffer)
 
-        # Loop explícito sobre as geometrias
-        for geom in gdf_linhas_buffer_veiculo["geometry"]:
-            try:
-                # Calcula a interseção entre a geometria da linha e o buffer
-                intersection = geom.intersection(geometria_trajetoria_veiculo_buffer)
-
-                # Verifica se a interseção é válida e calcula a porcentagem
-                if not intersection.is_empty:
-                    percentage = (intersection.area / geom.area) * 100
-                else:
-                    percentage = 0  # Sem interseção
-
-            except Exception as e:
-                # Lidar com erros possíveis
-                percentage = 0
-
-            # Armazena a porcentagem calculada
-            overlap_percentages.append(percentage)
+        overlap_percentages = indice_linhas.calcula_overlap_percentages(geometria_trajetoria_veiculo_buffer)
 
         # Adicionar a nova coluna com as porcentagens ao GeoDataFrame
-        gdf_linhas_buffer_veiculo["overlap_percentage"] = overlap_percentages
-        return gdf_linhas_buffer_veiculo
+        return gdf_linhas_buffer.assign(overlap_percentage=overlap_percentages)
 
     # Função auxiliar para obter o sentido da linha suspeita, bem como os buffer das posições extrema dela
     # Filtra as linhas suspeitas e retorna aquelas cuja posição inicial corresponde a posição inicial do GPS do veículo
+    # As posições [start_idx, end_idx] são avaliadas usando os buffers já calculados da trajetória
     def filtra_sentido(
         self,
-        df_gps_sort,
+        trajetoria,
+        start_idx,
+        end_idx,
         gdf_linha_buffer,
         gdf_linhas_extremo_start_buffer,
         gdf_linhas_extremo_end_buffer,
-        tamanho_buffer_posicao_veiculo=TAMANHO_BUFFER_POSICAO_VEICULO,
     ):
-        gdf_linha_buffer_filtrado = gdf_linha_buffer.copy()
-        gdf_linha_extremo_start_buffer_filtrado = gdf_linhas_extremo_start_buffer.copy()
-        gdf_linha_extremo_end_buffer_filtrado = gdf_linhas_extremo_end_buffer.copy()
+        # Os GeoDataFrames são apenas lidos/filtrados (podem vir do cache de geometrias), por isso não são copiados
+        gdf_linha_buffer_filtrado = gdf_linha_buffer
+        gdf_linha_extremo_start_buffer_filtrado = gdf_linhas_extremo_start_buffer
+        gdf_linha_extremo_end_buffer_filtrado = gdf_linhas_extremo_end_buffer
 
-        total_posicoes = len(df_gps_sort)
-
-        for i in range(0, total_posicoes):
-            df_gps_filtro_ponto = df_gps_sort.iloc[[i]]
-            buf_ponto = self.gera_shape_posicoes(
-                df_gps_filtro_ponto, tam_buffer_positions=tamanho_buffer_posicao_veiculo
+        for i in range(start_idx, end_idx + 1):
+            # Vamos fazer a intersecção na origem da linha
+            intersecta_start = pd.Series(
+                trajetoria.posicao_intersecta(i, gdf_linhas_extremo_start_buffer["start_point"].values),
+                index=gdf_linhas_extremo_start_buffer.index,
             )
 
-            # Vamos fazer a intersecção na origem da linha
-            intersection_start_lines = gdf_linhas_extremo_start_buffer["start_point"].intersection(buf_ponto)
-
-            # Verifica se as interseções são vazias e inverte o sinal para obter quando pelo menso uma teve intersecção
-            teve_overlap = not (intersection_start_lines.is_empty.all())
-
-            if teve_overlap:
-                gdf_linha_buffer_filtrado = gdf_linha_buffer[~intersection_start_lines.is_empty].copy()
-                gdf_linha_extremo_start_buffer_filtrado = gdf_linhas_extremo_start_buffer[
-                    ~intersection_start_lines.is_empty
-                ].copy()
-                gdf_linha_extremo_end_buffer_filtrado = gdf_linhas_extremo_end_buffer[
-                    ~intersection_start_lines.is_empty
-                ].copy()
+            # Verifica se pelo menos uma origem teve intersecção
+            if intersecta_start.any():
+                gdf_linha_buffer_filtrado = gdf_linha_buffer[intersecta_start]
+                gdf_linha_extremo_start_buffer_filtrado = gdf_linhas_extremo_start_buffer[intersecta_start]
+                gdf_linha_extremo_end_buffer_filtrado = gdf_linhas_extremo_end_buffer[intersecta_start]
                 break
 
         sentido = gdf_linha_buffer_filtrado["sentido"].values[0]
@@ -145,7 +126,7 @@ class DiscoverBusLinesAlgorithm(object):
             gdf_linha_extremo_start_buffer_filtrado,
             gdf_linha_extremo_end_buffer_filtrado,
         ]
-    
+
     # Retorna tempo da viagem em segundos
     def get_tempo_viagem_segundos(self, df_gps_sort, start_idx, end_idx):
         timestamp_inicio = pd.to_datetime(df_gps_sort.iloc[start_idx]["Timestamp"])
@@ -168,7 +149,10 @@ class DiscoverBusLinesAlgorithm(object):
         gdf_linhas_extremo_end_buffer,
         tamanho_buffer_posicao_veiculo=TAMANHO_BUFFER_POSICAO_VEICULO,
         threshold_overlap=THRESHOLD_OVERLAP,
-        tempo_min_viagem=TEMPO_MINIMO_VIAGEM_SEGUNDOS
+        tempo_min_viagem=TEMPO_MINIMO_VIAGEM_SEGUNDOS,
+        indice_linhas=None,
+        indice_linear=None,
+        afinar_trajetoria=True,
     ):
         # Linhas encontradas
         linhas_encontradas = []
@@ -180,27 +164,51 @@ class DiscoverBusLinesAlgorithm(object):
         init_search_idx = 0
         curr_idx = 0
 
+        # Afinamento: a descoberta usa apenas as posições mantidas (df_gps_afinado), sem paradas repetidas e
+        # posições muito próximas. idx_originais mapeia os índices de volta para df_gps_sort (resposta)
+        idx_originais = np.arange(len(df_gps_sort))
+        if afinar_trajetoria:
+            idx_originais = afina_trajetoria(df_gps_sort, tamanho_buffer_posicao_veiculo * FRACAO_BUFFER_AFINAMENTO)
+        df_gps_afinado = df_gps_sort.iloc[idx_originais]
+
         # Total de posições
-        total_posicoes = len(df_gps_sort)
+        total_posicoes = len(df_gps_afinado)
+
+        # Trajetória incremental: cada posição é projetada e bufferizada uma única vez
+        # O buffer da trajetória é o dobro do buffer usado para testar as posições individualmente
+        # O índice das linhas (indice_linhas) pode vir pronto do cache de geometrias
+        # Com o índice linear (indice_linear), a sobreposição é a cobertura ao longo do comprimento das linhas
+        if indice_linear is not None:
+            trajetoria = LinearReferencingTrajectory(
+                df_gps_afinado,
+                indice_linear,
+                tamanho_buffer_posicao_veiculo * 2,
+                tamanho_buffer_posicao_veiculo,
+            )
+        else:
+            trajetoria = IncrementalTrajectoryBuffer(
+                df_gps_afinado,
+                gdf_linha_buffer,
+                tamanho_buffer_posicao_veiculo * 2,
+                tamanho_buffer_posicao_veiculo,
+                indice_linhas,
+            )
 
         while curr_idx < total_posicoes:
-            # Filtra as posições para a busca, vamos gerar o shape e ver o ovelap
-            df_gps_filtro_raw = df_gps_sort.iloc[init_search_idx : curr_idx + 1]
-
-            buf_raw = self.gera_shape_posicoes(
-                df_gps_filtro_raw, tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2
-            )
-            df_overlap_raw = self.calcula_overlap(buf_raw, gdf_linha_buffer)
+            # Adiciona a posição atual na trajetória e vê o overlap
+            trajetoria.adiciona_posicao(curr_idx)
+            overlap_linhas = trajetoria.get_overlap_percentages()
 
             # Computa o maior ovelap
-            df_maior_overlap_linha = df_overlap_raw.sort_values("overlap_percentage", ascending=False).head(1)
+            idx_maior_overlap = int(np.argmax(overlap_linhas))
+            df_maior_overlap_linha = gdf_linha_buffer.iloc[[idx_maior_overlap]]
 
-            maior_overlap = df_overlap_raw["overlap_percentage"].max()
+            maior_overlap = overlap_linhas[idx_maior_overlap]
             maior_linha = df_maior_overlap_linha["numero"].values[0]
             maior_sublinha = df_maior_overlap_linha["numero_sublinha"].values[0]
 
             # Tempo em segundos da viagem
-            tempo_viagem_seg = self.get_tempo_viagem_segundos(df_gps_sort, init_search_idx, curr_idx)
+            tempo_viagem_seg = self.get_tempo_viagem_segundos(df_gps_afinado, init_search_idx, curr_idx)
             tempo_viagem_h = (tempo_viagem_seg / 60) / 60
 
             # Threshold overlap muda conforme o tamanho da linha
@@ -245,25 +253,12 @@ class DiscoverBusLinesAlgorithm(object):
                 # Limpa a linha e acha o ponto inicial (sem repetição)
                 # Isso é necessário pois o veículo pode ter ficado parado gerando posições repetidas (ex: no terminal)
                 # Usamos o ponto inicial para descobrir a hora que o veículo saiu e para cálculos de combustível
-                df_overlap_opt = None
-                j = curr_idx
-                for j in range(curr_idx, init_search_idx, -1):
-                    # Regera as posições, porém de forma contrária (do último ponto até o ponto inicial da busca)
-                    # Quando acharmos uma sobreposição, achamos o ponto inicial da linha
-                    df_gps_filtro_opt = df_gps_sort.iloc[j : curr_idx + 1]
-
-                    buf_opt = self.gera_shape_posicoes(
-                        df_gps_filtro_opt, tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2
-                    )
-                    df_overlap_opt = self.calcula_overlap(buf_opt, gdf_linha_buffer)
-
-                    if df_overlap_opt["overlap_percentage"].max() >= threshold_overlap:
-                        break
-
-                # Atualiza o ponteiro inicial da busca (caso tenha encontrado), senão utiliza o ponteiro inicial da busca
-                idx_start_linha = j
+                # O ponto inicial é o último índice (de trás para frente) em que o trecho até a posição atual
+                # ainda tem sobreposição, encontrado por busca galopante/binária sobre as uniões dos sufixos
+                # Caso não encontre, utiliza o ponteiro inicial da busca
+                idx_start_linha = trajetoria.encontra_inicio(init_search_idx, curr_idx, threshold_overlap)
                 start_idx = idx_start_linha
-                resposta.start_idx = start_idx
+                resposta.start_idx = int(idx_originais[start_idx])
 
                 # Agora que temos o começo, podemos delimitar o sentido da linha
                 gdf_linhas_candidatas = gdf_linha_buffer[gdf_linha_buffer["numero_sublinha"] == maior_sublinha]
@@ -273,7 +268,6 @@ class DiscoverBusLinesAlgorithm(object):
                 gdf_linhas_candidatas_extremo_end_buffer = gdf_linhas_extremo_end_buffer[
                     gdf_linhas_extremo_end_buffer["numero_sublinha"] == maior_sublinha
                 ]
-                df_posicoes_veiculo = df_gps_sort.iloc[start_idx : curr_idx + 1]
 
                 (
                     sentido,
@@ -281,7 +275,9 @@ class DiscoverBusLinesAlgorithm(object):
                     gdf_linha_detectada_extremo_start_buffer,
                     gdf_linha_detectada_extremo_end_buffer,
                 ) = self.filtra_sentido(
-                    df_posicoes_veiculo,
+                    trajetoria,
+                    start_idx,
+                    curr_idx,
                     gdf_linhas_candidatas,
                     gdf_linhas_candidatas_extremo_start_buffer,
                     gdf_linhas_candidatas_extremo_end_buffer,
@@ -293,22 +289,18 @@ class DiscoverBusLinesAlgorithm(object):
                 k = curr_idx
                 end_idx = curr_idx
 
+                extremos_linha_detectada = np.concatenate(
+                    [
+                        gdf_linha_detectada_extremo_start_buffer["start_point"].values,
+                        gdf_linha_detectada_extremo_end_buffer["end_point"].values,
+                    ]
+                )
+
                 teve_overlap_ponto_final = False
                 for k in range(curr_idx, total_posicoes):
-                    df_gps_filtro_ponto = df_gps_sort.iloc[[k]]
-                    buf_ponto = self.gera_shape_posicoes(
-                        df_gps_filtro_ponto, tam_buffer_positions=tamanho_buffer_posicao_veiculo
-                    )
-
-                    intersection_start = gdf_linha_detectada_extremo_start_buffer["start_point"].intersection(buf_ponto)
-                    intersection_end = gdf_linha_detectada_extremo_end_buffer["end_point"].intersection(buf_ponto)
+                    # Se acharmos uma sobreposição com algum extremo, achamos o ponto final da linha
+                    teve_overlap_ponto_final = trajetoria.posicao_intersecta(k, extremos_linha_detectada).any()
 
-                    # Verifica se as interseções são vazias e inverte o sinal
-                    teve_overlap_ponto_final = not (
-                        intersection_start.is_empty.all() and intersection_end.is_empty.all()
-                    )
-
-                    # Se acharmos uma sobreposição, achamos o ponto final da linha
                     if teve_overlap_ponto_final:
                         break
 
@@ -320,18 +312,15 @@ class DiscoverBusLinesAlgorithm(object):
                     end_idx = curr_idx
                     resposta.teve_overlap = False
 
-                resposta.end_idx = end_idx
+                resposta.end_idx = int(idx_originais[end_idx])
 
                 # % de sobreposição final
-                buf_final = self.gera_shape_posicoes(
-                    df_gps_sort.iloc[start_idx : end_idx + 1], tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2
-                )
-                df_overlap_final = self.calcula_overlap(buf_final, gdf_linha_detectada_buffer)[
-                    "overlap_percentage"
-                ].max()
+                df_overlap_final = trajetoria.calcula_overlap_intervalo(
+                    start_idx, end_idx, gdf_linha_buffer.index.get_indexer(gdf_linha_detectada_buffer.index)
+                ).max()
 
                 resposta.overlap_final = df_overlap_final
-                resposta.overlap_df = df_gps_sort.iloc[start_idx : end_idx + 1]
+                resposta.overlap_df = df_gps_sort.iloc[resposta.start_idx : resposta.end_idx + 1]
 
                 # Computa duração da viagem
                 resposta.computa_duracao_viagem()
@@ -343,5 +332,8 @@ class DiscoverBusLinesAlgorithm(object):
                 init_search_idx = end_idx + 1
                 curr_idx = end_idx + 1
 
+                # A busca recomeça, então a trajetória volta a ficar vazia
+                trajetoria.reinicia()
+
         # Retorna as linhas encontradas
         return linhas_encontradas
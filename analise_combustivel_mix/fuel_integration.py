@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Funções para integrar o combustível gasto a partir das leituras do evento tst_combs
+# - O evento acumula o combustível gasto a cada 5 minutos (300 segundos)
+# - As janelas parciais (primeira e última) são interpoladas pelo tempo da viagem dentro da janela
+# - Quando o contador reinicia (diferença <= 0), considera-se o próprio valor da leitura como o consumo da janela
+#
+# Todas as funções operam sobre vetores NumPy (timestamps em ns e valores), sem iterar linha a linha no pandas
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import numpy as np
+import pandas as pd
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Intervalo entre as leituras de combustível (em segundos)
+JANELA_COMBUSTIVEL_SEGUNDOS = 300
+
+# Fator de conversão ns -> s
+NS_POR_SEGUNDO = 1e9
+
+###################################################################################
+# Funções
+###################################################################################
+
+
+# Função que calcula o incremento de combustível entre cada par de leituras consecutivas (j, j + 1)
+# Regra do contador: se a diferença for positiva usa a diferença, senão o contador reiniciou e usa o valor da leitura
+def calcula_incrementos(valores):
+    valores = np.asarray(valores, dtype=np.float64)
+    diff = np.diff(valores)
+    return np.where(diff > 0, diff, valores[1:])
+
+
+# Função que calcula o combustível gasto entre ts_inicio_ns e ts_fim_ns
+# ts_ns e valores são as leituras (ordenadas) já filtradas para a viagem
+def calcula_combustivel(ts_ns, valores, ts_inicio_ns, ts_fim_ns, janela_segundos=JANELA_COMBUSTIVEL_SEGUNDOS):
+    total = calcula_combustivel_lote(
+        ts_ns,
+        valores,
+        np.array([0]),
+        np.array([len(valores)]),
+        np.array([ts_inicio_ns]),
+        np.array([ts_fim_ns]),
+        janela_segundos,
+    )
+    return float(total[0])
+
+
+# Função que calcula o combustível de várias viagens em uma única chamada
+# Cada viagem k usa as leituras ts_ns[idx_inicio[k]:idx_fim[k]] (leituras ordenadas do dia inteiro)
+# A parte do meio é obtida por soma de prefixos sobre os incrementos, sem laço por viagem
+def calcula_combustivel_lote(
+    ts_ns, valores, idx_inicio, idx_fim, ts_inicio_ns, ts_fim_ns, janela_segundos=JANELA_COMBUSTIVEL_SEGUNDOS
+):
+    ts_ns = np.asarray(ts_ns, dtype=np.int64)
+    valores = np.asarray(valores, dtype=np.float64)
+    idx_inicio = np.asarray(idx_inicio, dtype=np.int64)
+    idx_fim = np.asarray(idx_fim, dtype=np.int64)
+    ts_inicio_ns = np.asarray(ts_inicio_ns, dtype=np.int64)
+    ts_fim_ns = np.asarray(ts_fim_ns, dtype=np.int64)
+
+    total = np.zeros(len(idx_inicio))
+
+    # Com menos de duas leituras não é possível calcular (o cálculo é feito pela diferença entre leituras)
+    num_leituras = idx_fim - idx_inicio
+    validas = num_leituras >= 2
+    if not validas.any():
+        return total
+
+    a = idx_inicio[validas]
+    b = idx_fim[validas]
+    n = num_leituras[validas]
+
+    # Primeira parte (janela até o início da viagem)
+    # janela_segundos antes até o tempo inicial, para interpolar e pegar o combustível ponderado
+    primeira_segundos = janela_segundos - (ts_inicio_ns[validas] - ts_ns[a]) / NS_POR_SEGUNDO
+    primeira_comb = (valores[a + 1] - valores[a]) * primeira_segundos / janela_segundos
+
+    # Parte do meio: incrementos dos pares (i, i + 1) para i = 1 ... n - 3 (relativo ao início da viagem)
+    prefixo = np.concatenate([[0.0], np.cumsum(calcula_incrementos(valores))])
+    ini_meio = a + 1
+    fim_meio = np.maximum(a + n - 2, ini_meio)
+    meio_comb = prefixo[fim_meio] - prefixo[ini_meio]
+
+    # Última parte (fim da viagem até a última leitura)
+    ultima_segundos = janela_segundos - (ts_ns[b - 1] - ts_fim_ns[validas]) / NS_POR_SEGUNDO
+    ultima_comb = (valores[b - 1] - valores[b - 2]) * ultima_segundos / janela_segundos
+
+    total[validas] = primeira_comb + meio_comb + ultima_comb
+    return total
+
+
+# Função que calcula o combustível a partir do DataFrame filtrado (colunas StartDateTime e Value)
+# Mantém a interface usada pelos scripts de análise
+def calcula_combustivel_df(df_comb_filtered, timestamp_inicio, timestamp_final):
+    if df_comb_filtered.empty or len(df_comb_filtered) == 1:
+        return 0
+
+    ts_ns = para_ns(df_comb_filtered["StartDateTime"])
+    valores = df_comb_filtered["Value"].to_numpy(dtype=np.float64)
+
+    return calcula_combustivel(ts_ns, valores, para_ns(timestamp_inicio), para_ns(timestamp_final))
+
+
+# Função que converte timestamps (texto ISO, datetime ou Series) para ns (int64, UTC)
+def para_ns(timestamps):
+    if np.ndim(timestamps) == 0:
+        return pd.to_datetime(timestamps, utc=True).as_unit("ns").value
+
+    return pd.DatetimeIndex(pd.to_datetime(timestamps, utc=True)).as_unit("ns").asi8
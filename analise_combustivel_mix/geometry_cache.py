@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Cache (por processo) das geometrias das linhas de ônibus
+# - As geometrias são construídas uma única vez para cada snapshot do KML (conjunto de ids selecionados)
+# - Os buffers das linhas e dos pontos extremos ficam preparados (shapely.prepare) e são reusados apenas para leitura
+#   por todas as viagens e veículos processados no mesmo processo
+# - Opcionalmente, as geometrias já projetadas e bufferizadas são persistidas em disco (parquet + WKB), de forma que
+#   outros processos carregam o snapshot sem consultar o geojson nem refazer os buffers
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports de sistema
+import os
+import hashlib
+import tempfile
+
+# Imports básicos
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+
+# Biblioteca espaciais
+import geopandas as gpd
+import shapely
+
+# Índice espacial das linhas
+from line_index import BusLineSpatialIndex
+
+# Índice de referenciamento linear das linhas
+from linear_referencing import BusLineLinearIndex
+
+# Métricas das linhas (tamanho pré-calculado na ingestão do KML)
+from line_metrics import COLUNA_TAMANHO
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Número máximo de snapshots mantidos em memória (dias diferentes podem selecionar KMLs diferentes)
+MAX_SNAPSHOTS_CACHE = 4
+
+# Diretório do cache em disco
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache_geometrias"))
+
+# Versão do formato do cache em disco, deve ser incrementada sempre que a forma de construir as geometrias mudar
+VERSAO_CACHE_DISCO = 2
+
+# Colunas textuais grandes do KML que não são usadas após a criação da geometria
+COLUNAS_DESCARTADAS = ["geojsondata", "kmldata"]
+
+# Nome de cada GeoDataFrame persistido
+NOMES_GEOMETRIAS = ["linha_raw", "linha_buffer", "extremo_start_buffer", "extremo_end_buffer"]
+
+###################################################################################
+# Classes
+###################################################################################
+
+
+class BusLineGeometries(object):
+    # Construtor, por padrão
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, gdf_linha_raw, gdf_linha_buffer, gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer):
+        self.gdf_linha_raw = gdf_linha_raw.drop(columns=COLUNAS_DESCARTADAS, errors="ignore")   # Linhas (EPSG:4326)
+        self.gdf_linha_buffer = gdf_linha_buffer.drop(columns=COLUNAS_DESCARTADAS, errors="ignore")  # Buffer (EPSG:5641)
+        self.gdf_linhas_extremo_start_buffer = gdf_linhas_extremo_start_buffer  # Buffer do ponto inicial (EPSG:5641)
+        self.gdf_linhas_extremo_end_buffer = gdf_linhas_extremo_end_buffer      # Buffer do ponto final (EPSG:5641)
+
+        # Prepara as geometrias (in-place, os GeoDataFrames passam a referenciar as geometrias preparadas)
+        shapely.prepare(np.asarray(self.gdf_linha_buffer.geometry.values, dtype=object))
+        shapely.prepare(np.asarray(gdf_linhas_extremo_start_buffer["start_point"].values, dtype=object))
+        shapely.prepare(np.asarray(gdf_linhas_extremo_end_buffer["end_point"].values, dtype=object))
+
+        # Índice espacial das linhas
+        self.indice_linhas = BusLineSpatialIndex(self.gdf_linha_buffer)
+        self.indice_linear = None
+        self.tamanhos_linhas_metros = None
+    # fmt: on
+
+    # Índice de referenciamento linear das linhas (modo de descoberta "linear"), construído na primeira chamada
+    def get_indice_linear(self):
+        if self.indice_linear is None:
+            self.indice_linear = BusLineLinearIndex(self.gdf_linha_raw)
+        return self.indice_linear
+
+    # Tamanho (metros, UTM) de cada (numero_sublinha, sentido), agrupado na primeira chamada
+    # Os tamanhos de cada KML vêm da tabela derivada do KML (ou são calculados em get_linhas_kml)
+    def get_tamanhos_linhas_metros(self):
+        if self.tamanhos_linhas_metros is None:
+            self.tamanhos_linhas_metros = (
+                self.gdf_linha_raw.groupby(["numero_sublinha", "sentido"])[COLUNA_TAMANHO].sum().to_dict()
+            )
+        return self.tamanhos_linhas_metros
+
+    # Retorna os GeoDataFrames por nome (mesmos nomes de NOMES_GEOMETRIAS)
+    def get_gdfs(self):
+        return {
+            "linha_raw": self.gdf_linha_raw,
+            "linha_buffer": self.gdf_linha_buffer,
+            "extremo_start_buffer": self.gdf_linhas_extremo_start_buffer,
+            "extremo_end_buffer": self.gdf_linhas_extremo_end_buffer,
+        }
+
+
+class BusLineGeometryDiskCache(object):
+    def __init__(self, diretorio=CACHE_DIR, versao=VERSAO_CACHE_DISCO):
+        self.diretorio = diretorio
+        self.versao = versao
+
+    # Nome do arquivo para a chave (hash do snapshot, tamanhos de buffer e versão)
+    def get_caminho_arquivo(self, chave, nome_gdf):
+        hash_chave = hashlib.sha1(repr((self.versao, chave)).encode("utf-8")).hexdigest()
+        return os.path.join(self.diretorio, f"{hash_chave}_{nome_gdf}.parquet")
+
+    # Carrega as geometrias do disco, retorna None caso não existam (ou não seja possível lê-las)
+    def carrega(self, chave):
+        gdfs = {}
+        try:
+            for nome_gdf in NOMES_GEOMETRIAS:
+                caminho = self.get_caminho_arquivo(chave, nome_gdf)
+                if not os.path.exists(caminho):
+                    return None
+
+                gdfs[nome_gdf] = self.__wkb_para_gdf(pd.read_parquet(caminho, memory_map=True))
+        except Exception as e:
+            print(f"Erro ao ler o cache de geometrias em disco: {e}")
+            return None
+
+        return BusLineGeometries(
+            gdfs["linha_raw"], gdfs["linha_buffer"], gdfs["extremo_start_buffer"], gdfs["extremo_end_buffer"]
+        )
+
+    # Salva as geometrias no disco (escrita atômica, outros processos nunca leem um arquivo pela metade)
+    def salva(self, chave, geometrias):
+        try:
+            os.makedirs(self.diretorio, exist_ok=True)
+
+            for nome_gdf, gdf in geometrias.get_gdfs().items():
+                caminho = self.get_caminho_arquivo(chave, nome_gdf)
+                fd, caminho_tmp = tempfile.mkstemp(dir=self.diretorio, suffix=".tmp")
+                os.close(fd)
+
+                try:
+                    self.__gdf_para_wkb(gdf).to_parquet(caminho_tmp, index=False)
+                    os.replace(caminho_tmp, caminho)
+                finally:
+                    if os.path.exists(caminho_tmp):
+                        os.remove(caminho_tmp)
+        except Exception as e:
+            print(f"Erro ao salvar o cache de geometrias em disco: {e}")
+
+    # Converte todas as colunas de geometria para WKB, guardando qual é a geometria ativa e o seu CRS
+    def __gdf_para_wkb(self, gdf):
+        df = pd.DataFrame(gdf).copy()
+        for coluna in df.columns:
+            valores = np.asarray(df[coluna], dtype=object)
+            if len(valores) > 0 and shapely.is_geometry(valores).all():
+                df[coluna] = shapely.to_wkb(valores)
+
+        df["_geometria_ativa"] = gdf.geometry.name
+        df["_crs"] = gdf.crs.to_string() if gdf.crs is not None else None
+        return df
+
+    def __wkb_para_gdf(self, df):
+        geometria_ativa = df["_geometria_ativa"].iloc[0] if len(df) > 0 else "geometry"
+        crs = df["_crs"].iloc[0] if len(df) > 0 else None
+        df = df.drop(columns=["_geometria_ativa", "_crs"])
+
+        for coluna in df.columns:
+            if df[coluna].dtype == object and len(df) > 0 and isinstance(df[coluna].iloc[0], bytes):
+                df[coluna] = shapely.from_wkb(df[coluna].values)
+
+        return gpd.GeoDataFrame(df, geometry=geometria_ativa, crs=crs)
+
+
+class BusLineGeometryCache(object):
+    def __init__(self, max_snapshots=MAX_SNAPSHOTS_CACHE, cache_disco=None):
+        self.max_snapshots = max_snapshots
+        self.cache_disco = cache_disco
+        self.__geometrias = OrderedDict()
+
+    # Retorna as geometrias do snapshot, construindo-as (constroi_geometrias) apenas se não estiverem em memória nem
+    # no disco. A chave deve conter tudo que altera as geometrias (ids do snapshot e tamanhos de buffer)
+    def get_geometrias(self, chave_snapshot, constroi_geometrias):
+        if chave_snapshot in self.__geometrias:
+            self.__geometrias.move_to_end(chave_snapshot)
+            return self.__geometrias[chave_snapshot]
+
+        geometrias = None
+        if self.cache_disco is not None:
+            geometrias = self.cache_disco.carrega(chave_snapshot)
+
+        if geometrias is None:
+            geometrias = constroi_geometrias()
+
+            if self.cache_disco is not None:
+                self.cache_disco.salva(chave_snapshot, geometrias)
+
+        self.__geometrias[chave_snapshot] = geometrias
+
+        # Remove o snapshot usado há mais tempo
+        if len(self.__geometrias) > self.max_snapshots:
+            self.__geometrias.popitem(last=False)
+
+        return geometrias
+
+    def limpa(self):
+        self.__geometrias.clear()
+
+
+# Cache global do processo (com persistência em disco)
+CACHE_GEOMETRIAS_LINHAS = BusLineGeometryCache(cache_disco=BusLineGeometryDiskCache())
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Afinamento (thinning) da trajetória GPS antes da descoberta das linhas
+# - Em movimento, só é mantida a posição que está a pelo menos distancia_minima metros da última posição mantida
+# - Paradas (posições que ficam a menos de distancia_minima metros por pelo menos TEMPO_MINIMO_PARADA_SEGUNDOS, ex:
+#   garagem e terminais) viram apenas a primeira (chegada) e a última (saída) posição
+# - A primeira e a última posição da trajetória são sempre mantidas
+#
+# Retorna os índices posicionais das posições mantidas no DataFrame original, a descoberta trabalha nas posições
+# mantidas e os índices encontrados (start_idx, end_idx) são mapeados de volta para as posições e timestamps originais
+#
+# Cada pasta de análise possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import numpy as np
+import pandas as pd
+
+# Projeção das posições
+from projection import get_xy
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Distância mínima entre posições mantidas, em fração do buffer da posição do veículo
+# O buffer da trajetória é o dobro do buffer da posição, então as posições mantidas continuam se sobrepondo
+FRACAO_BUFFER_AFINAMENTO = 0.5
+
+# Tempo mínimo (segundos) parado para manter também a posição de saída da parada
+TEMPO_MINIMO_PARADA_SEGUNDOS = 60
+
+###################################################################################
+# Funções
+###################################################################################
+
+
+# Retorna os índices posicionais (np.array) das posições mantidas de df_gps_sort (ordenado pelo Timestamp)
+def afina_trajetoria(df_gps_sort, distancia_minima, tempo_minimo_parada=TEMPO_MINIMO_PARADA_SEGUNDOS):
+    total_posicoes = len(df_gps_sort)
+    if total_posicoes <= 2:
+        return np.arange(total_posicoes)
+
+    # Coordenadas métricas (EPSG:5641) e tempo em segundos
+    x, y = get_xy(df_gps_sort)
+    timestamps = pd.to_datetime(df_gps_sort["Timestamp"], utc=True)
+    segundos = (timestamps - timestamps.iloc[0]).dt.total_seconds().to_numpy()
+
+    distancia_minima_quadrado = distancia_minima**2
+
+    mantidos = [0]
+    ancora = 0
+    for i in range(1, total_posicoes):
+        if (x[i] - x[ancora]) ** 2 + (y[i] - y[ancora]) ** 2 < distancia_minima_quadrado:
+            continue
+
+        # Saiu do raio da última posição mantida, se ficou parado tempo suficiente mantém a posição de saída
+        if i - 1 != ancora and segundos[i - 1] - segundos[ancora] >= tempo_minimo_parada:
+            mantidos.append(i - 1)
+
+        mantidos.append(i)
+        ancora = i
+
+    if mantidos[-1] != total_posicoes - 1:
+        mantidos.append(total_posicoes - 1)
+
+    return np.asarray(mantidos)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Classe que indexa os buffers das linhas de ônibus em uma STRtree (shapely 2)
+# - Só as linhas cujo envelope toca a trajetória são intersectadas
+# - Interseção e área são calculadas de forma vetorizada para as linhas candidatas
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import numpy as np
+
+# Biblioteca espaciais
+import shapely
+from shapely.errors import GEOSException
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class BusLineSpatialIndex(object):
+    def __init__(self, gdf_linhas_buffer):
+        self.linhas = np.asarray(gdf_linhas_buffer.geometry.values, dtype=object)
+        self.area_linhas = shapely.area(self.linhas)
+        self.arvore = shapely.STRtree(self.linhas)
+
+    def __len__(self):
+        return len(self.linhas)
+
+    # Retorna os índices (posicionais) das linhas que intersectam a geometria
+    # O envelope é filtrado pela STRtree e o teste exato usa as linhas preparadas, quando houver
+    def get_linhas_candidatas(self, geometria):
+        idx_candidatas = self.arvore.query(geometria)
+        return idx_candidatas[shapely.intersects(self.linhas[idx_candidatas], geometria)]
+
+    # Calcula a área de interseção da geometria com cada linha (0 para as linhas descartadas pelo índice)
+    def calcula_areas_intersecao(self, geometria):
+        areas = np.zeros(len(self.linhas))
+
+        if geometria is None or geometria.is_empty:
+            return areas
+
+        idx_candidatas = self.get_linhas_candidatas(geometria)
+        if len(idx_candidatas) == 0:
+            return areas
+
+        areas[idx_candidatas] = self.__calcula_areas(self.linhas[idx_candidatas], geometria)
+        return areas
+
+    # Calcula a % de sobreposição da geometria com cada linha
+    def calcula_overlap_percentages(self, geometria):
+        return calcula_percentual_overlap(self.calcula_areas_intersecao(geometria), self.area_linhas)
+
+    def __calcula_areas(self, linhas, geometria):
+        try:
+            return shapely.area(shapely.intersection(linhas, geometria))
+        except GEOSException:
+            # Alguma geometria inválida, faz uma a uma e considera 0 nas que falharem (como na versão anterior)
+            areas = np.zeros(len(linhas))
+            for i, linha in enumerate(linhas):
+                try:
+                    areas[i] = linha.intersection(geometria).area
+                except GEOSException:
+                    areas[i] = 0
+            return areas
+
+
+# Função que converte as áreas de interseção em % da área de cada linha
+def calcula_percentual_overlap(area_intersecao, area_linhas):
+    percentual = np.zeros(len(area_linhas))
+    validas = area_linhas > 0
+    percentual[validas] = (area_intersecao[validas] / area_linhas[validas]) * 100
+    return percentual
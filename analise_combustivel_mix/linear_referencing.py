@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Descoberta das linhas por referenciamento linear (alternativa à sobreposição de áreas dos buffers)
+# - Cada posição GPS é projetada (line_locate_point) nas linhas que estão a até R metros dela (consulta dwithin
+#   na STRtree das linhas), uma única vez e de forma vetorizada para toda a viagem
+# - A posição cobre o trecho da linha dentro do círculo de raio R: [m - sqrt(R² - d²), m + sqrt(R² - d²)], onde m é a
+#   posição ao longo da linha e d a distância até ela (o mesmo trecho que o buffer da posição sobrepõe)
+# - A cobertura de uma linha é o comprimento da união dos trechos cobertos dividido pelo comprimento da linha,
+#   sem nenhuma operação entre polígonos
+#
+# LinearReferencingTrajectory tem a mesma interface de IncrementalTrajectoryBuffer e pode substituí-la em
+# DiscoverBusLinesAlgorithm.discover_bus_lines (modo de descoberta "linear")
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+# Biblioteca espaciais
+import shapely
+
+# Projeção das posições e geometrias métricas das linhas
+from projection import get_pontos_projetados
+from line_metrics import get_geometrias_metricas
+
+# Percentual de sobreposição e busca do ponto inicial
+from line_index import calcula_percentual_overlap
+from trajectory_buffer import busca_inicio_galopante
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Comprimento da união dos intervalos [inicios, fins] de cada linha (vetorizado)
+# Os intervalos são ordenados por (linha, início) e cada linha é deslocada para que os intervalos de linhas
+# diferentes nunca se sobreponham. Cada intervalo contribui com o trecho que passa do maior fim visto até ele
+def calcula_comprimento_uniao(idx_linhas, inicios, fins, num_linhas):
+    comprimento = np.zeros(num_linhas)
+    if len(idx_linhas) == 0:
+        return comprimento
+
+    ordem = np.lexsort((inicios, idx_linhas))
+    linhas = idx_linhas[ordem]
+    deslocamento = linhas * (fins.max() + 1)
+    inicios_ord = inicios[ordem] + deslocamento
+    fins_ord = fins[ordem] + deslocamento
+
+    fim_acumulado = np.maximum.accumulate(fins_ord)
+    fim_anterior = np.concatenate([[-np.inf], fim_acumulado[:-1]])
+    contribuicao = np.maximum(0, fim_acumulado - np.maximum(inicios_ord, fim_anterior))
+
+    comprimento += np.bincount(linhas, weights=contribuicao, minlength=num_linhas)
+    return comprimento
+
+
+###################################################################################
+# Classes
+###################################################################################
+
+
+class BusLineLinearIndex(object):
+    # Linhas (LineString/MultiLineString) projetadas para o sistema métrico e indexadas na STRtree
+    # A ordem das linhas é a mesma do GeoDataFrame (e do gdf_linha_buffer construído a partir dele)
+    def __init__(self, gdf_linhas_raw):
+        self.linhas = get_geometrias_metricas(gdf_linhas_raw)
+        self.comprimento_linhas = shapely.length(self.linhas)
+        self.arvore = shapely.STRtree(self.linhas)
+
+    def __len__(self):
+        return len(self.linhas)
+
+    # Projeta os pontos nas linhas que estão a até raio metros
+    # Retorna os pares (ponto, linha) ordenados pelo ponto, a posição ao longo da linha e a distância até ela
+    def referencia_pontos(self, pontos, raio):
+        idx_pontos, idx_linhas = self.arvore.query(pontos, predicate="dwithin", distance=raio)
+
+        ordem = np.argsort(idx_pontos, kind="stable")
+        idx_pontos = idx_pontos[ordem]
+        idx_linhas = idx_linhas[ordem]
+
+        posicoes = shapely.line_locate_point(self.linhas[idx_linhas], pontos[idx_pontos])
+        distancias = shapely.distance(self.linhas[idx_linhas], pontos[idx_pontos])
+
+        return idx_pontos, idx_linhas, posicoes, distancias
+
+
+class LinearReferencingTrajectory(object):
+    # Construtor, mesmos parâmetros de IncrementalTrajectoryBuffer (buffers viram raios)
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, df_gps_sort, indice_linear, tam_buffer_trajetoria, tam_buffer_ponto):
+        # Posições no sistema métrico (EPSG:5641), reusa as coordenadas já projetadas do dia (colunas x/y)
+        self.pontos = get_pontos_projetados(df_gps_sort)
+
+        self.indice_linear = indice_linear
+        self.num_linhas = len(indice_linear)
+        self.comprimento_linhas = indice_linear.comprimento_linhas
+        self.tam_buffer_ponto = tam_buffer_ponto
+
+        # Trechos cobertos por cada posição, pares (posição, linha) ordenados pela posição
+        idx_pontos, idx_linhas, posicoes, distancias = indice_linear.referencia_pontos(
+            self.pontos, tam_buffer_trajetoria
+        )
+        meia_corda = np.sqrt(np.maximum(tam_buffer_trajetoria**2 - distancias**2, 0))
+        comprimentos = self.comprimento_linhas[idx_linhas]
+
+        self.ref_linhas = idx_linhas                                                    # Linha do trecho
+        self.ref_inicios = np.clip(posicoes - meia_corda, 0, comprimentos)              # Início do trecho (m)
+        self.ref_fins = np.clip(posicoes + meia_corda, 0, comprimentos)                 # Fim do trecho (m)
+        self.limites = np.searchsorted(idx_pontos, np.arange(len(self.pontos) + 1))     # Trechos da posição i
+
+        # Estado incremental
+        self.intervalos = {}                                        # linha -> (inícios, fins) disjuntos e ordenados
+        self.comprimento_coberto = np.zeros(self.num_linhas)        # comprimento coberto de cada linha
+    # fmt: on
+
+    # Limpa os trechos cobertos, usado quando a busca recomeça a partir de outra posição
+    def reinicia(self):
+        self.intervalos = {}
+        self.comprimento_coberto = np.zeros(self.num_linhas)
+
+    # Adiciona os trechos cobertos pela posição idx
+    def adiciona_posicao(self, idx):
+        for k in range(self.limites[idx], self.limites[idx + 1]):
+            self.__insere_intervalo(int(self.ref_linhas[k]), self.ref_inicios[k], self.ref_fins[k])
+
+    # Retorna a % de cobertura de cada linha
+    def get_overlap_percentages(self):
+        return calcula_percentual_overlap(self.comprimento_coberto, self.comprimento_linhas)
+
+    # Calcula a % de cobertura de um intervalo fechado de posições [idx_inicio, idx_fim]
+    # Retorna todas as linhas ou apenas as informadas (índices posicionais), não altera o estado incremental
+    def calcula_overlap_intervalo(self, idx_inicio, idx_fim, idx_linhas=None):
+        trechos = slice(self.limites[idx_inicio], self.limites[idx_fim + 1])
+        comprimento = calcula_comprimento_uniao(
+            self.ref_linhas[trechos], self.ref_inicios[trechos], self.ref_fins[trechos], self.num_linhas
+        )
+        percentual = calcula_percentual_overlap(comprimento, self.comprimento_linhas)
+
+        if idx_linhas is None:
+            return percentual
+        return percentual[idx_linhas]
+
+    # Ponto inicial da linha, maior idx em (idx_inicio_busca, idx_fim] cujo trecho [idx, idx_fim] ainda tem
+    # cobertura >= threshold em alguma linha (busca galopante/binária, como em IncrementalTrajectoryBuffer)
+    def encontra_inicio(self, idx_inicio_busca, idx_fim, threshold):
+        if idx_fim <= idx_inicio_busca:
+            return idx_fim
+
+        def atinge(idx):
+            return self.calcula_overlap_intervalo(idx, idx_fim).max() >= threshold
+
+        return busca_inicio_galopante(atinge, idx_inicio_busca + 1, idx_fim)
+
+    # Retorna quais geometrias estão a até tam_buffer_ponto metros da posição idx
+    # (equivale a intersectar o buffer simples da posição)
+    def posicao_intersecta(self, idx, geometrias):
+        return shapely.dwithin(np.asarray(geometrias, dtype=object), self.pontos[idx], self.tam_buffer_ponto)
+
+    # Insere [inicio, fim] nos intervalos disjuntos da linha, juntando os que se sobrepõem
+    def __insere_intervalo(self, linha, inicio, fim):
+        inicios, fins = self.intervalos.setdefault(linha, ([], []))
+
+        i = bisect_left(fins, inicio)
+        j = bisect_right(inicios, fim)
+
+        removido = 0
+        if i < j:
+            inicio = min(inicio, inicios[i])
+            fim = max(fim, fins[j - 1])
+            removido = sum(fins[k] - inicios[k] for k in range(i, j))
+
+        inicios[i:j] = [inicio]
+        fins[i:j] = [fim]
+        self.comprimento_coberto[linha] += (fim - inicio) - removido
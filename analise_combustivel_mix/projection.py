@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Camada de projeção das coordenadas (pyproj)
+# - Os Transformers são criados uma única vez por processo (lru_cache) e reusados em todas as viagens
+# - As posições GPS são projetadas direto dos arrays de longitude/latitude (sem GeoDataFrame, set_crs e to_crs)
+# - As coordenadas projetadas podem ser guardadas no DataFrame (colunas x/y), as etapas seguintes as reutilizam
+#
+# Cada pasta de análise possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+from functools import lru_cache
+import numpy as np
+
+# Biblioteca espaciais
+import shapely
+from pyproj import Transformer
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Sistema das posições GPS e do KML
+CRS_GPS = "EPSG:4326"
+
+# Sistema métrico usado nos buffers e nas sobreposições
+CRS_METRICO = "EPSG:5641"
+
+# Sistema (UTM) usado para o tamanho das linhas
+CRS_UTM = "EPSG:31982"
+
+# Colunas com as coordenadas projetadas (CRS_METRICO)
+COLUNA_X = "x_metrico"
+COLUNA_Y = "y_metrico"
+
+###################################################################################
+# Funções
+###################################################################################
+
+
+# Transformer entre dois sistemas, criado uma única vez por processo
+# always_xy: (longitude, latitude), a mesma ordem usada pelo geopandas
+@lru_cache(maxsize=None)
+def get_transformer(crs_origem, crs_destino):
+    return Transformer.from_crs(crs_origem, crs_destino, always_xy=True)
+
+
+# Projeta arrays de longitude/latitude, retorna os arrays x, y
+def projeta_xy(longitudes, latitudes, crs_destino=CRS_METRICO):
+    transformer = get_transformer(CRS_GPS, crs_destino)
+    return transformer.transform(np.asarray(longitudes, dtype=float), np.asarray(latitudes, dtype=float))
+
+
+# Retorna uma cópia do DataFrame de posições com as colunas x/y projetadas (CRS_METRICO)
+def adiciona_xy(df_posicoes):
+    x, y = projeta_xy(df_posicoes["Longitude"].to_numpy(), df_posicoes["Latitude"].to_numpy())
+    return df_posicoes.assign(**{COLUNA_X: x, COLUNA_Y: y})
+
+
+# Coordenadas projetadas (CRS_METRICO) das posições, usa as colunas x/y quando já existem
+def get_xy(df_posicoes):
+    if COLUNA_X in df_posicoes.columns and COLUNA_Y in df_posicoes.columns:
+        return df_posicoes[COLUNA_X].to_numpy(), df_posicoes[COLUNA_Y].to_numpy()
+
+    return projeta_xy(df_posicoes["Longitude"].to_numpy(), df_posicoes["Latitude"].to_numpy())
+
+
+# Pontos (shapely) projetados das posições
+def get_pontos_projetados(df_posicoes):
+    x, y = get_xy(df_posicoes)
+    return shapely.points(x, y)
+
+
+# Projeta geometrias shapely (ex: linhas do KML) entre dois sistemas
+def projeta_geometrias(geometrias, crs_origem=CRS_GPS, crs_destino=CRS_METRICO):
+    transformer = get_transformer(crs_origem, crs_destino)
+
+    def transforma(coordenadas):
+        x, y = transformer.transform(coordenadas[:, 0], coordenadas[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(np.asarray(geometrias, dtype=object), transforma)
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Classe que acumula os resultados da análise em memória e os salva em lote
+# - A tabela é refletida (autoload) uma única vez
+# - Os registros são inseridos em um único INSERT com múltiplas linhas, mantendo o ON CONFLICT DO NOTHING
+#   nas colunas (dia, num_viagem, vec_asset_id)
+# - O lote é salvo quando atinge o tamanho máximo, quando o registro pendente mais antigo passa do tempo máximo
+#   ou quando flush() é chamado explicitamente (ex: fim da análise do veículo)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import time
+
+# Banco de Dados
+from sqlalchemy import Table, MetaData
+from sqlalchemy.dialects.postgresql import insert
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Colunas que identificam uma viagem (conflito)
+CHAVES_CONFLITO = ["dia", "num_viagem", "vec_asset_id"]
+
+# Número máximo de registros pendentes antes de salvar
+TAMANHO_MAXIMO_LOTE = 200
+
+# Tempo máximo (em segundos) que um registro fica pendente antes de salvar
+TEMPO_MAXIMO_PENDENTE_SEGUNDOS = 30
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class BufferedResultWriter(object):
+    # Construtor, por padrão
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(
+        self,
+        pgDB,
+        table_name,
+        chaves_conflito=CHAVES_CONFLITO,
+        tamanho_maximo_lote=TAMANHO_MAXIMO_LOTE,
+        tempo_maximo_pendente=TEMPO_MAXIMO_PENDENTE_SEGUNDOS,
+    ):
+        self.pgDB = pgDB
+        self.table_name = table_name
+        self.chaves_conflito = chaves_conflito              # Colunas do ON CONFLICT
+        self.tamanho_maximo_lote = tamanho_maximo_lote      # Salva ao atingir esse número de registros
+        self.tempo_maximo_pendente = tempo_maximo_pendente  # Salva se o registro mais antigo passar desse tempo
+
+        self.tabela = None                                  # Tabela refletida (carregada no primeiro flush)
+        self.registros = []                                 # Registros pendentes
+        self.inicio_pendente = None                         # Momento em que o primeiro registro pendente chegou
+    # fmt: on
+
+    # Adiciona um registro (dict com as colunas da tabela) e salva o lote se algum limite foi atingido
+    def adiciona(self, registro):
+        if not self.registros:
+            self.inicio_pendente = time.monotonic()
+
+        self.registros.append(registro)
+
+        if len(self.registros) >= self.tamanho_maximo_lote:
+            self.flush()
+        elif time.monotonic() - self.inicio_pendente >= self.tempo_maximo_pendente:
+            self.flush()
+
+    # Salva todos os registros pendentes
+    def flush(self):
+        if not self.registros:
+            return 0
+
+        registros = self.registros
+        self.registros = []
+        self.inicio_pendente = None
+
+        try:
+            self.__insere(registros)
+        except Exception as e:
+            # Caso o lote falhe, tenta salvar registro a registro para não perder os demais
+            print(f"Erro ao salvar lote de {len(registros)} registros em {self.table_name}: {e}")
+            for registro in registros:
+                try:
+                    self.__insere([registro])
+                except Exception as e:
+                    print(f"Erro ao salvar registro em {self.table_name}: {e}")
+
+        return len(registros)
+
+    def __get_tabela(self):
+        if self.tabela is None:
+            self.tabela = Table(self.table_name, MetaData(), autoload_with=self.pgDB.get_engine())
+
+        return self.tabela
+
+    def __insere(self, registros):
+        tabela = self.__get_tabela()
+
+        with self.pgDB.get_engine().begin() as conn:
+            stmt = insert(tabela).values(registros)
+            stmt = stmt.on_conflict_do_nothing(index_elements=self.chaves_conflito)
+            conn.execute(stmt)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Classe que mantém a trajetória bufferizada do veículo de forma incremental
+# - Cada posição GPS é projetada e bufferizada uma única vez
+# - A união dos buffers e a área de interseção com cada linha são atualizadas por deltas a cada nova posição
+# - O ponto inicial da linha é refinado por busca galopante/binária sobre as uniões dos sufixos da trajetória
+#
+# Cada pasta de análise possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import numpy as np
+
+# Biblioteca espaciais
+import shapely
+
+# Projeção das posições
+from projection import get_pontos_projetados
+
+# Índice espacial das linhas
+from line_index import BusLineSpatialIndex, calcula_percentual_overlap
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Mesma resolução padrão do GeoSeries.buffer, para manter as mesmas áreas da versão anterior
+RESOLUCAO_BUFFER = 16
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Retorna o maior índice idx em [idx_min, idx_max] com atinge(idx) verdadeiro
+# Supõe que atinge é monotônica (se vale para idx, vale para todos os índices menores)
+# Galopa a partir de idx_max (idx_max, idx_max - 1, idx_max - 3, idx_max - 7, ...) e refina com busca binária,
+# O(log N) chamadas de atinge. Se nenhum índice atinge, retorna idx_min (igual à varredura posição a posição)
+def busca_inicio_galopante(atinge, idx_min, idx_max):
+    if idx_max <= idx_min:
+        return idx_max
+
+    idx = idx_max
+    falha = idx_max + 1
+    passo = 1
+    while not atinge(idx):
+        falha = idx
+        if idx == idx_min:
+            return idx_min
+
+        idx = max(idx_min, idx - passo)
+        passo *= 2
+
+    # idx atinge e falha não, a resposta está em [idx, falha)
+    while falha - idx > 1:
+        meio = (idx + falha) // 2
+        if atinge(meio):
+            idx = meio
+        else:
+            falha = meio
+
+    return idx
+
+
+###################################################################################
+# Classes
+###################################################################################
+
+
+class SegmentUnionTree(object):
+    # Árvore de segmentos sobre os buffers das posições [idx_inicio, idx_fim]
+    # Cada nó guarda a união do seu intervalo (calculada sob demanda, uma única vez)
+    # A união de qualquer intervalo é a união de O(log N) nós
+    def __init__(self, geometrias, idx_inicio, idx_fim):
+        self.geometrias = geometrias
+        self.idx_inicio = idx_inicio
+        self.idx_fim = idx_fim
+        self.nos = {}
+
+    # União das geometrias do intervalo fechado [ini, fim]
+    def get_uniao(self, ini, fim):
+        partes = []
+        self.__coleta(1, self.idx_inicio, self.idx_fim, ini, fim, partes)
+
+        if len(partes) == 1:
+            return partes[0]
+        return shapely.union_all(partes)
+
+    def __coleta(self, no, no_ini, no_fim, ini, fim, partes):
+        if fim < no_ini or no_fim < ini:
+            return
+
+        if ini <= no_ini and no_fim <= fim:
+            partes.append(self.__get_no(no, no_ini, no_fim))
+            return
+
+        meio = (no_ini + no_fim) // 2
+        self.__coleta(2 * no, no_ini, meio, ini, fim, partes)
+        self.__coleta(2 * no + 1, meio + 1, no_fim, ini, fim, partes)
+
+    def __get_no(self, no, no_ini, no_fim):
+        if no not in self.nos:
+            if no_ini == no_fim:
+                self.nos[no] = self.geometrias[no_ini]
+            else:
+                meio = (no_ini + no_fim) // 2
+                self.nos[no] = shapely.union(
+                    self.__get_no(2 * no, no_ini, meio), self.__get_no(2 * no + 1, meio + 1, no_fim)
+                )
+
+        return self.nos[no]
+
+
+
+class IncrementalTrajectoryBuffer(object):
+    # Construtor, por padrão
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, df_gps_sort, gdf_linhas_buffer, tam_buffer_trajetoria, tam_buffer_ponto, indice_linhas=None):
+        # Posições no sistema métrico (EPSG:5641), reusa as coordenadas já projetadas do dia (colunas x/y)
+        self.pontos = get_pontos_projetados(df_gps_sort)
+
+        # Buffers das posições (calculados uma única vez)
+        self.buffers_trajetoria = shapely.buffer(self.pontos, tam_buffer_trajetoria, quad_segs=RESOLUCAO_BUFFER)
+        self.buffers_ponto = shapely.buffer(self.pontos, tam_buffer_ponto, quad_segs=RESOLUCAO_BUFFER)
+
+        # Linhas (já bufferizadas) que serão comparadas com a trajetória, indexadas na STRtree
+        if indice_linhas is None:
+            indice_linhas = BusLineSpatialIndex(gdf_linhas_buffer)
+        self.indice_linhas = indice_linhas
+        self.linhas = indice_linhas.linhas
+        self.area_linhas = indice_linhas.area_linhas
+
+        # Estado incremental
+        self.uniao = None                                   # união dos buffers das posições já adicionadas
+        self.area_intersecao = np.zeros(len(self.linhas))   # área de interseção da união com cada linha
+    # fmt: on
+
+    # Limpa a união, usado quando a busca recomeça a partir de outra posição
+    def reinicia(self):
+        self.uniao = None
+        self.area_intersecao = np.zeros(len(self.linhas))
+
+    # Adiciona a posição idx na união e atualiza a área de interseção com as linhas
+    # Só a parte nova do buffer (delta) é intersectada com as linhas
+    def adiciona_posicao(self, idx):
+        buffer_posicao = self.buffers_trajetoria[idx]
+
+        if self.uniao is None:
+            delta = buffer_posicao
+            self.uniao = buffer_posicao
+        else:
+            delta = shapely.difference(buffer_posicao, self.uniao)
+
+            # Posição já coberta pela união (ex: veículo parado), nada muda
+            if delta.is_empty:
+                return
+
+            self.uniao = shapely.union(self.uniao, buffer_posicao)
+
+        self.area_intersecao += self.indice_linhas.calcula_areas_intersecao(delta)
+
+    # Retorna a % de sobreposição da união atual com cada linha
+    def get_overlap_percentages(self):
+        return calcula_percentual_overlap(self.area_intersecao, self.area_linhas)
+
+    # Calcula a % de sobreposição de um intervalo fechado de posições [idx_inicio, idx_fim] com as linhas
+    # Retorna todas as linhas ou apenas as informadas (índices posicionais), não altera o estado incremental
+    def calcula_overlap_intervalo(self, idx_inicio, idx_fim, idx_linhas=None):
+        uniao_intervalo = shapely.union_all(self.buffers_trajetoria[idx_inicio : idx_fim + 1])
+
+        if idx_linhas is None:
+            return self.indice_linhas.calcula_overlap_percentages(uniao_intervalo)
+
+        linhas = self.linhas[idx_linhas]
+        area_intersecao = shapely.area(shapely.intersection(linhas, uniao_intervalo))
+        return calcula_percentual_overlap(area_intersecao, self.area_linhas[idx_linhas])
+
+    # Retorna o ponto inicial da linha: o maior idx em (idx_inicio_busca, idx_fim] cuja união das posições
+    # [idx, idx_fim] ainda tem overlap >= threshold com alguma linha
+    # Remover posições do início só diminui o overlap, então a busca galopante/binária dá a mesma resposta da
+    # varredura de trás para frente com O(log N) avaliações das linhas
+    # Não altera o estado incremental
+    def encontra_inicio(self, idx_inicio_busca, idx_fim, threshold):
+        if idx_fim <= idx_inicio_busca:
+            return idx_fim
+
+        unioes = SegmentUnionTree(self.buffers_trajetoria, idx_inicio_busca + 1, idx_fim)
+
+        def atinge(idx):
+            uniao_sufixo = unioes.get_uniao(idx, idx_fim)
+            return self.indice_linhas.calcula_overlap_percentages(uniao_sufixo).max() >= threshold
+
+        return busca_inicio_galopante(atinge, idx_inicio_busca + 1, idx_fim)
+
+    # Retorna quais geometrias intersectam o buffer simples da posição idx
+    def posicao_intersecta(self, idx, geometrias):
+        return shapely.intersects(np.asarray(geometrias, dtype=object), self.buffers_ponto[idx])
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Classe que pré-carrega (prefetch) as posições GPS e os dados de combustível de um veículo em um dia
+# - Uma única query para cada tabela (posicao_gps e tst_combs) cobrindo todas as trips do dia
+# - As tabelas são filtradas pela coluna de partição ts (timestamptz), usando a poda de partições e o índice
+#   ("AssetId", ts)
+# - Cada trip é recortada em memória com searchsorted sobre os timestamps ordenados
+# - As posições do dia são projetadas (EPSG:5641) uma única vez, as trips reutilizam as colunas x/y
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import numpy as np
+import pandas as pd
+
+# Projeção das posições
+from projection import adiciona_xy
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Formato das datas salvas pela Mix (ex: 2025-02-27T10:35:00Z)
+FORMATO_DATA_MIX = "%Y-%m-%dT%H:%M:%SZ"
+
+# Buffer de tempo em minutos
+TEMPO_BUFFER_GPS = 10
+TEMPO_BUFFER_COMBUSTIVEL = 10
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class VehicleDayData(object):
+    # Construtor, por padrão
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(
+        self,
+        pgDB,
+        vec_asset_id,
+        data_inicio,
+        data_fim,
+        tempo_buffer_gps=TEMPO_BUFFER_GPS,
+        tempo_buffer_combustivel=TEMPO_BUFFER_COMBUSTIVEL,
+    ):
+        self.pgDB = pgDB
+        self.vec_asset_id = vec_asset_id                            # ID do veículo na Mix
+        self.tempo_buffer_gps = tempo_buffer_gps                    # Buffer (min) antes/depois de cada trip (GPS)
+        self.tempo_buffer_combustivel = tempo_buffer_combustivel    # Buffer (min) antes/depois de cada trip (comb)
+
+        # Intervalo do dia (início da primeira trip até o fim da última)
+        self.data_inicio_dt = pd.to_datetime(data_inicio, utc=True)
+        self.data_fim_dt = pd.to_datetime(data_fim, utc=True)
+
+        # Dados do dia, ordenados, e seus timestamps em ns (int64)
+        self.df_gps_dia, self.ts_gps_dia = self.__carrega_posicoes_gps()
+        self.df_comb_dia, self.ts_comb_dia = self.__carrega_combustivel()
+    # fmt: on
+
+    # Retorna as posições GPS da trip (mesmo resultado de consultar o intervalo da trip com o buffer)
+    def get_posicoes_gps(self, data_trip_inicio, data_trip_final):
+        return self.__recorta(
+            self.df_gps_dia, self.ts_gps_dia, data_trip_inicio, data_trip_final, self.tempo_buffer_gps
+        )
+
+    # Retorna os dados de combustível da trip (mesmo resultado de consultar o intervalo da trip com o buffer)
+    def get_combustivel(self, data_trip_inicio, data_trip_final):
+        return self.__recorta(
+            self.df_comb_dia, self.ts_comb_dia, data_trip_inicio, data_trip_final, self.tempo_buffer_combustivel
+        )
+
+    # Recorta o intervalo [inicio - buffer, fim + buffer] (fechado, como o BETWEEN) dos dados ordenados
+    def __recorta(self, df_dia, ts_dia, data_trip_inicio, data_trip_final, tempo_buffer):
+        inicio_ns = self.__para_ns(pd.to_datetime(data_trip_inicio, utc=True) - pd.Timedelta(minutes=tempo_buffer))
+        fim_ns = self.__para_ns(pd.to_datetime(data_trip_final, utc=True) + pd.Timedelta(minutes=tempo_buffer))
+
+        idx_inicio = np.searchsorted(ts_dia, inicio_ns, side="left")
+        idx_fim = np.searchsorted(ts_dia, fim_ns, side="right")
+
+        return df_dia.iloc[idx_inicio:idx_fim]
+
+    # Intervalo (texto ISO) da query do dia, com o buffer
+    def __get_intervalo_query(self, tempo_buffer):
+        inicio = self.data_inicio_dt - pd.Timedelta(minutes=tempo_buffer)
+        fim = self.data_fim_dt + pd.Timedelta(minutes=tempo_buffer)
+
+        return inicio.strftime(FORMATO_DATA_MIX), fim.strftime(FORMATO_DATA_MIX)
+
+    def __carrega_posicoes_gps(self):
+        inicio_str, fim_str = self.__get_intervalo_query(self.tempo_buffer_gps)
+
+        query_gps = f"""
+        SELECT
+            *
+        FROM
+            posicao_gps pg
+        WHERE
+            pg."AssetId" = '{self.vec_asset_id}'
+            AND pg.ts >= '{inicio_str}'::TIMESTAMPTZ
+            AND pg.ts <= '{fim_str}'::TIMESTAMPTZ
+        """
+        df_gps = self.pgDB.read_sql_safe(query_gps)
+        df_gps_sort, ts_gps_sort = self.__ordena(df_gps, "Timestamp")
+
+        return adiciona_xy(df_gps_sort), ts_gps_sort
+
+    def __carrega_combustivel(self):
+        inicio_str, fim_str = self.__get_intervalo_query(self.tempo_buffer_combustivel)
+
+        query_combustivel = f"""
+        SELECT
+            *
+        FROM
+            tst_combs tc
+        WHERE
+            tc."AssetId" = {self.vec_asset_id}
+            AND tc.ts >= '{inicio_str}'::TIMESTAMPTZ
+            AND tc.ts <= '{fim_str}'::TIMESTAMPTZ
+        """
+        df_comb = self.pgDB.read_sql_safe(query_combustivel)
+
+        return self.__ordena(df_comb, "StartDateTime")
+
+    # Ordena pelo timestamp e retorna também o vetor de timestamps em ns para o searchsorted
+    def __ordena(self, df, coluna_timestamp):
+        df_sort = df.sort_values(coluna_timestamp, kind="stable")
+        ts_sort = pd.DatetimeIndex(pd.to_datetime(df_sort[coluna_timestamp], utc=True)).as_unit("ns").asi8
+
+        return df_sort, ts_sort
+
+    def __para_ns(self, timestamp):
+        return timestamp.as_unit("ns").value
@@ -0,0 +1,29 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Módulo pré-carregado pelo forkserver do pool de workers (ver analise_combustivel_mix_main.cria_executor)
+# - Importa o módulo de análise e carrega o histórico de km/l (INDICE_BASELINE) uma única vez por execução
+# - Os workers partem do forkserver e herdam o índice já carregado, inclusive os workers que substituem os reciclados
+#   por max_tasks_per_child, sem reler a tabela rmtc_viagens_analise_mix
+# - As viagens do dia em processamento continuam sendo relidas periodicamente por cada worker (FuelBaselineIndex)
+# - Se a carga falhar, cada worker carrega o índice sob demanda (mesmo comportamento da execução isolada)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Análise de um veículo
+import analise_combustivel_mix_subprocess as analise_veiculo
+
+###################################################################################
+# Carga
+###################################################################################
+
+try:
+    analise_veiculo.INDICE_BASELINE.carrega()
+    print("Histórico de km/l carregado no forkserver", len(analise_veiculo.INDICE_BASELINE.grupos), "grupos")
+except Exception as e:
+    print(f"Erro ao carregar o histórico de km/l no forkserver: {e}")
+finally:
+    # O forkserver não usa mais as conexões, os workers abrem as suas
+    analise_veiculo.pg_engine.dispose()
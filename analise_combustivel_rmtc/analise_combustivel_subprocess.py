@@ -8,6 +8,7 @@
 # Import de sistema
 import gc
 import os
+import time
 
 # Click
 import click
@@ -22,10 +23,34 @@ from datetime import datetime, timedelta
 
 # Biblioteca espaciais
 import geopandas as gpd
-from shapely.geometry import Point
-from shapely.ops import unary_union
+import shapely
 from shapely.geometry import shape, MultiLineString, MultiPolygon
 
+# Índice espacial das linhas
+from line_index import BusLineSpatialIndex
+
+# Busca galopante/binária do início da linha na trajetória
+from trajectory_buffer import busca_inicio_galopante
+
+# Afinamento da trajetória GPS
+from gps_thinning import afina_trajetoria, FRACAO_BUFFER_AFINAMENTO
+
+# Projeção das posições e dos pontos extremos (Transformers reusados)
+from projection import adiciona_xy, get_pontos_projetados, projeta_xy, CRS_METRICO
+
+# Métricas das linhas pré-calculadas na ingestão do KML (tamanho, extremos e geometria métrica)
+from line_metrics import (
+    TABELA_KML_DERIVADO,
+    ORIGENS_KML,
+    COLUNA_TAMANHO,
+    COLUNA_GEOMETRIA_METRICA,
+    completa_metricas_linhas,
+    get_geometrias_metricas,
+)
+
+# Integração do combustível
+from fuel_integration import calcula_combustivel_df
+
 # Banco de Dados
 from sqlalchemy import create_engine, text
 from sqlalchemy import Table, MetaData
@@ -68,31 +93,43 @@ TEMPO_BUFFER = 10
 # % de sobreposição para considerar como rota
 THRESHOLD_OVERLAP = 90
 
+
+# Exceção levantada quando o prazo do veículo (timeout dos workers do main) se esgota
+# O prazo só é verificado entre as viagens, nunca no meio de uma escrita no banco
+# Herda de BaseException para não ser capturada pelos "except Exception" do processamento do veículo
+class TimeoutVeiculo(BaseException):
+    pass
+
+
+# Levanta TimeoutVeiculo se o prazo (time.monotonic) já passou
+def verifica_prazo(prazo):
+    if prazo is not None and time.monotonic() > prazo:
+        raise TimeoutVeiculo()
+
 ###################################################################################
 # Etapa de Leitura de Dados
 # --> Funções auxiliares
 ###################################################################################
 
 
-# Função que verifica se uma determinada viagem já foi processada
-def verifica_viagem_processada(dia, vec_num_id, num_viagem):
+# Função que retorna o conjunto de viagens (num_viagem) já processadas do veículo no dia
+def get_viagens_processadas(dia, vec_num_id):
     """
-    Função que verifica se uma determinada viagem já foi processada
+    Função que retorna o conjunto de viagens (num_viagem) já processadas do veículo no dia
     """
     query = f"""
     SELECT 
-        *
+        num_viagem
     FROM 
         rmtc_viagens_analise
     WHERE 
         dia = '{dia}'
         AND vec_num_id = '{vec_num_id}'
-        AND num_viagem = {num_viagem}
     """
 
-    df_viagem = pd.read_sql(query, pg_engine)
+    df_viagens = pd.read_sql(query, pg_engine)
 
-    return not df_viagem.empty
+    return set(df_viagens["num_viagem"].astype(int))
 
 
 # Função que retorna as viagens de um veículo em um determinado dia
@@ -161,20 +198,41 @@ def parse_geojson(geojson_str):
         return geometries  # Retorna uma lista com os tipos mistos
 
 
+# Verifica se a tabela com as métricas derivadas do KML já existe (criada pela ingestão do KML)
+def existe_kml_derivado():
+    df_existe = pd.read_sql(f"SELECT to_regclass('{TABELA_KML_DERIVADO}') IS NOT NULL AS existe", pg_engine)
+    return bool(df_existe["existe"].iloc[0])
+
+
 # Função para obter o KML da linha
 def get_linha_kml(linha, rmtc_timestamp_inicio, tabela_kml="rmtc_kml_via_ra"):
     """
-    Função que retorna o KML da linha (geopanadas)
+    Função que retorna o KML da linha (geopanadas), com as métricas derivadas (tamanho, extremos e geometria
+    métrica) salvas na ingestão do KML ou, na falta delas, calculadas a partir do GeoJSON
     """
+    # Métricas pré-calculadas
+    colunas_derivadas = ""
+    join_derivado = ""
+    if existe_kml_derivado():
+        colunas_derivadas = """,
+        d.tamanho_m,
+        d.start_longitude,
+        d.start_latitude,
+        d.end_longitude,
+        d.end_latitude,
+        d.geometria_metrica_wkb"""
+        join_derivado = f"""
+    LEFT JOIN {TABELA_KML_DERIVADO} d ON d.origem = '{ORIGENS_KML[tabela_kml]}' AND d.id_kml = k.id"""
+
     # Query
     query_linha = f"""
     SELECT 
-        *
+        k.*{colunas_derivadas}
     FROM 
-        {tabela_kml}
+        {tabela_kml} k{join_derivado}
     WHERE 
-        numero = '{linha}'
-    ORDER BY ABS(EXTRACT(EPOCH FROM (diahorario::timestamptz  - '{rmtc_timestamp_inicio}'::timestamptz)))
+        k.numero = '{linha}'
+    ORDER BY ABS(EXTRACT(EPOCH FROM (k.diahorario::timestamptz  - '{rmtc_timestamp_inicio}'::timestamptz)))
     LIMIT 2;
     """
 
@@ -189,61 +247,63 @@ def get_linha_kml(linha, rmtc_timestamp_inicio, tabela_kml="rmtc_kml_via_ra"):
     # Cria o GeoDF
     gdf_linha_raw = gpd.GeoDataFrame(df_linha_raw, geometry="geometry", crs="EPSG:4326")  # WGS84 CRS
 
-    return gdf_linha_raw
+    # Completa as métricas das linhas que ainda não estão na tabela derivada
+    return completa_metricas_linhas(gdf_linha_raw)
 
 
 # Função principal para obter linha com buffer
 def get_linha_buffer_gdf(linhagdf, tamanho_buffer_linha=TAMANHO_BUFFER_LINHA):
-    gdf_linha_buffer = linhagdf.copy()
+    # Geometrias já projetadas para 5641 (tabela derivada do KML)
+    geometrias_metricas = get_geometrias_metricas(linhagdf)
+
+    # Aplica buffer (mesma resolução padrão do GeoSeries.buffer)
+    gdf_linha_buffer = gpd.GeoDataFrame(
+        linhagdf.drop(columns=["geometry", COLUNA_GEOMETRIA_METRICA], errors="ignore"),
+        geometry=shapely.buffer(geometrias_metricas, tamanho_buffer_linha, quad_segs=16),
+        crs=CRS_METRICO,
+    )
 
-    # Converte para 5641
-    gdf_linha_buffer = gdf_linha_buffer.to_crs("EPSG:5641")
+    return gdf_linha_buffer
 
-    # Aplica buffer
-    gdf_linha_buffer["geometry"] = gdf_linha_buffer["geometry"].buffer(tamanho_buffer_linha)
 
-    return gdf_linha_buffer
+# Buffer (5641) dos pontos extremos a partir das coordenadas (longitude/latitude)
+def get_buffer_extremos(longitudes, latitudes, tamanho_buffer_pontos):
+    x, y = projeta_xy(longitudes, latitudes)
+    return shapely.buffer(shapely.points(x, y), tamanho_buffer_pontos, quad_segs=16)
 
 
 # Função para obter os pontos extremos da linha
+# Os extremos (primeiro e último ponto) vêm da tabela derivada do KML (ou são calculados em get_linha_kml)
 def get_pontos_extremos_buffers_gdf(linhagdf, tamanho_buffer_pontos=TAMANHO_BUFFER_PONTOS_EXTREMOS):
-    # Extraí o primeiro e último ponto de cada linha
-    extremes = []
-    for idx, row in linhagdf.iterrows():
-        line = row["geometry"]
-        if not line.is_empty:
-            start_point = line.coords[0]  # Primeiro Ponto
-            end_point = line.coords[-1]  # Último Ponto
-            extremes.append(
-                {
-                    "numero": row["numero"],
-                    "sentido": row["sentido"],
-                    "start_point": Point(start_point),
-                    "START_LATITUDE": start_point[1],
-                    "START_LONGITUDE": start_point[0],
-                    "end_point": Point(end_point),
-                    "END_LATITUDE": end_point[1],
-                    "END_LONGITUDE": end_point[0],
-                }
-            )
+    # Descarta as linhas vazias (sem extremos)
+    colunas = ["numero", "sentido", "START_LATITUDE", "START_LONGITUDE", "END_LATITUDE", "END_LONGITUDE"]
+    df_extremos = pd.DataFrame(linhagdf.loc[linhagdf["START_LONGITUDE"].notna(), colunas]).reset_index(drop=True)
 
-    gdf_linhas_extremo_start = gpd.GeoDataFrame(extremes, geometry="start_point")
-    gdf_linhas_extremo_start.set_crs(epsg=4326, inplace=True)
-
-    gdf_linhas_extremo_end = gpd.GeoDataFrame(extremes, geometry="end_point")
-    gdf_linhas_extremo_end.set_crs(epsg=4326, inplace=True)
+    # Pontos (EPSG:4326)
+    pontos_inicio = shapely.points(df_extremos["START_LONGITUDE"], df_extremos["START_LATITUDE"])
+    pontos_fim = shapely.points(df_extremos["END_LONGITUDE"], df_extremos["END_LATITUDE"])
 
     # Cria os buffers
-    gdf_linhas_extremo_start_buffer = gdf_linhas_extremo_start.copy()
-    gdf_linhas_extremo_start_buffer = gdf_linhas_extremo_start_buffer.to_crs("EPSG:5641")
-    gdf_linhas_extremo_start_buffer["start_point"] = gdf_linhas_extremo_start_buffer.geometry.buffer(
-        TAMANHO_BUFFER_PONTOS_EXTREMOS
+    gdf_linhas_extremo_start_buffer = gpd.GeoDataFrame(
+        df_extremos.assign(
+            start_point=get_buffer_extremos(
+                df_extremos["START_LONGITUDE"], df_extremos["START_LATITUDE"], tamanho_buffer_pontos
+            ),
+            end_point=pontos_fim,
+        ),
+        geometry="start_point",
+        crs=CRS_METRICO,
     )
 
-    gdf_linhas_extremo_end_buffer = gdf_linhas_extremo_end.copy()
-    gdf_linhas_extremo_end_buffer = gdf_linhas_extremo_end_buffer.to_crs("EPSG:5641")
-    gdf_linhas_extremo_end_buffer["end_point"] = gdf_linhas_extremo_end_buffer.geometry.buffer(
-        TAMANHO_BUFFER_PONTOS_EXTREMOS
+    gdf_linhas_extremo_end_buffer = gpd.GeoDataFrame(
+        df_extremos.assign(
+            start_point=pontos_inicio,
+            end_point=get_buffer_extremos(
+                df_extremos["END_LONGITUDE"], df_extremos["END_LATITUDE"], tamanho_buffer_pontos
+            ),
+        ),
+        geometry="end_point",
+        crs=CRS_METRICO,
     )
 
     return gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer
@@ -272,7 +332,7 @@ def get_combustivel(asset_id, data_trip_inicio, data_trip_final, tempo_buffer=TE
     WHERE 
         tc."AssetId" = '{asset_id}'
         AND
-        CAST(tc."StartDateTime" AS TIMESTAMPTZ) BETWEEN '{inicio_str}'::TIMESTAMPTZ AND '{fim_str}'::TIMESTAMPTZ
+        tc.ts BETWEEN '{inicio_str}'::TIMESTAMPTZ AND '{fim_str}'::TIMESTAMPTZ
     """
 
     df_comb = pd.read_sql(query_combustivel, pg_engine)
@@ -303,13 +363,14 @@ def get_posicoes_gps(asset_id, data_trip_inicio, data_trip_final):
     WHERE 
         pg."AssetId" = '{asset_id}'
         AND
-        CAST(pg."Timestamp" AS TIMESTAMPTZ) BETWEEN '{inicio_str}'::TIMESTAMPTZ AND '{fim_str}'::TIMESTAMPTZ
+        pg.ts BETWEEN '{inicio_str}'::TIMESTAMPTZ AND '{fim_str}'::TIMESTAMPTZ
     """
 
     df_gps = pd.read_sql(query_gps, pg_engine)
     df_gps_sort = df_gps.sort_values("Timestamp")
 
-    return df_gps_sort
+    # Projeta as posições (EPSG:5641) uma única vez, as etapas seguintes reutilizam as colunas x/y
+    return adiciona_xy(df_gps_sort)
 
 
 # Função auxiliar para obter o sentido da linha suspeita
@@ -364,54 +425,29 @@ def filtra_sentido(
 
 
 # Gera o shape a partir de um conjunto de posicoes
+# As posições são projetadas com o Transformer reusado (ou vêm das colunas x/y já projetadas)
 def gera_shape_posicoes(df_posicoes, tam_buffer_positions=TAMANHO_BUFFER_POSICAO_VEICULO):
-    geodf_positions = gpd.GeoDataFrame(
-        df_posicoes, geometry=gpd.points_from_xy(df_posicoes["Longitude"], df_posicoes["Latitude"])
-    )
-
-    # Reseta as coordenadas para facilitar o processamento
-    geodf_positions.set_crs(epsg=4326, inplace=True)
-    geodf_positions_buffer = geodf_positions.to_crs("EPSG:5641").copy()
+    pontos = get_pontos_projetados(df_posicoes)
 
-    # Gera o buffer
-    geodf_positions_buffer["geometry"] = geodf_positions_buffer.geometry.buffer(tam_buffer_positions)
-    geodf_positions_buffer.head()
+    # Gera o buffer (mesma resolução padrão do GeoSeries.buffer)
+    buffers = shapely.buffer(pontos, tam_buffer_positions, quad_segs=16)
 
     # Gera a geometria da união do buffer
-    geometria_trajetoria_veiculo_buffer = unary_union(geodf_positions_buffer.geometry)
+    geometria_trajetoria_veiculo_buffer = shapely.union_all(buffers)
 
     return geometria_trajetoria_veiculo_buffer
 
 
 # Calcula a sobreposição de uma trajetória com as linhas em análise
-def calcula_overlap(geometria_trajetoria_veiculo_buffer, gdf_linhas_buffer):
-    # Lista para armazenar as porcentagens de sobreposição
-    overlap_percentages = []
-
-    gdf_linhas_buffer_veiculo = gdf_linhas_buffer.copy()
-
-    # Loop explícito sobre as geometrias
-    for geom in gdf_linhas_buffer_veiculo["geometry"]:
-        try:
-            # Calcula a interseção entre a geometria da linha e o buffer
-            intersection = geom.intersection(geometria_trajetoria_veiculo_buffer)
-
-            # Verifica se a interseção é válida e calcula a porcentagem
-            if not intersection.is_empty:
-                percentage = (intersection.area / geom.area) * 100
-            else:
-                percentage = 0  # Sem interseção
-
-        except Exception as e:
-            # Lidar com erros possíveis
-            percentage = 0
+# Só as linhas candidatas da STRtree são intersectadas, as demais ficam com 0%
+def calcula_overlap(geometria_trajetoria_veiculo_buffer, gdf_linhas_buffer, indice_linhas=None):
+    if indice_linhas is None:
+        indice_linhas = BusLineSpatialIndex(gdf_linhas_buffer)
 
-        # Armazena a porcentagem calculada
-        overlap_percentages.append(percentage)
+    overlap_percentages = indice_linhas.calcula_overlap_percentages(geometria_trajetoria_veiculo_buffer)
 
     # Adicionar a nova coluna com as porcentagens ao GeoDataFrame
-    gdf_linhas_buffer_veiculo["overlap_percentage"] = overlap_percentages
-    return gdf_linhas_buffer_veiculo
+    return gdf_linhas_buffer.assign(overlap_percentage=overlap_percentages)
 
 
 ###################################################################################
@@ -449,11 +485,14 @@ def discover_bus_line(
     curr_idx = 0
     total_posicoes = len(df_gps_sort)
 
+    # Índice das linhas construído uma única vez para a viagem
+    indice_linhas = BusLineSpatialIndex(gdf_linha_buffer)
+
     while curr_idx < total_posicoes:
         df_gps_filtro_raw = df_gps_sort.iloc[search_idx : curr_idx + 1]
 
         buf_raw = gera_shape_posicoes(df_gps_filtro_raw, tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2)
-        df_overlap_raw = calcula_overlap(buf_raw, gdf_linha_buffer)
+        df_overlap_raw = calcula_overlap(buf_raw, gdf_linha_buffer, indice_linhas)
 
         df_maior_overlap_linha = df_overlap_raw.sort_values("overlap_percentage", ascending=False).head(1)
 
@@ -474,16 +513,23 @@ def discover_bus_line(
             resposta["overlap_inicial"] = maior_overlap
 
             # Limpa a linha e acha o ponto inicial (sem repetição)
-            for j in range(curr_idx, search_idx, -1):
-                df_gps_filtro_opt = df_gps_sort.iloc[j : curr_idx + 1]
-
-                buf_opt = gera_shape_posicoes(
-                    df_gps_filtro_opt, tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2
-                )
-                df_overlap_opt = calcula_overlap(buf_opt, gdf_linha_buffer)
-
-                if df_overlap_opt["overlap_percentage"].max() > threshold_overlap:
-                    break
+            # Busca galopante/binária de trás para frente: O(log N) avaliações ao invés de uma por posição
+            overlaps_sufixos = {}
+
+            def calcula_overlap_sufixo(j):
+                if j not in overlaps_sufixos:
+                    buf_opt = gera_shape_posicoes(
+                        df_gps_sort.iloc[j : curr_idx + 1], tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2
+                    )
+                    overlaps_sufixos[j] = calcula_overlap(buf_opt, gdf_linha_buffer, indice_linhas)
+                return overlaps_sufixos[j]
+
+            j = busca_inicio_galopante(
+                lambda j: calcula_overlap_sufixo(j)["overlap_percentage"].max() > threshold_overlap,
+                search_idx + 1,
+                curr_idx,
+            )
+            df_overlap_opt = calcula_overlap_sufixo(j)
 
             idx_start_linha = j
             start_idx = idx_start_linha
@@ -541,7 +587,7 @@ def discover_bus_line(
             buf_final = gera_shape_posicoes(
                 df_gps_sort.iloc[start_idx : end_idx + 1], tam_buffer_positions=tamanho_buffer_posicao_veiculo * 2
             )
-            df_overlap_final = calcula_overlap(buf_final, gdf_linha_buffer)["overlap_percentage"].max()
+            df_overlap_final = calcula_overlap(buf_final, gdf_linha_buffer, indice_linhas)["overlap_percentage"].max()
 
             resposta["overlap_final"] = df_overlap_final
             resposta["overlap_df"] = df_gps_sort.iloc[start_idx : end_idx + 1]
@@ -565,19 +611,11 @@ def discover_bus_line(
 ###################################################################################
 
 
-# Obtém o tamanho da linha
+# Obtém o tamanho da linha (metros, UTM), pré-calculado na ingestão do KML
 def get_tamanho_linha(gdf_linha_raw, sentido_linha_overlap, sublinha_overlap):
-    # Copia e joga para UTM
-    gdf_linhas_metros = gdf_linha_raw.copy().to_crs(epsg=31982)  # Substitua 31982 pela zona UTM correta, se necessário
-
-    # Calcular o comprimento de cada linha em metros
-    gdf_linhas_metros["length_m"] = gdf_linhas_metros["geometry"].length
-    gdf_linhas_metros[gdf_linhas_metros["sentido"] == sentido_linha_overlap]
-
-    tam_linha_metros = gdf_linhas_metros[
-        (gdf_linhas_metros["sentido"] == sentido_linha_overlap)
-        & (gdf_linhas_metros["numero_sublinha"] == sublinha_overlap)
-    ]["length_m"].sum()
+    tam_linha_metros = gdf_linha_raw[
+        (gdf_linha_raw["sentido"] == sentido_linha_overlap) & (gdf_linha_raw["numero_sublinha"] == sublinha_overlap)
+    ][COLUNA_TAMANHO].sum()
 
     return tam_linha_metros
 
@@ -606,6 +644,15 @@ def get_round_timestamps(timestamp_inicio, timestamp_final, minutes_to_round=5):
 
 
 # Retorna as informações relacionadas a duração da viagem
+# Mapeia os índices da resposta (calculados nas posições afinadas) de volta para as posições originais
+def mapeia_indices_originais(resposta, idx_originais, df_gps_sort):
+    for chave in ["start_idx", "curr_idx", "end_idx"]:
+        resposta[chave] = int(idx_originais[resposta[chave]])
+
+    resposta["overlap_df"] = df_gps_sort.iloc[resposta["start_idx"] : resposta["end_idx"] + 1]
+    return resposta
+
+
 def get_duracao_viagem(df_gps_sort, resposta):
     # Obtém índices de início e fim do GPS
     start_idx = resposta["start_idx"]
@@ -624,70 +671,26 @@ def get_duracao_viagem(df_gps_sort, resposta):
     return timestamp_inicio, timestamp_final, tempo_viagem_segundos, dt_start_round_timestamp, dt_end_round_timestamp
 
 
-# Calcula a quantidade de combustível utilizada
-def calcula_combustivel(df_comb_filtered, timestamp_inicio, timestamp_final):
-    # Verifica se o DataFrame está vazio
-    # ou
-    # só tem um único dado (impossibilita calcular pq fazemos o calculo pela diferença entre dados subsequenetos)
-    if df_comb_filtered.empty or len(df_comb_filtered) == 1:
-        return 0
-
-    # Primeira parte (buffer até inicial)
-    first_part_diff_seconds = (
-        300 - (pd.to_datetime(timestamp_inicio) - df_comb_filtered.iloc[0]["StartDateTime"]).total_seconds()
-    )
-    first_part_diff_comb = df_comb_filtered.iloc[1]["Value"] - df_comb_filtered.iloc[0]["Value"]
-    first_part_comb = first_part_diff_comb * first_part_diff_seconds / 300
-
-    # Parte do meio
-    middle_comb = 0
-    total_rows = len(df_comb_filtered)
-
-    for i in range(1, total_rows - 2):
-        df_comb_antes = df_comb_filtered.iloc[i]
-        df_comb_depois = df_comb_filtered.iloc[i + 1]
-
-        diff_comb = df_comb_depois["Value"] - df_comb_antes["Value"]
-
-        if diff_comb > 0:
-            middle_comb = middle_comb + (df_comb_depois["Value"] - df_comb_antes["Value"])
-        else:
-            middle_comb = middle_comb + (df_comb_depois["Value"])
-
-    # Última parte
-    last_part_diff_seconds = (
-        300 - (df_comb_filtered.iloc[-1]["StartDateTime"] - pd.to_datetime(timestamp_final)).total_seconds()
-    )
-    last_part_diff_comb = df_comb_filtered.iloc[-1]["Value"] - df_comb_filtered.iloc[-2]["Value"]
-    last_part_comb = last_part_diff_comb * last_part_diff_seconds / 300
-
-    # Combustível total
-    total_comb = first_part_comb + middle_comb + last_part_comb
-
-    return total_comb
-
-
-###################################################################################
-# MAIN
-####################################################################################
-
-
-# Processa as viagens de um veículo
-def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
+def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia, prazo=None):
     # Adiciona horário da próxima viagem na coluna prox_diahorario
     df_trips_dia["prox_diahorario"] = df_trips_dia["diahorario"].shift(-1)
 
     # Conta o número de viagens
     count_viagem = 1
 
+    # Viagens já processadas do veículo no dia (uma única query)
+    viagens_processadas = get_viagens_processadas(dia, vec_num_id)
+
     # Para cada viagem
     for jx, row_trip in df_trips_dia.iterrows():
+        verifica_prazo(prazo)
+
         rmtc_timestamp_inicio = row_trip["diahorario"]
         rmtc_timestamp_fim = row_trip["prox_diahorario"]
         rmtc_destino_curto = row_trip["destinocurto"]
 
         # Verifia se a viagem já não foi processada
-        foi_processada = verifica_viagem_processada(dia, vec_num_id, count_viagem)
+        foi_processada = count_viagem in viagens_processadas
 
         if foi_processada:
             count_viagem += 1
@@ -723,6 +726,11 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
             # Posições do GPS
             df_gps_sort = get_posicoes_gps(vec_asset_id, rmtc_timestamp_inicio, rmtc_timestamp_fim)
 
+            # Afinamento: sentido e linha são descobertos nas posições mantidas (sem paradas repetidas e posições
+            # muito próximas), os índices da resposta são mapeados de volta para df_gps_sort
+            idx_originais = afina_trajetoria(df_gps_sort, TAMANHO_BUFFER_POSICAO_VEICULO * FRACAO_BUFFER_AFINAMENTO)
+            df_gps_afinado = df_gps_sort.iloc[idx_originais]
+
             # Linha
             linha = row_trip["linhanumero"]
 
@@ -749,7 +757,7 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
                 gdf_linhas_extremo_start_buffer_filtrado,
                 gdf_linhas_extremo_end_buffer_filtrado,
             ) = filtra_sentido(
-                df_gps_sort, gdf_linha_buffer, gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer
+                df_gps_afinado, gdf_linha_buffer, gdf_linhas_extremo_start_buffer, gdf_linhas_extremo_end_buffer
             )
 
             # Caso tenha encontrado/filtrado o sentido, vamos analisar a linha
@@ -758,7 +766,7 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
             if encontrou_sentido:
                 # Descobre a linha
                 resposta = discover_bus_line(
-                    df_gps_sort,
+                    df_gps_afinado,
                     gdf_linha_buffer_filtrado,
                     gdf_linhas_extremo_start_buffer_filtrado,
                     gdf_linhas_extremo_end_buffer_filtrado,
@@ -767,6 +775,8 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
                 )
                 # Verifica se conseguiu analisar a linha com sucesso
                 encontrou_linha = resposta["encontrou_linha"]
+                if encontrou_linha:
+                    mapeia_indices_originais(resposta, idx_originais, df_gps_sort)
 
             # Se não encontrou a linha
             if not encontrou_linha:
@@ -817,7 +827,7 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
                 df_comb_filtered["StartDateTime"] = pd.to_datetime(df_comb_filtered["StartDateTime"])
 
                 # Calcula quantidade de combustível utilizada
-                total_comb = calcula_combustivel(df_comb_filtered, timestamp_inicio, timestamp_final)
+                total_comb = calcula_combustivel_df(df_comb_filtered, timestamp_inicio, timestamp_final)
 
                 # Computa km / l (convertendo para km e L só por desencargo)
                 tam_linha_km = tam_linha_metros / 1000
@@ -890,7 +900,7 @@ def processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia):
         count_viagem += 1
 
 
-def processa_veiculo(row, dia):
+def processa_veiculo(row, dia, prazo=None):
     vec_num_id = row["Description"]
     vec_asset_id = row["AssetId"]
     vec_model = row["Model"]
@@ -903,7 +913,7 @@ def processa_veiculo(row, dia):
 
         # Se possuí viagens nesse dia
         if len(df_trips_dia) > 0:
-            processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia)
+            processa_viagem(vec_num_id, vec_asset_id, vec_model, df_trips_dia, dia, prazo)
         else:
             print(f"Veículo: {vec_num_id} - {vec_asset_id} - {vec_model} não possui viagens no dia {dia}")
 
@@ -915,13 +925,9 @@ def processa_veiculo(row, dia):
     gc.collect()
 
 
-@click.command()
-@click.option("--data_baixar", type=str, help="Data para baixar")
-@click.option("--vec_asset_id", type=int, help="ID do veículo")
-def main(data_baixar, vec_asset_id):
-    global pg_engine
-    df_veiculos = pd.DataFrame()
-
+# Analisa um único veículo em um único dia
+# Usado tanto pela linha de comando quanto pelos workers do main (que informam o prazo do veículo)
+def analisa_veiculo_dia(vec_asset_id, dia_str, prazo=None):
     # Obtém o veículo a ser processado
     df_veiculos = pd.read_sql(
         f"""
@@ -930,6 +936,15 @@ def main(data_baixar, vec_asset_id):
         pg_engine,
     )
 
+    # Dado do veículo
+    row_veiculo = df_veiculos.iloc[0]
+    processa_veiculo(row_veiculo, dia_str, prazo)
+
+
+@click.command()
+@click.option("--data_baixar", type=str, help="Data para baixar")
+@click.option("--vec_asset_id", type=int, help="ID do veículo")
+def main(data_baixar, vec_asset_id):
     # Obtem a data a ser processada, assume hoje caso não seja informado
     dia_dt = dt.datetime.now()
 
@@ -938,9 +953,7 @@ def main(data_baixar, vec_asset_id):
 
     dia_str = dia_dt.strftime("%Y-%m-%d")
 
-    # Dado do veículo
-    row_veiculo = df_veiculos.iloc[0]
-    processa_veiculo(row_veiculo, dia_str)
+    analisa_veiculo_dia(vec_asset_id, dia_str)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Script que mantém as partições mensais das tabelas posicao_gps e tst_combs
+# - Manutenção (padrão): cria as partições do mês atual e dos próximos meses e move para a partição
+#   mensal os dados que caíram na partição DEFAULT
+# - --migrar: aplica migracao_particoes.sql (tabelas particionadas por ts) e copia os dados da tabela
+#   <tabela>_legado mês a mês (cada mês em uma transação, pode ser reexecutado)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports variáveis de ambiente
+from dotenv import load_dotenv
+
+# Tenta carregar o .env atual e o do diretório pai
+load_dotenv("./env")
+load_dotenv("../.env")
+
+# Bibliotecas padrão
+import os
+import sys
+import pandas as pd
+
+# CLI
+import click
+
+# BD
+from sqlalchemy import create_engine
+from sqlalchemy.sql import text
+from execution_logger import ExecutionLogger
+
+
+###################################################################################
+# Configurações e Variáveis de ambiente
+###################################################################################
+
+# Não bufferiza a saída
+sys.stdout.flush()
+
+# Variáveis do banco
+DB_HOST = os.getenv("DB_HOST")
+DB_PORT = os.getenv("DB_PORT")
+DB_USER = os.getenv("DB_USER")
+DB_PASS = os.getenv("DB_PASS")
+DB_NAME = os.getenv("DB_NAME")
+
+# Conexão com o banco de dados
+pg_engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
+
+if pg_engine is None:
+    print("Erro ao conectar ao banco de dados.")
+    sys.exit(1)
+
+# Tabelas particionadas e a coluna (texto ISO da Mix) que origina o ts
+TABELAS_PARTICIONADAS = {
+    "posicao_gps": "Timestamp",
+    "tst_combs": "StartDateTime",
+}
+
+# Número de partições criadas antecipadamente (meses)
+MESES_A_FRENTE = 3
+
+# Arquivo da migração
+ARQUIVO_MIGRACAO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migracao_particoes.sql")
+
+# Formato das datas salvas pela Mix (texto ISO)
+FORMATO_DATA_MIX = "%Y-%m-%dT%H:%M:%SZ"
+
+
+###################################################################################
+# Partições
+###################################################################################
+
+
+# Limites (UTC) do mês
+def get_limites_mes(mes):
+    inicio = pd.Timestamp(mes).to_period("M").to_timestamp()
+    fim = inicio + pd.offsets.MonthBegin(1)
+    return inicio, fim
+
+
+def existe_tabela(conn, tabela):
+    return conn.execute(text("SELECT to_regclass(:tabela)"), {"tabela": tabela}).scalar() is not None
+
+
+def eh_particionada(conn, tabela):
+    relkind = conn.execute(text("SELECT relkind FROM pg_class WHERE relname = :tabela"), {"tabela": tabela}).scalar()
+    return relkind == "p"
+
+
+# Cria a partição do mês (se não existir)
+# Os dados desse mês que estão na partição DEFAULT são movidos para a nova partição
+def cria_particao(conn, tabela, mes):
+    inicio, fim = get_limites_mes(mes)
+    particao = f"{tabela}_{inicio:%Y%m}"
+    particao_default = f"{tabela}_default"
+
+    if existe_tabela(conn, particao):
+        return False
+
+    inicio_str = inicio.strftime("%Y-%m-%d 00:00:00+00")
+    fim_str = fim.strftime("%Y-%m-%d 00:00:00+00")
+    limites = {"inicio": inicio_str, "fim": fim_str}
+    intervalo = f"FOR VALUES FROM ('{inicio_str}') TO ('{fim_str}')"
+
+    tem_dados_default = conn.execute(
+        text(f"SELECT EXISTS (SELECT 1 FROM {particao_default} WHERE ts >= :inicio AND ts < :fim)"), limites
+    ).scalar()
+
+    if not tem_dados_default:
+        conn.execute(text(f"CREATE TABLE {particao} PARTITION OF {tabela} {intervalo}"))
+    else:
+        # O PostgreSQL não cria a partição se a DEFAULT tiver dados do intervalo
+        conn.execute(text(f"ALTER TABLE {tabela} DETACH PARTITION {particao_default}"))
+        conn.execute(text(f"CREATE TABLE {particao} PARTITION OF {tabela} {intervalo}"))
+        resultado = conn.execute(
+            text(f"INSERT INTO {tabela} SELECT * FROM {particao_default} WHERE ts >= :inicio AND ts < :fim"), limites
+        )
+        conn.execute(text(f"DELETE FROM {particao_default} WHERE ts >= :inicio AND ts < :fim"), limites)
+        conn.execute(text(f"ALTER TABLE {tabela} ATTACH PARTITION {particao_default} DEFAULT"))
+        print(tabela, "MOVEMOS", resultado.rowcount, "REGISTROS DA PARTIÇÃO DEFAULT PARA", particao)
+
+    print(tabela, "CRIAMOS A PARTIÇÃO", particao)
+    return True
+
+
+# Cria as partições do mês atual e dos próximos meses, e as partições dos meses que estão na DEFAULT
+def mantem_particoes(tabela, meses_a_frente):
+    with pg_engine.begin() as conn:
+        if not eh_particionada(conn, tabela):
+            print(tabela, "NÃO É PARTICIONADA, EXECUTE COM --migrar")
+            return
+
+    mes_atual = pd.Timestamp.now("UTC").tz_localize(None)
+    meses = [mes_atual + pd.DateOffset(months=i) for i in range(0, meses_a_frente + 1)]
+
+    with pg_engine.connect() as conn:
+        df_meses_default = pd.read_sql(
+            text(f"SELECT DISTINCT date_trunc('month', ts AT TIME ZONE 'UTC') AS mes FROM {tabela}_default"), conn
+        )
+    meses.extend(df_meses_default["mes"].tolist())
+
+    for mes in meses:
+        with pg_engine.begin() as conn:
+            cria_particao(conn, tabela, mes)
+
+
+###################################################################################
+# Migração
+###################################################################################
+
+
+# Copia os dados de <tabela>_legado para a tabela particionada, mês a mês
+def migra_dados(tabela, coluna_tempo):
+    legado = f"{tabela}_legado"
+
+    with pg_engine.connect() as conn:
+        if not existe_tabela(conn, legado):
+            print(tabela, "SEM TABELA LEGADO")
+            return
+
+        minimo, maximo = conn.execute(text(f'SELECT MIN("{coluna_tempo}"), MAX("{coluna_tempo}") FROM {legado}')).one()
+
+    if minimo is None:
+        print(tabela, "TABELA LEGADO VAZIA")
+        return
+
+    minimo = pd.to_datetime(minimo, utc=True).tz_convert(None)
+    maximo = pd.to_datetime(maximo, utc=True).tz_convert(None)
+    meses = pd.period_range(minimo, maximo, freq="M")
+    for mes in meses:
+        inicio, fim = get_limites_mes(mes.to_timestamp())
+
+        # A coluna de tempo é texto ISO, comparamos como texto para aproveitar índices existentes
+        with pg_engine.begin() as conn:
+            cria_particao(conn, tabela, inicio)
+            resultado = conn.execute(
+                text(
+                    f"""
+                    INSERT INTO {tabela}
+                    SELECT l.*, CAST(l."{coluna_tempo}" AS TIMESTAMPTZ)
+                    FROM {legado} l
+                    WHERE l."{coluna_tempo}" >= :inicio AND l."{coluna_tempo}" < :fim
+                    ON CONFLICT DO NOTHING
+                    """
+                ),
+                {"inicio": inicio.strftime(FORMATO_DATA_MIX), "fim": fim.strftime(FORMATO_DATA_MIX)},
+            )
+
+        print(tabela, f"{inicio:%Y-%m}", "COPIAMOS", resultado.rowcount, "REGISTROS")
+
+
+def migra():
+    with open(ARQUIVO_MIGRACAO) as arquivo:
+        sql_migracao = arquivo.read()
+
+    with pg_engine.begin() as conn:
+        conn.execute(text(sql_migracao))
+
+    for tabela, coluna_tempo in TABELAS_PARTICIONADAS.items():
+        migra_dados(tabela, coluna_tempo)
+
+
+###################################################################################
+# Main
+###################################################################################
+
+
+@click.command()
+@click.option("--migrar", is_flag=True, help="Aplica a migração e copia os dados das tabelas legado")
+@click.option("--meses_a_frente", type=int, default=MESES_A_FRENTE, help="Partições criadas antecipadamente")
+def main(migrar, meses_a_frente):
+    if migrar:
+        migra()
+
+    for tabela in TABELAS_PARTICIONADAS.keys():
+        mantem_particoes(tabela, meses_a_frente)
+
+
+if __name__ == "__main__":
+    with ExecutionLogger(pg_engine, "db_particiona_mix"):
+        main()
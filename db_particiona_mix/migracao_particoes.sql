@@ -0,0 +1,43 @@
+-- Migração de posicao_gps e tst_combs para tabelas particionadas por mês (RANGE em ts)
+-- - ts (timestamptz) é a coluna de partição, preenchida pelos downloaders a partir de "Timestamp" / "StartDateTime"
+-- - A chave primária inclui ts (exigência do PostgreSQL para tabelas particionadas)
+-- - Índice ("AssetId", ts) para as consultas por veículo e intervalo de tempo (partition pruning + index scan)
+-- - Partição DEFAULT para dados fora das partições mensais (o job db_particiona_mix.py os move depois)
+-- - A tabela antiga é renomeada para <tabela>_legado, os dados são copiados mês a mês pelo db_particiona_mix.py --migrar
+--
+-- Idempotente: só migra se a tabela ainda não for particionada
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'posicao_gps' AND relkind = 'r') THEN
+        ALTER TABLE posicao_gps RENAME TO posicao_gps_legado;
+
+        CREATE TABLE posicao_gps (
+            LIKE posicao_gps_legado INCLUDING DEFAULTS,
+            ts TIMESTAMPTZ NOT NULL
+        ) PARTITION BY RANGE (ts);
+
+        ALTER TABLE posicao_gps
+            ADD CONSTRAINT posicao_gps_part_pkey PRIMARY KEY ("AssetId", "PositionId", ts);
+
+        CREATE INDEX posicao_gps_part_asset_ts_idx ON posicao_gps ("AssetId", ts);
+
+        CREATE TABLE posicao_gps_default PARTITION OF posicao_gps DEFAULT;
+    END IF;
+
+    IF EXISTS (SELECT 1 FROM pg_class WHERE relname = 'tst_combs' AND relkind = 'r') THEN
+        ALTER TABLE tst_combs RENAME TO tst_combs_legado;
+
+        CREATE TABLE tst_combs (
+            LIKE tst_combs_legado INCLUDING DEFAULTS,
+            ts TIMESTAMPTZ NOT NULL
+        ) PARTITION BY RANGE (ts);
+
+        ALTER TABLE tst_combs
+            ADD CONSTRAINT tst_combs_part_pkey PRIMARY KEY ("EventTypeId", "EventId", "DriverId", "AssetId", ts);
+
+        CREATE INDEX tst_combs_part_asset_ts_idx ON tst_combs ("AssetId", ts);
+
+        CREATE TABLE tst_combs_default PARTITION OF tst_combs DEFAULT;
+    END IF;
+END $$;
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Classe que salva em lote os eventos da Mix
+# - Os tipos das colunas são tratados uma única vez por DataFrame (bigint, float, boolean e NaN -> NULL)
+# - Os registros são copiados (COPY) para uma tabela temporária (staging) e então inseridos na tabela do evento
+#   com um único INSERT ... SELECT ... ON CONFLICT DO NOTHING
+# - Registros inválidos vão para a tabela de quarentena ao invés de abortar o lote
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import io
+import json
+import functools
+import numpy as np
+import pandas as pd
+
+# Banco de Dados
+from sqlalchemy import text
+from sqlalchemy import BigInteger, Boolean, Float
+from sqlalchemy.dialects.postgresql import insert
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Limites do bigint
+BIGINT_MIN = -9223372036854775808
+BIGINT_MAX = 9223372036854775807
+
+# Colunas que identificam um evento (conflito)
+CHAVES_CONFLITO_EVENTOS = ["EventTypeId", "EventId", "DriverId", "AssetId"]
+
+# Tabela de quarentena (registros que não puderam ser inseridos)
+TABELA_QUARENTENA = "mix_evt_quarentena"
+
+# Tabela temporária usada no COPY
+TABELA_STAGING = "stg_mix_evt"
+
+# Coluna de partição (timestamptz) das tabelas particionadas por mês (db_particiona_mix) e a coluna que a origina
+COLUNA_PARTICAO = "ts"
+COLUNA_TEMPO_EVENTO = "StartDateTime"
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Converte uma coluna para bigint (Int64), valores inválidos ou fora do intervalo viram NULL
+def converte_bigint(serie):
+    if pd.api.types.is_bool_dtype(serie):
+        return serie.astype("Int64")
+
+    if pd.api.types.is_signed_integer_dtype(serie):
+        return serie.astype("Int64")
+
+    if pd.api.types.is_unsigned_integer_dtype(serie):
+        return serie.where(serie <= BIGINT_MAX).astype("Int64")
+
+    if pd.api.types.is_float_dtype(serie):
+        # 2 ** 63 não é representável em bigint (float(BIGINT_MAX) == 2 ** 63)
+        validos = np.isfinite(serie) & (serie >= BIGINT_MIN) & (serie < 2**63)
+        return np.trunc(serie.where(validos)).astype("Int64")
+
+    # Demais (object): converte valor a valor como int(), só nesta coluna
+    def para_int(valor):
+        try:
+            valor = int(valor)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        return valor if BIGINT_MIN <= valor <= BIGINT_MAX else None
+
+    return serie.map(para_int).astype("Int64")
+
+
+# Converte uma coluna para float, valores inválidos viram NULL
+def converte_float(serie):
+    return pd.to_numeric(serie, errors="coerce").astype("float64")
+
+
+# Formata um valor para o CSV do COPY
+def formata_valor_copy(valor):
+    if isinstance(valor, (dict, list)):
+        return json.dumps(valor)
+    if isinstance(valor, (bool, np.bool_)):
+        return "true" if valor else "false"
+    return str(valor)
+
+
+# Formata uma coluna para o CSV do COPY (NULL = campo vazio sem aspas, demais valores entre aspas)
+def formata_coluna_copy(serie):
+    nulos = serie.isna()
+    texto = serie.map(formata_valor_copy, na_action="ignore").astype(str)
+    texto = '"' + texto.str.replace('"', '""', regex=False) + '"'
+    return texto.where(~nulos, "")
+
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class EventBulkLoader(object):
+    # Construtor, por padrão
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, pg_engine, event_table, chaves_conflito=CHAVES_CONFLITO_EVENTOS, tabela_quarentena=TABELA_QUARENTENA):
+        self.pg_engine = pg_engine
+        self.event_table = event_table              # Tabela do evento (refletida)
+        self.chaves_conflito = chaves_conflito      # Colunas do ON CONFLICT
+        self.tabela_quarentena = tabela_quarentena  # Tabela para os registros inválidos
+
+        # Colunas da tabela agrupadas por tipo
+        self.colunas_bigint = [c.name for c in event_table.columns if isinstance(c.type, BigInteger)]
+        self.colunas_float = [c.name for c in event_table.columns if isinstance(c.type, Float)]
+        self.colunas_boolean = [c.name for c in event_table.columns if isinstance(c.type, Boolean)]
+
+        # Tabela particionada, ts também faz parte da chave de conflito
+        self.particionada = COLUNA_PARTICAO in event_table.columns
+        if self.particionada:
+            self.chaves_conflito = list(chaves_conflito) + [COLUNA_PARTICAO]
+    # fmt: on
+
+    # Trata os tipos do DataFrame (uma vez por coluna)
+    # Retorna os registros válidos e os inválidos (vão para a quarentena)
+    def prepara(self, df):
+        # Coluna de partição, o PostgreSQL direciona o registro para a partição do mês
+        if self.particionada and COLUNA_TEMPO_EVENTO in df.columns:
+            df = df.assign(**{COLUNA_PARTICAO: pd.to_datetime(df[COLUNA_TEMPO_EVENTO], utc=True, errors="coerce")})
+
+        colunas = [c.name for c in self.event_table.columns if c.name in df.columns]
+        df_limpo = df[colunas].copy()
+
+        for coluna in colunas:
+            if coluna in self.colunas_bigint:
+                df_limpo[coluna] = converte_bigint(df_limpo[coluna])
+            elif coluna in self.colunas_float:
+                df_limpo[coluna] = converte_float(df_limpo[coluna])
+            elif coluna in self.colunas_boolean:
+                df_limpo[coluna] = df_limpo[coluna].fillna(False).astype(bool)
+
+        # NaN -> NULL
+        df_limpo = df_limpo.astype(object).where(df_limpo.notna(), None)
+
+        # Registros com NULL em colunas NOT NULL (ex: chave primária) não podem ser inseridos
+        obrigatorias = [c.name for c in self.event_table.columns if not c.nullable and c.name in df_limpo.columns]
+        invalidos = df_limpo[obrigatorias].isna().any(axis=1)
+
+        return df_limpo[~invalidos], df_limpo[invalidos]
+
+    # Salva o DataFrame, retorna (número de registros inseridos, número de registros em quarentena)
+    def carrega(self, df):
+        df_limpo, df_invalidos = self.prepara(df)
+        num_inseridos, num_quarentena = 0, 0
+
+        with self.pg_engine.begin() as conn:
+            if not df_invalidos.empty:
+                num_quarentena += self.__envia_quarentena(conn, df_invalidos, "Coluna obrigatória nula ou inválida")
+
+            if df_limpo.empty:
+                return num_inseridos, num_quarentena
+
+            try:
+                # Savepoint, caso o COPY ou o INSERT falhem voltamos para cá
+                with conn.begin_nested():
+                    num_inseridos = self.__copia_e_insere(conn, df_limpo)
+            except Exception as e:
+                print(f"[ERRO] Lote de {len(df_limpo)} registros falhou ({e}), inserindo registro a registro")
+                inseridos, quarentena = self.__insere_registro_a_registro(conn, df_limpo)
+                num_inseridos += inseridos
+                num_quarentena += quarentena
+
+        return num_inseridos, num_quarentena
+
+    def __copia_e_insere(self, conn, df):
+        preparer = conn.dialect.identifier_preparer
+        tabela = preparer.format_table(self.event_table)
+        colunas = ", ".join(preparer.quote(c) for c in df.columns)
+        chaves = ", ".join(preparer.quote(c) for c in self.chaves_conflito)
+
+        # Tabela temporária com a mesma estrutura da tabela do evento (descartada no commit)
+        conn.execute(text(f"CREATE TEMP TABLE {TABELA_STAGING} (LIKE {tabela} INCLUDING DEFAULTS) ON COMMIT DROP"))
+
+        # Monta o CSV coluna a coluna
+        colunas_csv = [formata_coluna_copy(df[c]) for c in df.columns]
+        linhas_csv = functools.reduce(lambda a, b: a + "," + b, colunas_csv)
+        buffer = io.StringIO("\n".join(linhas_csv) + "\n")
+
+        cursor = conn.connection.cursor()
+        try:
+            cursor.copy_expert(f"COPY {TABELA_STAGING} ({colunas}) FROM STDIN WITH (FORMAT csv)", buffer)
+        finally:
+            cursor.close()
+
+        resultado = conn.execute(
+            text(
+                f"""
+                INSERT INTO {tabela} ({colunas})
+                SELECT {colunas} FROM {TABELA_STAGING}
+                ON CONFLICT ({chaves}) DO NOTHING
+                """
+            )
+        )
+
+        return resultado.rowcount
+
+    def __insere_registro_a_registro(self, conn, df):
+        num_inseridos, num_quarentena = 0, 0
+
+        for registro in df.to_dict(orient="records"):
+            try:
+                with conn.begin_nested():
+                    stmt = insert(self.event_table).values(registro)
+                    stmt = stmt.on_conflict_do_nothing(index_elements=self.chaves_conflito)
+                    num_inseridos += conn.execute(stmt).rowcount
+            except Exception as e:
+                print(f"[ERRO] Linha {registro} causou erro: {e}")
+                num_quarentena += self.__envia_quarentena(conn, pd.DataFrame([registro]), str(e))
+
+        return num_inseridos, num_quarentena
+
+    def __envia_quarentena(self, conn, df, erro):
+        conn.execute(
+            text(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.tabela_quarentena} (
+                    id BIGSERIAL PRIMARY KEY,
+                    tabela TEXT,
+                    registro JSONB,
+                    erro TEXT,
+                    data_quarentena TIMESTAMPTZ DEFAULT NOW()
+                )
+                """
+            )
+        )
+
+        registros = [
+            {"tabela": self.event_table.name, "registro": json.dumps(registro, default=str), "erro": erro}
+            for registro in df.to_dict(orient="records")
+        ]
+        conn.execute(
+            text(
+                f"""
+                INSERT INTO {self.tabela_quarentena} (tabela, registro, erro)
+                VALUES (:tabela, CAST(:registro AS JSONB), :erro)
+                """
+            ),
+            registros,
+        )
+
+        return len(registros)
@@ -10,11 +10,9 @@
 import os
 import gc
 import sys
-import math
 
 # Imports básicos
 import os
-import json
 import pandas as pd
 import time
 
@@ -30,9 +28,27 @@ import requests
 # Banco de Dados
 from sqlalchemy import create_engine
 from sqlalchemy import Table, MetaData
-from sqlalchemy.dialects.postgresql import insert
 from execution_logger import ExecutionLogger
 
+# Cliente da Mix
+from mix_client import MixClient
+
+# Carga em lote
+from bulk_loader import EventBulkLoader
+
+# Leitura em streaming das respostas
+from mix_stream import StreamingColumnReader, get_colunas_float
+
+# Download incremental (marcas d'água)
+from high_water_mark import HighWaterMarks, LOOKBACK_MINUTOS, divide_em_lotes
+
+# Backfill
+from mix_fetcher import AdaptiveRateLimiter, TAXA_INICIAL, TAXA_MINIMA, STATUS_SOBRECARGA, get_retry_after
+
+# Download concorrente (vários tipos de eventos por requisição)
+from mix_fetcher import ConcurrentAssetFetcher, AdaptiveBatchSizer
+from backfill_checkpoint import BackfillCheckpoint, get_dias_backfill, executa_dias_em_paralelo
+
 # DotEnv
 from dotenv import load_dotenv
 
@@ -63,153 +79,40 @@ DB_NAME = os.getenv("DB_NAME")
 # Criar a conexão com o SQLAlchemy
 pg_engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
 
-# Constantes
-MIX_API_IDENTITY_URL = os.getenv("MIX_API_IDENTITY_URL")
-MIX_API_URL = os.getenv("MIX_API_URL")
-MIX_USERNAME = os.getenv("MIX_USERNAME")
-MIX_PASSWORD = os.getenv("MIX_PASSWORD")
-MIX_API_USERNAME = os.getenv("MIX_API_USERNAME")
-MIX_API_PASSWORD = os.getenv("MIX_API_PASSWORD")
-MIX_GROUP_ID = os.getenv("MIX_GROUP_ID")
+# Cliente da API da Mix (sessão persistente e token compartilhado entre processos)
+cliente_mix = MixClient()
 
 # Tabela
 metadata = MetaData()
 
-# Config
-BIGINT_MIN = -9223372036854775808
-BIGINT_MAX = 9223372036854775807
-
-
-###################################################################################
-# Autenticação
-###################################################################################
-
-payload = f"""
-grant_type=password&
-username={MIX_USERNAME}&
-password={MIX_PASSWORD}&
-scope=offline_access%20MiX.Integrate
-"""
-headers = {
-    "Content-Type": "application/x-www-form-urlencoded",
-}
-
-TOKEN = None
-AUTH_HEADERS = None
-AUTH_HEADERS_JSON = None
-ULTIMO_LOGIN = None
+# Backfill: dias baixados ao mesmo tempo e orçamento de requisições por segundo na API (somando todos os dias)
+DIAS_PARALELOS = 4
+REQUISICOES_POR_SEGUNDO = 0.5
 
-
-def get_auth_token():
-    response = requests.request(
-        "POST",
-        MIX_API_IDENTITY_URL + "/core/connect/token",
-        headers=headers,
-        data=payload,
-        auth=(MIX_API_USERNAME, MIX_API_PASSWORD),
-    )
-    print(response.json())
-    return response.json()["access_token"]
-
-
-def authenticate():
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON, ULTIMO_LOGIN
-
-    if ULTIMO_LOGIN is None:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-    elif (dt.datetime.now() - ULTIMO_LOGIN).seconds > 3000:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-
-    AUTH_HEADERS = {"Authorization": f"Bearer {TOKEN}"}
-    AUTH_HEADERS_JSON = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+# Modo paralelo: tipos de eventos por requisição e tamanho do lote de veículos (inicial e máximo)
+TIPOS_POR_REQUISICAO = 10
+TAMANHO_LOTE_INICIAL = 50
+TAMANHO_LOTE_MAXIMO = 150
 
 
 #### Download de Evento
 def download_evento(asset_ids, event_id, data_inicio, data_fim):
-    global AUTH_HEADERS_JSON
-
-    # Datas
-    data_inicio_str = data_inicio.strftime("%Y%m%d%H%M%S")
-    data_final_str = data_fim.strftime("%Y%m%d%H%M%S")
+    return cliente_mix.get_eventos(asset_ids, [event_id], data_inicio, data_fim, timeout=300, stream=True)
 
-    # URL
-    url = MIX_API_URL + f"/api/events/assets/from/{data_inicio_str}/to/{data_final_str}"
 
-    # Payload
-    evt_payload = {"EntityIds": list(map(int, asset_ids)), "EventTypeIds": [event_id], "MenuId": "string"}
+#### Download de vários tipos de eventos numa mesma requisição
+def download_eventos(asset_ids, event_ids, data_inicio, data_fim):
+    return cliente_mix.get_eventos(asset_ids, event_ids, data_inicio, data_fim, timeout=300, stream=True)
 
-    # Resposta
-    return requests.request("POST", url, headers=AUTH_HEADERS_JSON, data=json.dumps(evt_payload), timeout=300)
 
-# Limpa Registro
-def clean_record(record, table):
-    cleaned = {}
-    for key, value in record.items():
-        column = table.columns.get(key)
-
-        if column is None:
-            continue
-
-        col_type = getattr(column.type, "__visit_name__", "")
-
-        # Trata NaN
-        if isinstance(value, float) and (math.isnan(value) or pd.isna(value)):
-            cleaned[key] = None
-            continue
+# Prepara os eventos que serão baixados (tabela, carga em lote e leitor de cada evento)
+def prepara_eventos(df_eventos):
+    eventos = []
 
-        # Trata bigint
-        if col_type == 'bigint':
-            try:
-                value = int(value)
-                if BIGINT_MIN <= value <= BIGINT_MAX:
-                    cleaned[key] = value
-                else:
-                    cleaned[key] = None
-            except:
-                cleaned[key] = None
-
-        # Trata float
-        elif col_type in ('float', 'float8', 'double precision'):
-            try:
-                cleaned[key] = float(value)
-            except:
-                cleaned[key] = None
-
-        # Demais tipos
-        else:
-            cleaned[key] = value
-
-    return cleaned
-
-
-    
-@click.command()
-@click.option("--data_baixar", type=str, help="Data que irei baixar")
-def main(data_baixar):
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON
-    authenticate()
-
-    # Lista de Veículos
-    url = MIX_API_URL + f"/api/assets/group/{MIX_GROUP_ID}"
-    resp = requests.request("GET", url, headers=AUTH_HEADERS, data={})
-    df_veiculos = pd.json_normalize(resp.json())
-
-    batch_size = 150
-    n_batches = (df_veiculos.shape[0] // batch_size) + 1
-    erros = []
-
-    # Eventos que tenho que baixar
-    df_eventos = pd.read_sql('SELECT * FROM tipos_eventos_api tbl WHERE tbl."Baixar" = True', pg_engine)
-
-    # Para cada evento que eu quero baixar, vou fazer um loop
     for _, row in df_eventos.iterrows():
         event_id = row["EventTypeId"]
         event_name = row["DescriptionCLEAN"]
 
-        print("PROCESSANDO O EVENTO", event_id, event_name)
-
         # A tabela que iremos inserir
         tbl_name = event_name
 
@@ -229,81 +132,98 @@ def main(data_baixar):
         metadata = MetaData()
         event_table = Table(tbl_name, metadata, autoload_with=pg_engine)
 
-        # Descobre quais colunas são booleanas no banco
-        boolean_columns = [
-            c.name for c in event_table.columns
-            if hasattr(c.type, '__visit_name__') and c.type.__visit_name__ == 'boolean'
-        ]
+        # Carga em lote (COPY + INSERT ... ON CONFLICT), trata os tipos das colunas da tabela
+        carregador = EventBulkLoader(pg_engine, event_table)
 
-        i = 0
-        while i < n_batches:
-            # Pega datas
-            datahoje = dt.datetime.now()
-            if data_baixar:
-                datahoje = pd.to_datetime(data_baixar)
+        # Lê apenas as colunas da tabela, direto da resposta (streaming)
+        leitor = StreamingColumnReader(tbl_existing_columns, get_colunas_float(event_table))
 
-            dataontem = datahoje - dt.timedelta(days=1)
+        eventos.append((event_id, event_name, carregador, leitor))
 
-            # Printa informações do batch
-            print(datahoje, event_name, f"Batch {i+1} / {n_batches} valores de {i*batch_size} até {(i+1)*batch_size}")
+    return eventos
+
+
+# Baixa os eventos do dia (datahoje é o fim do intervalo), retorna a lista de erros
+# No backfill, os veículos já concluídos são pulados, cada lote salvo é registrado no checkpoint
+# e o ritmo é dado pelo limitador (compartilhado entre os dias) ao invés da pausa fixa entre lotes
+# Com lookback_minutos, cada veículo baixa apenas o intervalo que ainda falta (marcas d'água) mais o lookback
+def baixa_dia(datahoje, df_veiculos, eventos, checkpoint=None, limitador=None, lookback_minutos=None):
+    batch_size = 150
+    erros = []
+    dia = pd.to_datetime(datahoje).date()
+    dataontem = datahoje - dt.timedelta(days=1)
+
+    # Para cada evento que eu quero baixar, vou fazer um loop
+    for event_id, event_name, carregador, leitor in eventos:
+        print("PROCESSANDO O EVENTO", event_id, event_name)
+
+        veiculos = df_veiculos["AssetId"].values
+        if checkpoint is not None:
+            veiculos = checkpoint.get_pendentes(dia, veiculos, event_id)
+
+        # Intervalo que falta baixar de cada veículo (marcas d'água da tabela do evento) ou a janela completa
+        janelas = [(dataontem, veiculos)]
+        if lookback_minutos is not None:
+            marcas = HighWaterMarks(pg_engine, event_name, "StartDateTime", lookback_minutos)
+            janelas = marcas.get_janelas(veiculos, dataontem, datahoje)
+
+        lotes = divide_em_lotes(janelas, batch_size)
+        n_batches = len(lotes)
 
+        i = 0
+        while i < n_batches:
             # Pega dados do batch
-            asset_ids = df_veiculos["AssetId"].values[i * batch_size : (i + 1) * batch_size]
+            inicio_janela, asset_ids = lotes[i]
+
+            # Printa informações do batch
+            print(datahoje, event_name, f"Batch {i+1} / {n_batches} a partir de {inicio_janela}")
             print(datahoje, event_name, f"Tamanho do batch: {len(asset_ids)}")
 
             try:
-                # Autentica novamente para evitar timeout
-                authenticate()
+                # Autentica novamente para evitar timeout (renova apenas se o token estiver perto de expirar)
+                cliente_mix.autentica()
+
+                if limitador is not None:
+                    limitador.adquire()
 
-                response = download_evento(asset_ids, event_id, dataontem, datahoje)
+                response = download_evento(asset_ids, event_id, inicio_janela, datahoje)
 
                 # Resposta está OK?
                 if response.status_code == 200:
-                    # Ajusta o dado no pandas
-                    df_evt = pd.json_normalize(response.json())
-                    df_evt.columns = df_evt.columns.str.replace(".", "_")
+                    if limitador is not None:
+                        limitador.sucesso()
 
-                    # Remove colunas que não existem na tabela se tbl_existing_columns não for vazio
-                    if tbl_existing_columns:
-                        # Filter existing_columns to include only columns that are actually in df_evt
-                        tbl_filtered_columns = [col for col in tbl_existing_columns if col in df_evt.columns]
+                    # Ajusta o dado no pandas (apenas as colunas que existem na tabela)
+                    df_filtered = leitor.le(response)
 
-                        df_filtered = df_evt[tbl_filtered_columns]
-                    else:
-                        df_filtered = df_evt
+                    # Salva no banco (NaN -> NULL, booleanos NaN -> False, registros inválidos vão para a quarentena)
+                    pg_engine.dispose()
+                    num_inseridos, num_quarentena = carregador.carrega(df_filtered)
+                    if num_quarentena > 0:
+                        erros.append((datahoje, event_name, "BATCH", i + 1, "QUARENTENA", num_quarentena))
 
-                    # Converte NaN para False somente nas colunas booleanas
-                    for col in boolean_columns:
-                        if col in df_filtered.columns:
-                            df_filtered[col] = df_filtered[col].fillna(False).astype(bool)
+                    # Registra o lote no checkpoint (backfill)
+                    if checkpoint is not None:
+                        checkpoint.marca_concluidos(dia, asset_ids, event_id, df_filtered.shape[0])
 
-                    # Salva no banco
-                    pg_engine.dispose()
-                    with pg_engine.begin() as conn:
-                        raw_records = df_filtered.to_dict(orient="records")
-
-                        for registro in raw_records:
-                            try:
-                                registro_limpo = clean_record(registro, event_table)
-                                stmt = insert(event_table).values(registro_limpo)
-                                stmt = stmt.on_conflict_do_nothing(index_elements=["EventTypeId", "EventId", "DriverId", "AssetId"])
-                                conn.execute(stmt)
-                            except Exception as e:
-                                print(f"[ERRO] Linha {registro} causou erro: {e}")
-                                erros.append(("registro", registro, "erro", e))
-                        
                     # Printa informações da operação
-                    print(datahoje, event_name, "SALVAMOS ", df_filtered.shape[0], " REGISTROS")
+                    print(datahoje, event_name, "SALVAMOS ", num_inseridos, " REGISTROS NOVOS DE ", df_filtered.shape[0])
+                elif limitador is not None and response.status_code in STATUS_SOBRECARGA:
+                    # API sobrecarregada, diminui o ritmo de todos os dias e tenta o lote novamente
+                    print(datahoje, event_name, "API SOBRECARREGADA", response.status_code)
+                    limitador.sobrecarga(get_retry_after(response))
+                    response.close()
+                    continue
 
                 # Deu erro de autenticação? Vamos tentar novamente
                 if response.status_code == 401:
-                    authenticate()
+                    cliente_mix.autentica(forcar=True)
                     print(datahoje, event_name, "DEU 401")
                     continue
             except requests.exceptions.Timeout as te:
                 print(datahoje, event_name, "DEU TIMEOUT")
                 time.sleep(10)
-                authenticate()
+                cliente_mix.autentica()
                 continue
             except Exception as e:
                 print("Erro no batch", e)
@@ -312,13 +232,177 @@ def main(data_baixar):
             print(datahoje, event_name, "TERMINAMOS O BATCH", i + 1)
             # Incrementa o batch
             i += 1
-            time.sleep(15)
+            if limitador is None:
+                time.sleep(15)
             # Limpa a memória
             gc.collect()
 
         print("TERMINAMOS O EVENTO", event_name)
         print("NUMERO DE ERROS", erros)
 
+    return erros
+
+
+# Modo paralelo: baixa os eventos do dia pedindo vários tipos de eventos por requisição
+# - A resposta é separada por EventTypeId e cada parte é salva na tabela do seu evento
+# - Os lotes de veículos de um grupo de tipos são baixados ao mesmo tempo, sob o mesmo limitador de requisições
+# - Os grupos de tipos são processados um após o outro, retorna a lista de erros
+# - Com lookback_minutos, cada veículo baixa a partir da menor marca d'água entre as tabelas do grupo (ou a janela
+#   completa se não tiver marca em alguma delas)
+def baixa_dia_paralelo(
+    datahoje, df_veiculos, eventos, tipos_por_requisicao, checkpoint=None, limitador=None, lookback_minutos=None
+):
+    erros = []
+    dia = pd.to_datetime(datahoje).date()
+    dataontem = datahoje - dt.timedelta(days=1)
+
+    if limitador is None:
+        limitador = AdaptiveRateLimiter()
+
+    for inicio in range(0, len(eventos), max(1, tipos_por_requisicao)):
+        grupo = eventos[inicio : inicio + max(1, tipos_por_requisicao)]
+        event_ids = [int(event_id) for event_id, _, _, _ in grupo]
+        eventos_por_id = {int(event_id): (event_name, carregador, leitor) for event_id, event_name, carregador, leitor in grupo}
+        print(datahoje, "PROCESSANDO OS EVENTOS", [event_name for _, event_name, _, _ in grupo])
+
+        # Um único leitor com as colunas de todas as tabelas do grupo (e o EventTypeId para separar a resposta)
+        colunas = ["EventTypeId"]
+        colunas_float = set()
+        for _, _, leitor in eventos_por_id.values():
+            colunas.extend(c for c in leitor.colunas if c not in colunas)
+            colunas_float.update(leitor.colunas_float)
+        leitor_grupo = StreamingColumnReader(colunas, colunas_float)
+
+        # Veículos que ainda faltam em algum dos tipos do grupo
+        veiculos = df_veiculos["AssetId"].values
+        if checkpoint is not None:
+            pendentes = set()
+            for event_id in event_ids:
+                pendentes.update(checkpoint.get_pendentes(dia, veiculos, event_id))
+            veiculos = [asset_id for asset_id in veiculos if asset_id in pendentes]
+
+        # Salva um lote (já lido da resposta pelo fetcher), retorna o número de registros recebidos
+        def salva_lote(asset_ids, df_evt):
+            num_registros = df_evt.shape[0]
+
+            if "EventTypeId" in df_evt.columns:
+                df_evt = df_evt[df_evt["EventTypeId"].notna()]
+
+                for event_type_id, df_tipo in df_evt.groupby("EventTypeId"):
+                    if int(event_type_id) not in eventos_por_id:
+                        continue
+
+                    event_name, carregador, leitor = eventos_por_id[int(event_type_id)]
+
+                    # Apenas as colunas da tabela do evento que vieram preenchidas para esse tipo
+                    df_filtered = df_tipo[[c for c in leitor.colunas if c in df_tipo.columns]].dropna(axis=1, how="all")
+
+                    # Salva no banco (NaN -> NULL, booleanos NaN -> False, registros inválidos vão para a quarentena)
+                    num_inseridos, num_quarentena = carregador.carrega(df_filtered)
+                    if num_quarentena > 0:
+                        erros.append((datahoje, event_name, "LOTE", len(asset_ids), "QUARENTENA", num_quarentena))
+
+                    # Printa informações da operação
+                    print(datahoje, event_name, "SALVAMOS ", num_inseridos, " REGISTROS NOVOS DE ", df_filtered.shape[0])
+
+            # Registra o lote no checkpoint (backfill), para todos os tipos do grupo
+            if checkpoint is not None:
+                for event_id in event_ids:
+                    checkpoint.marca_concluidos(dia, asset_ids, event_id, num_registros)
+
+            # Limpa a memória
+            gc.collect()
+
+            return num_registros
+
+        # Intervalo que falta baixar de cada veículo (os tipos do grupo são baixados juntos) ou a janela completa
+        janelas = [(dataontem, veiculos)]
+        if lookback_minutos is not None:
+            nomes = [event_name for event_name, _, _ in eventos_por_id.values()]
+            marcas = HighWaterMarks(pg_engine, nomes, "StartDateTime", lookback_minutos)
+            janelas = marcas.get_janelas(veiculos, dataontem, datahoje)
+
+        dimensionador = AdaptiveBatchSizer(tamanho=TAMANHO_LOTE_INICIAL, tamanho_maximo=TAMANHO_LOTE_MAXIMO)
+        for inicio_janela, veiculos_janela in janelas:
+            fetcher = ConcurrentAssetFetcher(
+                lambda asset_ids: download_eventos(asset_ids, event_ids, inicio_janela, datahoje),
+                cliente_mix.autentica,
+                funcao_le=leitor_grupo.le,
+                limitador=limitador,
+                dimensionador=dimensionador,
+            )
+            erros.extend(fetcher.executa(veiculos_janela, salva_lote))
+
+    return erros
+
+
+@click.command()
+@click.option("--data_baixar", type=str, help="Data que irei baixar")
+@click.option("--backfill_inicio", type=str, help="Backfill: primeiro dia que irei baixar (retoma do checkpoint)")
+@click.option("--backfill_fim", type=str, help="Backfill: último dia que irei baixar (padrão: hoje)")
+@click.option("--dias_paralelos", type=int, default=DIAS_PARALELOS, help="Backfill: dias baixados ao mesmo tempo")
+@click.option("--requisicoes_por_segundo", type=float, default=REQUISICOES_POR_SEGUNDO, help="Backfill: orçamento da API")
+@click.option("--paralelo", is_flag=True, help="Vários tipos de eventos por requisição e lotes baixados ao mesmo tempo")
+@click.option("--tipos_por_requisicao", type=int, default=TIPOS_POR_REQUISICAO, help="Modo paralelo: tipos por requisição")
+@click.option("--lookback_minutos", type=int, default=LOOKBACK_MINUTOS, help="Baixa novamente dados atrasados nesse intervalo")
+@click.option("--janela_completa", is_flag=True, help="Ignora as marcas d'água e baixa a janela completa do dia")
+def main(
+    data_baixar,
+    backfill_inicio,
+    backfill_fim,
+    dias_paralelos,
+    requisicoes_por_segundo,
+    paralelo,
+    tipos_por_requisicao,
+    lookback_minutos,
+    janela_completa,
+):
+    cliente_mix.autentica()
+
+    # Lista de Veículos
+    df_veiculos = pd.json_normalize(cliente_mix.get_veiculos())
+
+    # Eventos que tenho que baixar
+    df_eventos = pd.read_sql('SELECT * FROM tipos_eventos_api tbl WHERE tbl."Baixar" = True', pg_engine)
+    eventos = prepara_eventos(df_eventos)
+
+    if backfill_inicio:
+        # Backfill: vários dias em paralelo, todos compartilhando o mesmo orçamento de requisições
+        checkpoint = BackfillCheckpoint(pg_engine, "mix_down_evt")
+        checkpoint.cria_tabela()
+        limitador = AdaptiveRateLimiter(
+            taxa=min(TAXA_INICIAL, requisicoes_por_segundo),
+            taxa_minima=min(TAXA_MINIMA, requisicoes_por_segundo),
+            taxa_maxima=requisicoes_por_segundo,
+        )
+
+        # Baixa um dia (no modo escolhido)
+        def baixa_dia_backfill(dia):
+            if paralelo:
+                return baixa_dia_paralelo(
+                    pd.to_datetime(dia), df_veiculos, eventos, tipos_por_requisicao, checkpoint, limitador
+                )
+            return baixa_dia(pd.to_datetime(dia), df_veiculos, eventos, checkpoint, limitador)
+
+        dias = get_dias_backfill(backfill_inicio, backfill_fim or dt.date.today())
+        erros = executa_dias_em_paralelo(dias, baixa_dia_backfill, dias_paralelos)
+    else:
+        # Pega datas
+        datahoje = dt.datetime.now()
+        if data_baixar:
+            datahoje = pd.to_datetime(data_baixar)
+
+        # Marcas d'água: maior StartDateTime já salvo de cada veículo
+        if janela_completa:
+            lookback_minutos = None
+
+        if paralelo:
+            erros = baixa_dia_paralelo(
+                datahoje, df_veiculos, eventos, tipos_por_requisicao, lookback_minutos=lookback_minutos
+            )
+        else:
+            erros = baixa_dia(datahoje, df_veiculos, eventos, lookback_minutos=lookback_minutos)
+
     # Imprime os erros
     print("NUMERO DE ERROS", len(erros))
     print("ERROS -------------------")
@@ -326,7 +410,6 @@ def main(data_baixar):
         print(e)
 
 
-
 if __name__ == "__main__":
     # Executa com Logger
     with ExecutionLogger(pg_engine, "mix_down_evt"):
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Cliente da API MiX Integrate compartilhado pelos scripts de download
+# - Uma única requests.Session (keep-alive, pool de conexões HTTP e gzip)
+# - Token salvo em disco e compartilhado entre processos (lock com fcntl), renovado antes de expirar
+# - Métodos para posições, eventos, trips, veículos (assets), motoristas e tipos de eventos
+#
+# Cada pasta de script possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports de sistema
+import os
+import json
+import time
+import fcntl
+import tempfile
+import threading
+
+# Requests
+import requests
+from requests.adapters import HTTPAdapter
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Arquivo onde o token é compartilhado entre processos
+MIX_TOKEN_CACHE = os.getenv("MIX_TOKEN_CACHE", os.path.join(tempfile.gettempdir(), "mix_token.json"))
+
+# Renova o token quando faltar menos que isso (segundos) para expirar
+MARGEM_RENOVACAO_TOKEN_SEGUNDOS = 300
+
+# Validade assumida caso a resposta não informe expires_in (segundos)
+VALIDADE_PADRAO_TOKEN_SEGUNDOS = 3000
+
+# Tamanho do pool de conexões HTTP
+TAMANHO_POOL_CONEXOES = 10
+
+# Formato das datas na URL da API
+FORMATO_DATA_API = "%Y%m%d%H%M%S"
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class MixClient(object):
+    # Construtor, por padrão lê as credenciais das variáveis de ambiente
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, arquivo_token=MIX_TOKEN_CACHE, tamanho_pool=TAMANHO_POOL_CONEXOES):
+        self.identity_url = os.getenv("MIX_API_IDENTITY_URL")
+        self.api_url = os.getenv("MIX_API_URL")
+        self.username = os.getenv("MIX_USERNAME")
+        self.password = os.getenv("MIX_PASSWORD")
+        self.api_username = os.getenv("MIX_API_USERNAME")
+        self.api_password = os.getenv("MIX_API_PASSWORD")
+        self.group_id = os.getenv("MIX_GROUP_ID")
+
+        self.arquivo_token = arquivo_token      # Cache do token em disco (compartilhado entre processos)
+        self.token = None                       # Token atual
+        self.expira_em = 0                      # Momento (epoch) em que o token expira
+        self.lock = threading.Lock()            # Lock entre threads do mesmo processo
+
+        # Sessão HTTP persistente (keep-alive, pool de conexões, gzip)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=tamanho_pool, pool_maxsize=tamanho_pool)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    # fmt: on
+
+    ###################################################################################
+    # Autenticação
+    ###################################################################################
+
+    # Garante um token válido, forcar=True obtém um novo token (ex: após um 401)
+    def autentica(self, forcar=False):
+        with self.lock:
+            if not forcar and self.__token_valido(self.token, self.expira_em):
+                return self.token
+
+            with open(self.arquivo_token + ".lock", "a") as arquivo_lock:
+                fcntl.flock(arquivo_lock, fcntl.LOCK_EX)
+                try:
+                    # Outro processo pode ter renovado o token enquanto esperávamos o lock
+                    token, expira_em = self.__le_token_disco()
+                    if token is not None and token != self.token and self.__token_valido(token, expira_em):
+                        self.token, self.expira_em = token, expira_em
+                    elif not forcar and self.__token_valido(token, expira_em):
+                        self.token, self.expira_em = token, expira_em
+                    else:
+                        self.token, self.expira_em = self.__solicita_token()
+                        self.__salva_token_disco(self.token, self.expira_em)
+                finally:
+                    fcntl.flock(arquivo_lock, fcntl.LOCK_UN)
+
+            return self.token
+
+    def get_headers(self, json_body=False):
+        headers = {"Authorization": f"Bearer {self.autentica()}"}
+        if json_body:
+            headers["Content-Type"] = "application/json"
+        return headers
+
+    def __token_valido(self, token, expira_em):
+        return token is not None and time.time() < expira_em - MARGEM_RENOVACAO_TOKEN_SEGUNDOS
+
+    def __solicita_token(self):
+        response = self.session.post(
+            self.identity_url + "/core/connect/token",
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            data={
+                "grant_type": "password",
+                "username": self.username,
+                "password": self.password,
+                "scope": "offline_access MiX.Integrate",
+            },
+            auth=(self.api_username, self.api_password),
+            timeout=60,
+        )
+
+        if response.status_code != 200:
+            raise Exception(f"Auth failed: {response.status_code} - {response.text}")
+
+        try:
+            data = response.json()
+        except Exception:
+            raise Exception(f"Invalid JSON returned: {response.text}")
+
+        if "access_token" not in data:
+            raise Exception(f"No access_token in response: {data}")
+
+        print("Novo token da Mix obtido")
+        validade = data.get("expires_in", VALIDADE_PADRAO_TOKEN_SEGUNDOS)
+        return data["access_token"], time.time() + float(validade)
+
+    def __le_token_disco(self):
+        try:
+            with open(self.arquivo_token) as arquivo:
+                dados = json.load(arquivo)
+            return dados["access_token"], float(dados["expira_em"])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None, 0
+
+    # Escrita atômica (arquivo temporário + rename), legível apenas pelo usuário
+    def __salva_token_disco(self, token, expira_em):
+        diretorio = os.path.dirname(os.path.abspath(self.arquivo_token))
+        fd, caminho_tmp = tempfile.mkstemp(dir=diretorio, prefix=".mix_token_")
+        try:
+            with os.fdopen(fd, "w") as arquivo:
+                json.dump({"access_token": token, "expira_em": expira_em}, arquivo)
+            os.chmod(caminho_tmp, 0o600)
+            os.replace(caminho_tmp, self.arquivo_token)
+        finally:
+            if os.path.exists(caminho_tmp):
+                os.remove(caminho_tmp)
+
+    ###################################################################################
+    # Requisições
+    ###################################################################################
+
+    # Requisição autenticada, em caso de 401 renova o token e tenta mais uma vez
+    # stream=True não lê o corpo da resposta (ver mix_stream.StreamingColumnReader)
+    def requisicao(self, metodo, caminho, json_body=None, timeout=300, stream=False):
+        data = json.dumps(json_body) if json_body is not None else None
+
+        response = self.session.request(
+            metodo,
+            self.api_url + caminho,
+            headers=self.get_headers(data is not None),
+            data=data,
+            timeout=timeout,
+            stream=stream,
+        )
+        if response.status_code == 401:
+            response.close()
+            self.autentica(forcar=True)
+            response = self.session.request(
+                metodo,
+                self.api_url + caminho,
+                headers=self.get_headers(data is not None),
+                data=data,
+                timeout=timeout,
+                stream=stream,
+            )
+
+        return response
+
+    # Veículos (assets) do grupo
+    def get_veiculos(self):
+        return self.requisicao("GET", f"/api/assets/group/{self.group_id}").json()
+
+    # Motoristas da organização
+    def get_motoristas(self):
+        return self.requisicao("GET", f"/api/drivers/organisation/{self.group_id}").json()
+
+    # Tipos de eventos (library events) da organização
+    def get_tipos_eventos(self):
+        return self.requisicao("GET", f"/api/libraryevents/organisation/{self.group_id}").json()
+
+    # Posições GPS dos veículos no intervalo
+    def get_posicoes(self, asset_ids, data_inicio, data_fim, timeout=600, stream=False):
+        caminho = f"/api/positions/assets/from/{data_inicio.strftime(FORMATO_DATA_API)}/to/{data_fim.strftime(FORMATO_DATA_API)}"
+        return self.requisicao("POST", caminho, list(map(int, asset_ids)), timeout, stream)
+
+    # Eventos (event_type_ids) dos veículos no intervalo
+    def get_eventos(self, asset_ids, event_type_ids, data_inicio, data_fim, timeout=300, stream=False):
+        caminho = f"/api/events/assets/from/{data_inicio.strftime(FORMATO_DATA_API)}/to/{data_fim.strftime(FORMATO_DATA_API)}"
+        payload = {"EntityIds": list(map(int, asset_ids)), "EventTypeIds": list(map(int, event_type_ids)), "MenuId": "string"}
+        return self.requisicao("POST", caminho, payload, timeout, stream)
+
+    # Trips (com sub trips) dos veículos no intervalo
+    def get_trips(self, asset_ids, data_inicio, data_fim, timeout=600, stream=False):
+        caminho = f"/api/trips/assets/from/{data_inicio.strftime(FORMATO_DATA_API)}/to/{data_fim.strftime(FORMATO_DATA_API)}?includeSubTrips=True"
+        return self.requisicao("POST", caminho, list(map(int, asset_ids)), timeout, stream)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Download concorrente de dados da API da Mix por lotes de veículos
+# - Vários lotes em paralelo (threads), compartilhando a mesma requests.Session
+# - Ritmo controlado por um token bucket que reduz a taxa em respostas 429/5xx (respeitando o Retry-After)
+#   e a aumenta gradualmente enquanto as respostas são bem sucedidas
+# - O tamanho do lote aumenta ou diminui conforme a latência (requisição + leitura do corpo) e o tamanho da resposta
+# - O corpo da resposta é lido (funcao_le, ex: StreamingColumnReader.le) na própria thread do download, erros de rede
+#   durante a leitura (timeout, conexão interrompida) fazem o lote ser baixado novamente
+# - Os dados lidos são processados (ex: salvos no banco) na thread que chamou executa(), um lote por vez
+#
+# Cada pasta de script possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import time
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Requests
+import requests
+import urllib3
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Número máximo de lotes em andamento
+MAX_LOTES_EM_ANDAMENTO = 4
+
+# Taxa de requisições (por segundo)
+TAXA_INICIAL = 0.5
+TAXA_MINIMA = 0.05
+TAXA_MAXIMA = 2.0
+
+# Tamanho do lote (número de veículos)
+TAMANHO_LOTE_INICIAL = 20
+TAMANHO_LOTE_MINIMO = 5
+TAMANHO_LOTE_MAXIMO = 80
+
+# Latência (segundos) e número de registros alvo por resposta
+LATENCIA_ALVO_SEGUNDOS = 30
+MAX_REGISTROS_RESPOSTA = 500000
+
+# Número máximo de tentativas de um lote
+MAX_TENTATIVAS_LOTE = 3
+
+# Status que indicam sobrecarga da API
+STATUS_SOBRECARGA = [429, 500, 502, 503, 504]
+
+# Erros de rede (na requisição ou na leitura do corpo em streaming) que fazem o lote ser baixado novamente
+ERROS_REDE = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError)
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Tempo (segundos) pedido pela API no cabeçalho Retry-After, se houver
+def get_retry_after(response):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+###################################################################################
+# Classes
+###################################################################################
+
+
+class AdaptiveRateLimiter(object):
+    # Token bucket com taxa adaptativa (redução multiplicativa, aumento aditivo)
+    def __init__(self, taxa=TAXA_INICIAL, taxa_minima=TAXA_MINIMA, taxa_maxima=TAXA_MAXIMA, capacidade=1):
+        self.taxa = taxa
+        self.taxa_minima = taxa_minima
+        self.taxa_maxima = taxa_maxima
+        self.capacidade = capacidade
+
+        self.tokens = capacidade
+        self.ultimo = time.monotonic()
+        self.pausado_ate = 0
+        self.lock = threading.Lock()
+
+    # Aguarda até existir um token disponível
+    def adquire(self):
+        while True:
+            with self.lock:
+                agora = time.monotonic()
+                self.tokens = min(self.capacidade, self.tokens + (agora - self.ultimo) * self.taxa)
+                self.ultimo = agora
+
+                if agora >= self.pausado_ate and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                espera = max(self.pausado_ate - agora, (1 - self.tokens) / self.taxa)
+
+            time.sleep(espera)
+
+    # Resposta bem sucedida, aumenta a taxa aos poucos
+    def sucesso(self):
+        with self.lock:
+            self.taxa = min(self.taxa_maxima, self.taxa + 0.05)
+
+    # API sobrecarregada (429/5xx), reduz a taxa pela metade e pausa pelo Retry-After (se houver)
+    def sobrecarga(self, retry_after=None):
+        with self.lock:
+            self.taxa = max(self.taxa_minima, self.taxa / 2)
+            self.tokens = 0
+            if retry_after is not None:
+                self.pausado_ate = max(self.pausado_ate, time.monotonic() + retry_after)
+
+
+class AdaptiveBatchSizer(object):
+    # Ajusta o tamanho do lote conforme a latência e o número de registros da resposta
+    # fmt: off
+    def __init__(
+        self,
+        tamanho=TAMANHO_LOTE_INICIAL,
+        tamanho_minimo=TAMANHO_LOTE_MINIMO,
+        tamanho_maximo=TAMANHO_LOTE_MAXIMO,
+        latencia_alvo=LATENCIA_ALVO_SEGUNDOS,
+        max_registros=MAX_REGISTROS_RESPOSTA,
+    ):
+        self.tamanho = tamanho                  # Tamanho atual do lote
+        self.tamanho_minimo = tamanho_minimo    # Menor lote permitido
+        self.tamanho_maximo = tamanho_maximo    # Maior lote permitido
+        self.latencia_alvo = latencia_alvo      # Latência desejada por requisição
+        self.max_registros = max_registros      # Número máximo desejado de registros por resposta
+        self.lock = threading.Lock()
+    # fmt: on
+
+    def get_tamanho(self):
+        with self.lock:
+            return self.tamanho
+
+    def ajusta(self, latencia, num_registros):
+        with self.lock:
+            if latencia > self.latencia_alvo or num_registros > self.max_registros:
+                self.tamanho = max(self.tamanho_minimo, self.tamanho // 2)
+            elif latencia < self.latencia_alvo / 2 and num_registros < self.max_registros / 2:
+                self.tamanho = min(self.tamanho_maximo, self.tamanho + max(1, self.tamanho // 4))
+
+    # Timeout ou sobrecarga, diminui o lote
+    def reduz(self):
+        with self.lock:
+            self.tamanho = max(self.tamanho_minimo, self.tamanho // 2)
+
+
+class ConcurrentAssetFetcher(object):
+    # fmt: off
+    def __init__(
+        self,
+        funcao_download,
+        funcao_autenticar,
+        funcao_le=None,
+        max_lotes=MAX_LOTES_EM_ANDAMENTO,
+        limitador=None,
+        dimensionador=None,
+        max_tentativas=MAX_TENTATIVAS_LOTE,
+    ):
+        self.funcao_download = funcao_download                  # funcao_download(asset_ids) -> requests.Response
+        self.funcao_autenticar = funcao_autenticar              # funcao_autenticar(forcar=False), na thread de executa()
+        self.funcao_le = funcao_le                              # funcao_le(response) -> dados, na thread do download
+        self.max_lotes = max_lotes                              # Lotes em andamento ao mesmo tempo
+        self.limitador = limitador or AdaptiveRateLimiter()     # Token bucket
+        self.dimensionador = dimensionador or AdaptiveBatchSizer()
+        self.max_tentativas = max_tentativas                    # Tentativas antes de desistir de um lote
+    # fmt: on
+
+    # Baixa os dados de todos os veículos, chamando processa_resposta(asset_ids, dados) para cada lote
+    # dados é o retorno de funcao_le(response) ou a própria resposta se funcao_le não foi informada
+    # Retorna a lista de erros (lotes que não puderam ser baixados ou processados)
+    def executa(self, asset_ids, processa_resposta):
+        pendentes = deque((asset_id, 0) for asset_id in asset_ids)  # (veículo, tentativas)
+        erros = []
+
+        with ThreadPoolExecutor(max_workers=self.max_lotes) as executor:
+            em_andamento = dict()
+
+            while pendentes or em_andamento:
+                # Mantém até max_lotes lotes em andamento
+                while pendentes and len(em_andamento) < self.max_lotes:
+                    self.funcao_autenticar()
+
+                    lote = [pendentes.popleft() for _ in range(min(self.dimensionador.get_tamanho(), len(pendentes)))]
+                    futuro = executor.submit(self.__baixa, [asset_id for asset_id, _ in lote])
+                    em_andamento[futuro] = lote
+
+                concluidos, _ = wait(list(em_andamento.keys()), return_when=FIRST_COMPLETED)
+
+                for futuro in concluidos:
+                    lote = em_andamento.pop(futuro)
+                    lote_ids = [asset_id for asset_id, _ in lote]
+
+                    try:
+                        response, dados, latencia = futuro.result()
+                    except ERROS_REDE as e:
+                        print("Erro na requisição do lote", len(lote), e)
+                        self.dimensionador.reduz()
+                        self.__reenfileira(pendentes, lote, erros, e)
+                        continue
+                    except Exception as e:
+                        print("Erro ao ler o lote", e)
+                        erros.append((lote_ids, "ERRO", e))
+                        continue
+
+                    if response.status_code == 200:
+                        self.limitador.sucesso()
+                        try:
+                            num_registros = processa_resposta(lote_ids, dados)
+                            self.dimensionador.ajusta(latencia, num_registros or 0)
+                        except Exception as e:
+                            print("Erro ao processar o lote", e)
+                            erros.append((lote_ids, "ERRO", e))
+                    elif response.status_code in STATUS_SOBRECARGA:
+                        print("API sobrecarregada", response.status_code)
+                        self.limitador.sobrecarga(get_retry_after(response))
+                        self.dimensionador.reduz()
+                        self.__reenfileira(pendentes, lote, erros, response.status_code)
+                    elif response.status_code == 401:
+                        print("DEU 401")
+                        self.funcao_autenticar(forcar=True)
+                        self.__reenfileira(pendentes, lote, erros, response.status_code)
+                    else:
+                        print("Erro no lote", response.status_code)
+                        erros.append((lote_ids, "STATUS", response.status_code))
+
+                    # Libera a conexão (respostas em streaming que não foram lidas)
+                    response.close()
+
+        return erros
+
+    # Baixa e lê um lote, a latência inclui a leitura do corpo da resposta
+    def __baixa(self, asset_ids):
+        self.limitador.adquire()
+
+        inicio = time.monotonic()
+        response = self.funcao_download(asset_ids)
+
+        dados = response
+        if response.status_code == 200 and self.funcao_le is not None:
+            try:
+                dados = self.funcao_le(response)
+            finally:
+                response.close()
+
+        return response, dados, time.monotonic() - inicio
+
+    # Devolve o lote para a fila (no início) ou desiste após max_tentativas
+    def __reenfileira(self, pendentes, lote, erros, erro):
+        for asset_id, tentativas in reversed(lote):
+            if tentativas + 1 < self.max_tentativas:
+                pendentes.appendleft((asset_id, tentativas + 1))
+            else:
+                erros.append(([asset_id], "TENTATIVAS", erro))
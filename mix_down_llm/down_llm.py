@@ -68,6 +68,18 @@ def recriar_pg_engine():
     print("Recriando conexão com o banco de dados...")
     return create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}", pool_pre_ping=True)
 
+# Executa funcao(pg_engine), em caso de erro de conexão recria a conexão e tenta novamente uma vez
+# Único ponto em que a conexão global é recriada
+def executa_com_reconexao(funcao):
+    global pg_engine
+
+    try:
+        return funcao(pg_engine)
+    except OperationalError as e:
+        print(f"Erro de conexão detectado: {e}")
+        pg_engine = recriar_pg_engine()
+        return funcao(pg_engine)
+
 ###################################################################################
 # OpenAI
 ###################################################################################
@@ -388,6 +400,26 @@ def prepara_user_input_llm(problem, text_symptoms, text_mechanic):
 # Vamos processar dado de mês em mês
 ###################################################################################
 
+# Retorna o conjunto de KEY_HASH das OS do intervalo que já foram classificadas
+def get_keys_processadas(data_inicio_str, data_fim_str):
+    query = f"""
+        SELECT DISTINCT odc."KEY_HASH"
+        FROM 
+            os_dados_classificacao odc
+            JOIN os_dados od ON od."KEY_HASH" = odc."KEY_HASH"
+        WHERE 
+            od."DATA INICIO SERVIÇO" >= '{data_inicio_str}' AND od."DATA INICIO SERVIÇO" < '{data_fim_str}'
+    """
+
+    def le_keys(engine):
+        with engine.connect() as conn:
+            return pd.read_sql_query(query, conn)
+
+    df_os_classificada = executa_com_reconexao(le_keys)
+
+    return set(df_os_classificada["KEY_HASH"])
+
+
 def main():
     # Data de hoje (threshold)
     data_hoje = pd.to_datetime("now")
@@ -396,9 +428,6 @@ def main():
     data_intervalo_inicio = pd.to_datetime("2025-01-01")
     data_intervalo_fim = data_intervalo_inicio + pd.DateOffset(months=1)
 
-    # Use global pg_engine or pass it. It is global.
-    global pg_engine
-
     while data_intervalo_inicio < data_hoje:
         data_inicio_str = data_intervalo_inicio.strftime("%Y-%m-%d")
         data_fim_str = data_intervalo_fim.strftime("%Y-%m-%d")
@@ -428,7 +457,10 @@ def main():
             AND od."DATA INICIO SERVIÇO" >= '{data_inicio_str}' AND od."DATA INICIO SERVIÇO" < '{data_fim_str}'
         """
 
-        df = pd.read_sql_query(query, pg_engine)
+        df = executa_com_reconexao(lambda engine: pd.read_sql_query(query, engine))
+
+        # OS do intervalo que já foram classificadas (uma única query por mês)
+        keys_processadas = get_keys_processadas(data_inicio_str, data_fim_str)
 
         # Processar os dados
         df["COMPLEMENTO DO SERVICO"] = df["COMPLEMENTO DO SERVICO"].apply(formatar_texto)
@@ -453,31 +485,8 @@ def main():
             text_symptoms = row["UFG_SINTOMA"]
             text_mechanic = row["UFG_CORRECAO"]
 
-            # Vamos verifica se a OS já não foi processada
-            query = f"""
-                SELECT "KEY_HASH"
-                FROM 
-                    os_dados_classificacao 
-                WHERE 
-                    "KEY_HASH" = '{key}'
-            """
-
-            df_os_classificada = None
-            try:
-                with pg_engine.connect() as conn:
-                    df_os_classificada = pd.read_sql_query(query, conn)
-            except OperationalError as e:
-                print(f"Erro de conexão detectado: {e}")
-                num_errors += 1
-
-            # Houve erro de conexão, vamos recriar a conexão
-            if df_os_classificada is None:
-                pg_engine = recriar_pg_engine()
-                num_errors += 1
-                continue
-
             # Vamos ver se a OS ainda não foi processada
-            if df_os_classificada.empty:
+            if key not in keys_processadas:
                 print(f"OS: {num_os}", problem, text_symptoms, text_mechanic, key)
                 try:
                     # Prepara user_input
@@ -493,8 +502,13 @@ def main():
                     df_os_dado["DATA_ANALISE"] = pd.to_datetime("now").strftime("%Y-%m-%d %H:%M:%S")
 
                     # Vamos inserir os dados no banco de dados
-                    df_os_dado.to_sql("os_dados_classificacao", pg_engine, if_exists="append", index=False)
+                    executa_com_reconexao(
+                        lambda engine: df_os_dado.to_sql(
+                            "os_dados_classificacao", engine, if_exists="append", index=False
+                        )
+                    )
                     print("--> Dado inserido com sucesso 'os_dados_classificacao'.")
+                    keys_processadas.add(key)
                 except Exception as ex:
                     print(f"Houve um erro: {ex}")
                     num_errors += 1
@@ -13,16 +13,13 @@ import pandas as pd
 import time
 import sys
 
-# Import de datas
-import datetime as dt
-
-# Requests
-import requests
-
 # Banco de Dados
 from sqlalchemy import create_engine
 from execution_logger import ExecutionLogger
 
+# Cliente da Mix
+from mix_client import MixClient
+
 # DotEnv
 from dotenv import load_dotenv
 
@@ -53,59 +50,8 @@ DB_NAME = os.getenv("DB_NAME")
 # Criar a conexão com o SQLAlchemy
 pg_engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
 
-# Constantes
-MIX_API_IDENTITY_URL = os.getenv("MIX_API_IDENTITY_URL")
-MIX_API_URL = os.getenv("MIX_API_URL")
-MIX_USERNAME = os.getenv("MIX_USERNAME")
-MIX_PASSWORD = os.getenv("MIX_PASSWORD")
-MIX_API_USERNAME = os.getenv("MIX_API_USERNAME")
-MIX_API_PASSWORD = os.getenv("MIX_API_PASSWORD")
-MIX_GROUP_ID = os.getenv("MIX_GROUP_ID")
-
-###################################################################################
-# Autenticação
-###################################################################################
-
-payload = f"""
-grant_type=password&
-username={MIX_USERNAME}&
-password={MIX_PASSWORD}&
-scope=offline_access%20MiX.Integrate
-"""
-headers = {
-    "Content-Type": "application/x-www-form-urlencoded",
-}
-
-TOKEN = None
-AUTH_HEADERS = None
-AUTH_HEADERS_JSON = None
-ULTIMO_LOGIN = None
-
-
-def get_auth_token():
-    response = requests.request(
-        "POST",
-        MIX_API_IDENTITY_URL + "/core/connect/token",
-        headers=headers,
-        data=payload,
-        auth=(MIX_API_USERNAME, MIX_API_PASSWORD),
-    )
-    print(response.json())
-    return response.json()["access_token"]
-
-
-def authenticate():
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON, ULTIMO_LOGIN
-
-    if ULTIMO_LOGIN is None:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-    elif (dt.datetime.now() - ULTIMO_LOGIN).seconds > 3000:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-
-    AUTH_HEADERS = {"Authorization": f"Bearer {TOKEN}"}
-    AUTH_HEADERS_JSON = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+# Cliente da API da Mix (sessão persistente e token compartilhado entre processos)
+cliente_mix = MixClient()
 
 
 # Função que retorna os motoristas existentes no banco
@@ -126,13 +72,10 @@ def get_motoristas_existentes():
 
 
 def main():
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON
-    authenticate()
+    cliente_mix.autentica()
 
     # Lista de Motoristas
-    url = MIX_API_URL + f"/api/drivers/organisation/{MIX_GROUP_ID}"
-    resp = requests.request("GET", url, headers=AUTH_HEADERS, data={})
-    df_motoristas = pd.json_normalize(resp.json())
+    df_motoristas = pd.json_normalize(cliente_mix.get_motoristas())
 
     # Filtra os motoristas que ainda não existem no banco
     df_motoristas_existentes = get_motoristas_existentes()
@@ -13,7 +13,6 @@ import sys
 # Imports básicos
 import pandas as pd
 import time
-import json
 
 # CLI
 import click
@@ -30,6 +29,21 @@ from sqlalchemy import Table, MetaData
 from sqlalchemy.dialects.postgresql import insert
 from execution_logger import ExecutionLogger
 
+# Cliente da Mix
+from mix_client import MixClient
+
+# Download concorrente
+from mix_fetcher import ConcurrentAssetFetcher, AdaptiveRateLimiter, TAXA_INICIAL, TAXA_MINIMA
+
+# Download incremental (marcas d'água)
+from high_water_mark import HighWaterMarks, LOOKBACK_MINUTOS
+
+# Backfill
+from backfill_checkpoint import BackfillCheckpoint, get_dias_backfill, executa_dias_em_paralelo
+
+# Leitura em streaming das respostas
+from mix_stream import StreamingColumnReader, get_colunas_float
+
 # DotEnv
 from dotenv import load_dotenv
 
@@ -59,107 +73,163 @@ DB_NAME = os.getenv("DB_NAME")
 # Criar a conexão com o SQLAlchemy
 pg_engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
 
-# Constantes
-MIX_API_IDENTITY_URL = os.getenv("MIX_API_IDENTITY_URL")
-MIX_API_URL = os.getenv("MIX_API_URL")
-MIX_USERNAME = os.getenv("MIX_USERNAME")
-MIX_PASSWORD = os.getenv("MIX_PASSWORD")
-MIX_API_USERNAME = os.getenv("MIX_API_USERNAME")
-MIX_API_PASSWORD = os.getenv("MIX_API_PASSWORD")
-MIX_GROUP_ID = os.getenv("MIX_GROUP_ID")
+# Cliente da API da Mix (sessão persistente e token compartilhado entre processos)
+cliente_mix = MixClient()
 
 # Tabela
 metadata = MetaData()
 posicao_gps_table = Table("posicao_gps", metadata, autoload_with=pg_engine)
 
+# Tabela particionada por mês em ts (db_particiona_mix), ts também faz parte da chave de conflito
+TABELA_PARTICIONADA = "ts" in posicao_gps_table.columns
+CHAVES_CONFLITO_POSICAO = ["AssetId", "PositionId"] + (["ts"] if TABELA_PARTICIONADA else [])
+
+# Colunas da resposta que salvamos
+COLUNAS_POSICAO = [
+    "Timestamp",
+    "Longitude",
+    "Latitude",
+    "DriverId",
+    "AssetId",
+    "PositionId",
+    "OdometerKilometres",
+    "SpeedKilometresPerHour",
+]
+
 ###################################################################################
 # Autenticação
 ###################################################################################
 
-payload = f"""
-grant_type=password&
-username={MIX_USERNAME}&
-password={MIX_PASSWORD}&
-scope=offline_access%20MiX.Integrate
-"""
-headers = {
-    "Content-Type": "application/x-www-form-urlencoded",
-}
-
 AUTH_MAX_RETRIES = 3
 AUTH_RETRY_WAIT = 2 * 60 # minutes
-TOKEN = None
-AUTH_HEADERS = None
-AUTH_HEADERS_JSON = None
-ULTIMO_LOGIN = None
-
-
-def get_auth_token():
-    response = requests.request(
-        "POST",
-        MIX_API_IDENTITY_URL + "/core/connect/token",
-        headers=headers,
-        data=payload,
-        auth=(MIX_API_USERNAME, MIX_API_PASSWORD),
-    )
-    
-    if response.status_code != 200:
-        raise Exception(f"Auth failed: {response.status_code} - {response.text}")
 
-    data = None
-    try:
-        data = response.json()
-    except Exception:
-        raise Exception(f"Invalid JSON returned: {response.text}")
+###################################################################################
+# Backfill
+###################################################################################
 
-    if "access_token" not in data:
-        raise Exception(f"No access_token in response: {data}")
+# Dias baixados ao mesmo tempo
+DIAS_PARALELOS = 4
 
-    print(response.json())
-    return response.json()["access_token"]
+# Orçamento de requisições por segundo na API (somando todos os dias)
+REQUISICOES_POR_SEGUNDO = 1.0
 
 
-def authenticate():
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON, ULTIMO_LOGIN
+#### Download de Evento
+def download_posicao(asset_ids, data_inicio, data_fim):
+    return cliente_mix.get_posicoes(asset_ids, data_inicio, data_fim, timeout=600, stream=True)
 
-    if ULTIMO_LOGIN is None:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-    elif (dt.datetime.now() - ULTIMO_LOGIN).seconds > 3000:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
 
-    AUTH_HEADERS = {"Authorization": f"Bearer {TOKEN}"}
-    AUTH_HEADERS_JSON = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+# Baixa as posições do dia (datahoje é o fim do intervalo), retorna a lista de erros
+# No backfill, os veículos já concluídos são pulados e cada lote salvo é registrado no checkpoint
+# Com as marcas d'água, cada veículo baixa apenas o intervalo que ainda falta (mais o lookback)
+def baixa_dia(datahoje, asset_ids, tbl_existing_columns, checkpoint=None, limitador=None, marcas=None):
+    event_name = "posicao_gps"
+    dataontem = datahoje - dt.timedelta(days=1)
+    dia = pd.to_datetime(datahoje).date()
 
+    if checkpoint is not None:
+        asset_ids = checkpoint.get_pendentes(dia, asset_ids)
 
-#### Download de Evento
-def download_posicao(asset_ids, data_inicio, data_fim):
-    global AUTH_HEADERS_JSON
+    # Lê apenas as colunas que salvamos, direto da resposta (streaming)
+    leitor = StreamingColumnReader(
+        COLUNAS_POSICAO,
+        colunas_float=get_colunas_float(posicao_gps_table) + ["Longitude", "Latitude"],
+    )
 
-    # Datas
-    data_inicio_str = data_inicio.strftime("%Y%m%d%H%M%S")
-    data_final_str = data_fim.strftime("%Y%m%d%H%M%S")
+    # Salva um lote (já lido da resposta pelo fetcher), retorna o número de registros recebidos
+    def salva_lote(asset_ids, df_evt):
+        num_registros = df_evt.shape[0]
+
+        if df_evt.empty:
+            print(datahoje, event_name, "LOTE SEM REGISTROS", len(asset_ids))
+            if checkpoint is not None:
+                checkpoint.marca_concluidos(dia, asset_ids, num_registros_lote=num_registros)
+            return num_registros
+
+        df_evt = df_evt.reindex(columns=COLUNAS_POSICAO)
+
+        # Remove those that do not have valid Longitude and Latitude
+        df_evt = df_evt[
+            (df_evt["Longitude"].notna())
+            & (df_evt["Latitude"].notna())
+            & (df_evt["Longitude"] != 0)
+            & (df_evt["Latitude"] != 0)
+        ]
+
+        # Fill na
+        df_evt = df_evt.fillna({"OdometerKilometres": 0, "SpeedKilometresPerHour": 0})
+
+        # Coluna de partição (timestamptz), o PostgreSQL direciona o registro para a partição do mês
+        if TABELA_PARTICIONADA:
+            df_evt["ts"] = pd.to_datetime(df_evt["Timestamp"], utc=True, errors="coerce")
+            df_evt = df_evt[df_evt["ts"].notna()]
+
+        # Remove colunas que não existem na tabela se tbl_existing_columns não for vazio
+        df_filtered = df_evt
+        if tbl_existing_columns:
+            # Filter existing_columns to include only columns that are actually in df_evt
+            tbl_filtered_columns = [col for col in tbl_existing_columns if col in df_evt.columns]
+            df_filtered = df_evt[tbl_filtered_columns]
+
+        # Salva no banco
+        if not df_filtered.empty:
+            with pg_engine.begin() as conn:
+                # Faz o insert
+                stmt = insert(posicao_gps_table).values(df_filtered.to_dict(orient="records"))
+                stmt = stmt.on_conflict_do_nothing(index_elements=CHAVES_CONFLITO_POSICAO)
+                conn.execute(stmt)
+
+        # Printa informações da operação
+        print(datahoje, event_name, "SALVAMOS ", df_evt.shape[0], " REGISTROS DE ", len(asset_ids), " VEÍCULOS")
+
+        # Registra o lote no checkpoint (backfill)
+        if checkpoint is not None:
+            checkpoint.marca_concluidos(dia, asset_ids, num_registros_lote=num_registros)
 
-    # URL
-    url = MIX_API_URL + f"/api/positions/assets/from/{data_inicio_str}/to/{data_final_str}"
+        # Limpa a memória
+        gc.collect()
 
-    # Resposta
-    return requests.request(
-        "POST", url, headers=AUTH_HEADERS_JSON, data=json.dumps(list(map(int, asset_ids))), timeout=600
-    )
+        return num_registros
+
+    # Intervalo que falta baixar de cada veículo (marcas d'água) ou a janela completa
+    janelas = [(dataontem, asset_ids)]
+    if marcas is not None:
+        janelas = marcas.get_janelas(asset_ids, dataontem, datahoje)
+
+    # Mantém o ritmo da API entre as janelas
+    if limitador is None:
+        limitador = AdaptiveRateLimiter()
+
+    # Baixa vários lotes ao mesmo tempo, o ritmo e o tamanho dos lotes se ajustam conforme as respostas da API
+    erros = []
+    for inicio_janela, asset_ids_janela in janelas:
+        print(datahoje, f"POS Baixando {len(asset_ids_janela)} veículos a partir de {inicio_janela}")
+        fetcher = ConcurrentAssetFetcher(
+            lambda asset_ids: download_posicao(asset_ids, inicio_janela, datahoje),
+            cliente_mix.autentica,
+            funcao_le=leitor.le,
+            limitador=limitador,
+        )
+        erros.extend(fetcher.executa(asset_ids_janela, salva_lote))
+
+    return erros
 
 
 @click.command()
 @click.option("--data_baixar", type=str, help="Data que irei baixar")
-def main(data_baixar):
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON
-    
+@click.option("--backfill_inicio", type=str, help="Backfill: primeiro dia que irei baixar (retoma do checkpoint)")
+@click.option("--backfill_fim", type=str, help="Backfill: último dia que irei baixar (padrão: hoje)")
+@click.option("--dias_paralelos", type=int, default=DIAS_PARALELOS, help="Backfill: dias baixados ao mesmo tempo")
+@click.option("--requisicoes_por_segundo", type=float, default=REQUISICOES_POR_SEGUNDO, help="Backfill: orçamento da API")
+@click.option("--lookback_minutos", type=int, default=LOOKBACK_MINUTOS, help="Baixa novamente dados atrasados nesse intervalo")
+@click.option("--janela_completa", is_flag=True, help="Ignora as marcas d'água e baixa a janela completa do dia")
+def main(data_baixar, backfill_inicio, backfill_fim, dias_paralelos, requisicoes_por_segundo, lookback_minutos, janela_completa):
     # Tenta autenticar AUTH_MAX_RETRIES vezes
     for tentativa_autenticar in range(1, AUTH_MAX_RETRIES + 1):
         try:
-            authenticate()
-        except requests.exceptions.Timeout as te:
+            cliente_mix.autentica()
+            break
+        except requests.exceptions.Timeout as e:
             print(f"Falha na autenticação (tentativa {tentativa_autenticar + 1}): {e}")
             if tentativa_autenticar < AUTH_MAX_RETRIES - 1:
                 time.sleep(AUTH_RETRY_WAIT)
@@ -167,19 +237,11 @@ def main(data_baixar):
                 raise e
 
     # Lista de Veículos
-    url = MIX_API_URL + f"/api/assets/group/{MIX_GROUP_ID}"
-    resp = requests.request("GET", url, headers=AUTH_HEADERS, data={})
-    df_veiculos = pd.json_normalize(resp.json())
-
-    batch_size = 20
-    n_batches = (df_veiculos.shape[0] // batch_size) + 1
-    erros = []
-
-    # Vamos baixar cada batch
-    event_name = "posicao_gps"
+    df_veiculos = pd.json_normalize(cliente_mix.get_veiculos())
+    asset_ids = df_veiculos["AssetId"].values
 
     # A tabela que iremos inserir
-    tbl_name = event_name
+    tbl_name = "posicao_gps"
 
     # Step 1: Fetch existing columns from the target table
     tbl_query = f"""
@@ -189,93 +251,34 @@ def main(data_baixar):
     """
     tbl_existing_columns = pd.read_sql(tbl_query, pg_engine)["column_name"].tolist()
 
-    i = 0
-    while i < n_batches:
+    if backfill_inicio:
+        # Backfill: vários dias em paralelo, todos compartilhando o mesmo orçamento de requisições
+        checkpoint = BackfillCheckpoint(pg_engine, "mix_down_pos")
+        checkpoint.cria_tabela()
+        limitador = AdaptiveRateLimiter(
+            taxa=min(TAXA_INICIAL, requisicoes_por_segundo),
+            taxa_minima=min(TAXA_MINIMA, requisicoes_por_segundo),
+            taxa_maxima=requisicoes_por_segundo,
+        )
+
+        dias = get_dias_backfill(backfill_inicio, backfill_fim or dt.date.today())
+        erros = executa_dias_em_paralelo(
+            dias,
+            lambda dia: baixa_dia(pd.to_datetime(dia), asset_ids, tbl_existing_columns, checkpoint, limitador),
+            dias_paralelos,
+        )
+    else:
         # Pega datas
         datahoje = dt.datetime.today().date()
         if data_baixar:
             datahoje = pd.to_datetime(data_baixar)
-        dataontem = datahoje - dt.timedelta(days=1)
 
-        # Printa informações do batch
-        print(datahoje, f"POS Batch {i+1} / {n_batches} valores de {i*batch_size} até {(i+1)*batch_size}")
+        # Marcas d'água: maior Timestamp já salvo de cada veículo
+        marcas = None
+        if not janela_completa:
+            marcas = HighWaterMarks(pg_engine, "posicao_gps", "Timestamp", lookback_minutos)
 
-        # Pega dados do batch
-        asset_ids = df_veiculos["AssetId"].values[i * batch_size : (i + 1) * batch_size]
-        print(datahoje, f"POS Tamanho do batch: {len(asset_ids)}")
-
-        try:
-            # Autentica novamente para evitar timeout
-            authenticate()
-
-            response = download_posicao(asset_ids, dataontem, datahoje)
-
-            # Resposta está OK?
-            if response.status_code == 200:
-                # Ajusta o dado no pandas
-                df_evt = pd.json_normalize(response.json())
-                df_evt = df_evt[
-                    [
-                        "Timestamp",
-                        "Longitude",
-                        "Latitude",
-                        "DriverId",
-                        "AssetId",
-                        "PositionId",
-                        "OdometerKilometres",
-                        "SpeedKilometresPerHour",
-                    ]
-                ].copy()
-                df_evt.columns = df_evt.columns.str.replace(".", "_")
-
-                # Remove those that do not have valid Longitude and Latitude
-                df_evt = df_evt[
-                    (df_evt["Longitude"].notna())
-                    & (df_evt["Latitude"].notna())
-                    & (df_evt["Longitude"] != 0)
-                    & (df_evt["Latitude"] != 0)
-                ]
-
-                # Fill na
-                df_evt = df_evt.fillna({"OdometerKilometres": 0, "SpeedKilometresPerHour": 0})
-
-                # Remove colunas que não existem na tabela se tbl_existing_columns não for vazio
-                if tbl_existing_columns:
-                    # Filter existing_columns to include only columns that are actually in df_evt
-                    tbl_filtered_columns = [col for col in tbl_existing_columns if col in df_evt.columns]
-                    df_filtered = df_evt[tbl_filtered_columns]
-
-                # Salva no banco
-                pg_engine.dispose()
-                with pg_engine.begin() as conn:
-                    # Faz o insert
-                    stmt = insert(posicao_gps_table).values(df_filtered.to_dict(orient="records"))
-                    stmt = stmt.on_conflict_do_nothing(index_elements=["AssetId", "PositionId"])
-                    conn.execute(stmt)
-
-                # Printa informações da operação
-                print(datahoje, event_name, "SALVAMOS ", df_evt.shape[0], " REGISTROS")
-
-            # Deu erro de autenticação? Vamos tentar novamente
-            if response.status_code == 401:
-                authenticate()
-                print(datahoje, event_name, "DEU 401")
-                continue
-        except requests.exceptions.Timeout as te:
-            print(datahoje, event_name, "DEU TIMEOUT")
-            time.sleep(30)
-            authenticate()
-            continue
-        except Exception as e:
-            print("Erro no batch", e)
-            erros.append((datahoje, event_name, "BATCH", i + 1, "ERRO", e))
-
-        print(datahoje, event_name, "TERMINAMOS O BATCH", i + 1)
-        # Incrementa o batch
-        i += 1
-        time.sleep(15)
-        # Limpa a memória
-        gc.collect()
+        erros = baixa_dia(datahoje, asset_ids, tbl_existing_columns, marcas=marcas)
 
     # Imprime os erros
     print("NUMERO DE ERROS", len(erros))
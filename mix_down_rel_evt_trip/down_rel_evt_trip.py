@@ -8,9 +8,12 @@
 import os
 import sys
 import datetime as dt
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
+import click
 import pandas as pd
 import psycopg2 as pg
+from psycopg2.pool import ThreadedConnectionPool
 from sqlalchemy import create_engine
 from execution_logger import ExecutionLogger
 
@@ -48,6 +51,25 @@ pg_engine = pg.connect(
     f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
 )
 
+# Tabela (UNLOGGED) com os intervalos das trips, carregada uma vez por execução e usada por todas as tabelas
+TABELA_INTERVALOS = "trip_intervalos_evt"
+
+# Tabela com a marca d'água (último evento processado) de cada tabela de evento e veículo
+TABELA_ESTADO = "trip_possui_evento_estado_veiculo"
+
+# Janela máxima (dias) considerada na vinculação
+DIAS_ANTERIORES = 10
+
+# Os eventos são relidos a partir de marca - LOOKBACK_MINUTOS, pois os downloaders baixam novamente os dados
+# atrasados nesse intervalo (mesmo valor de LOOKBACK_MINUTOS em high_water_mark.py)
+LOOKBACK_MINUTOS = 180
+
+# Tabelas processadas ao mesmo tempo (uma conexão do pool para cada)
+TABELAS_PARALELAS = 4
+
+# Formato das datas salvas pela Mix (texto ISO)
+FORMATO_DATA_MIX = "%Y-%m-%dT%H:%M:%SZ"
+
 ###################################################################################
 # Funções
 ###################################################################################
@@ -56,47 +78,245 @@ pg_engine = pg.connect(
 def return_all_tables(engine: any) -> list:
     """
     Retorna uma lista com os nomes das tabelas que possuem a coluna 'StartDateTime'.
+    Partições (ex: tst_combs_202501) e tabelas legado da migração não são incluídas.
     """
     query = """
-    SELECT DISTINCT table_name
-    FROM information_schema.columns
-    WHERE table_schema = 'public' 
-    AND column_name = 'StartDateTime';
+    SELECT DISTINCT c.table_name
+    FROM information_schema.columns c
+    JOIN pg_class pc
+        ON pc.relname = c.table_name
+        AND pc.relnamespace = 'public'::regnamespace
+    WHERE c.table_schema = 'public'
+    AND c.column_name = 'StartDateTime'
+    AND NOT pc.relispartition
+    AND c.table_name NOT LIKE '%_legado';
     """
     df = pd.read_sql(query, engine)
     return df["table_name"].to_list()
 
 
-def trips_of_event(event_name: str, engine: any) -> None:
+def return_partitioned_tables(engine: any) -> set:
+    """
+    Retorna o conjunto de tabelas particionadas pela coluna ts (timestamptz), ex: tst_combs.
+    """
+    query = """
+    SELECT c.table_name
+    FROM information_schema.columns c
+    JOIN pg_class pc
+        ON pc.relname = c.table_name
+        AND pc.relnamespace = 'public'::regnamespace
+    WHERE c.table_schema = 'public'
+    AND c.column_name = 'ts'
+    AND pc.relkind = 'p';
+    """
+    df = pd.read_sql(query, engine)
+    return set(df["table_name"])
+
+
+def get_filtro_limites(particionada: bool) -> str:
+    """
+    Filtro dos eventos pelo intervalo [inicio, fim] de cada veículo (CTE limites).
+    Nas tabelas particionadas o filtro usa a coluna ts (poda de partições e índice ("AssetId", ts)),
+    nas demais o StartDateTime é comparado como texto ISO (sem cast) para usar os índices.
+    """
+    if particionada:
+        return "ra.ts >= l.inicio::TIMESTAMPTZ AND ra.ts <= l.fim::TIMESTAMPTZ"
+
+    return 'ra."StartDateTime" >= l.inicio AND ra."StartDateTime" <= l.fim'
+
+
+def cria_tabelas_auxiliares(engine: any) -> None:
+    """
+    Cria a tabela de intervalos das trips e a tabela com a marca d'água de cada tabela de evento.
+    """
+    with engine.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE UNLOGGED TABLE IF NOT EXISTS {TABELA_INTERVALOS} (
+                asset_id BIGINT NOT NULL,
+                trip_id BIGINT NOT NULL,
+                trip_start TEXT NOT NULL,
+                trip_end TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS {TABELA_INTERVALOS}_idx ON {TABELA_INTERVALOS} (asset_id, trip_start, trip_end);
+
+            CREATE TABLE IF NOT EXISTS {TABELA_ESTADO} (
+                tabela TEXT NOT NULL,
+                asset_id BIGINT NOT NULL,
+                ultimo_start_date_time TEXT NOT NULL,
+                data_atualizacao TIMESTAMPTZ DEFAULT NOW(),
+                PRIMARY KEY (tabela, asset_id)
+            );
+            """
+        )
+    engine.commit()
+
+
+def carrega_intervalos(engine: any, inicio: str) -> str:
+    """
+    Carrega uma única vez os intervalos das trips da janela e retorna o fim da última trip conhecida.
+    """
+    with engine.cursor() as cursor:
+        cursor.execute(f"TRUNCATE {TABELA_INTERVALOS}")
+        cursor.execute(
+            f"""
+            INSERT INTO {TABELA_INTERVALOS} (asset_id, trip_id, trip_start, trip_end)
+            SELECT ta."AssetId", ta."TripId", ta."TripStart", ta."TripEnd"
+            FROM trips_api ta
+            WHERE ta."TripEnd" >= %s
+            """,
+            (inicio,),
+        )
+        print("INTERVALOS DE TRIPS CARREGADOS", cursor.rowcount)
+        cursor.execute(f"ANALYZE {TABELA_INTERVALOS}")
+        cursor.execute(f"SELECT MAX(trip_end) FROM {TABELA_INTERVALOS}")
+        fim_ultima_trip = cursor.fetchone()[0]
+    engine.commit()
+
+    return fim_ultima_trip
+
+
+def get_cte_limites() -> str:
+    """
+    Intervalo de eventos lido para cada veículo com trips na janela:
+    - início: marca d'água do veículo na tabela menos LOOKBACK_MINUTOS (ou o início da janela)
+    - fim: fim da última trip do próprio veículo (eventos posteriores ficam para a próxima execução)
+    """
+    return f"""
+    WITH limites AS (
+        SELECT
+            ti.asset_id,
+            GREATEST(
+                %(inicio)s,
+                COALESCE(
+                    TO_CHAR(
+                        (e.ultimo_start_date_time::TIMESTAMPTZ - %(lookback)s * INTERVAL '1 minute') AT TIME ZONE 'UTC',
+                        'YYYY-MM-DD"T"HH24:MI:SS"Z"'
+                    ),
+                    %(inicio)s
+                )
+            ) AS inicio,
+            MAX(ti.trip_end) AS fim
+        FROM {TABELA_INTERVALOS} ti
+        LEFT JOIN {TABELA_ESTADO} e
+            ON e.tabela = %(tabela)s
+            AND e.asset_id = ti.asset_id
+        GROUP BY ti.asset_id, e.ultimo_start_date_time
+    )
+    """
+
+
+def trips_of_event(event_name: str, engine: any, inicio: str, lookback_minutos: int, particionada: bool) -> int:
     """
-    Insere dados de eventos ocorridos nos últimos 5 dias que estão associados a viagens.
+    Insere as associações evento -> trip dos eventos posteriores à marca d'água de cada veículo na tabela.
+    Os eventos depois do fim da última trip conhecida do veículo ficam para a próxima execução.
     """
+    parametros = {"tabela": event_name, "inicio": inicio, "lookback": lookback_minutos}
+    filtro_limites = get_filtro_limites(particionada)
+
     query = f"""
+    {get_cte_limites()}
     INSERT INTO trip_possui_evento (asset_id, trip_id, event_id, event_type_id, dia_evento)
     SELECT DISTINCT 
         ra."AssetId" AS asset_id,
-        ta."TripId" AS trip_id,
+        ti.trip_id AS trip_id,
         ra."EventId" AS event_id,
         ra."EventTypeId" AS event_type_id,
         ra."StartDateTime" AS dia_evento
-    FROM {event_name} ra
-    INNER JOIN trips_api ta 
-        ON ra."AssetId" = ta."AssetId" 
-        AND ra."StartDateTime" BETWEEN ta."TripStart" AND ta."TripEnd"
-    WHERE ra."StartDateTime"::timestamp 
-        BETWEEN (CURRENT_DATE - INTERVAL '10 days') AND CURRENT_DATE
+    FROM limites l
+    INNER JOIN {event_name} ra
+        ON ra."AssetId" = l.asset_id
+        AND {filtro_limites}
+    INNER JOIN {TABELA_INTERVALOS} ti
+        ON ra."AssetId" = ti.asset_id
+        AND ra."StartDateTime" BETWEEN ti.trip_start AND ti.trip_end
     ON CONFLICT (event_id) DO NOTHING;
     """
     with engine.cursor() as cursor:
-        cursor.execute(query)
-        engine.commit()
+        cursor.execute(query, parametros)
+        num_vinculos = cursor.rowcount
+
+        # Nova marca d'água de cada veículo, último evento até o fim da última trip do veículo
+        cursor.execute(
+            f"""
+            {get_cte_limites()}
+            INSERT INTO {TABELA_ESTADO} (tabela, asset_id, ultimo_start_date_time)
+            SELECT %(tabela)s, l.asset_id, MAX(ra."StartDateTime")
+            FROM limites l
+            INNER JOIN {event_name} ra
+                ON ra."AssetId" = l.asset_id
+                AND {filtro_limites}
+            GROUP BY l.asset_id
+            ON CONFLICT (tabela, asset_id) DO UPDATE
+            SET ultimo_start_date_time = GREATEST(
+                    {TABELA_ESTADO}.ultimo_start_date_time, EXCLUDED.ultimo_start_date_time
+                ),
+                data_atualizacao = NOW()
+            """,
+            parametros,
+        )
+    engine.commit()
+
+    return num_vinculos
+
+
+def processa_tabela(
+    pool: ThreadedConnectionPool, event_name: str, inicio: str, lookback_minutos: int, particionada: bool
+) -> int:
+    conn = pool.getconn()
+    try:
+        return trips_of_event(
+            event_name=event_name,
+            engine=conn,
+            inicio=inicio,
+            lookback_minutos=lookback_minutos,
+            particionada=particionada,
+        )
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn)
+
+
+@click.command()
+@click.option("--dias_anteriores", type=int, default=DIAS_ANTERIORES, help="Janela máxima (dias) da vinculação")
+@click.option("--tabelas_paralelas", type=int, default=TABELAS_PARALELAS, help="Tabelas processadas ao mesmo tempo")
+@click.option("--lookback_minutos", type=int, default=LOOKBACK_MINUTOS, help="Relê eventos atrasados")
+@click.option("--reprocessar", is_flag=True, help="Ignora as marcas d'água e reprocessa a janela completa")
+def main(dias_anteriores, tabelas_paralelas, lookback_minutos, reprocessar) -> None:
+    cria_tabelas_auxiliares(engine=pg_engine)
+
+    if reprocessar:
+        with pg_engine.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {TABELA_ESTADO}")
+        pg_engine.commit()
 
+    inicio = (dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=dias_anteriores)).strftime(FORMATO_DATA_MIX)
+    fim_ultima_trip = carrega_intervalos(engine=pg_engine, inicio=inicio)
+    if fim_ultima_trip is None:
+        print("SEM TRIPS NA JANELA")
+        return
 
-def main(engine_pg: any) -> None:
-    table_names = return_all_tables(engine=engine_pg)
-    for table_name in tqdm(table_names, desc="Processando tabelas", unit="tabela"):
-        print(f"Tabela: {table_name}")
-        trips_of_event(event_name=table_name, engine=engine_pg)
+    table_names = return_all_tables(engine=pg_engine)
+    tabelas_particionadas = return_partitioned_tables(engine=pg_engine)
+    pool = ThreadedConnectionPool(1, max(1, tabelas_paralelas), **DB_CONFIG)
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, tabelas_paralelas)) as executor:
+            futuros = {
+                executor.submit(
+                    processa_tabela, pool, table_name, inicio, lookback_minutos, table_name in tabelas_particionadas
+                ): table_name
+                for table_name in table_names
+            }
+            for futuro in tqdm(as_completed(futuros), total=len(futuros), desc="Processando tabelas", unit="tabela"):
+                table_name = futuros[futuro]
+                try:
+                    print(f"Tabela: {table_name}", "VINCULADOS", futuro.result())
+                except Exception as e:
+                    print(f"Tabela: {table_name}", "ERRO", e)
+    finally:
+        pool.closeall()
 
 
 ###################################################################################
@@ -110,6 +330,6 @@ if __name__ == "__main__":
     )
     with ExecutionLogger(engine_logger, "mix_down_rel_evt_trip"):
         try:
-            main(engine_pg=pg_engine)
+            main()
         finally:
             pg_engine.close()
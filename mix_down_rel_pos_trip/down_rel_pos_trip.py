@@ -5,9 +5,12 @@
 # Imports
 ###################################################################################
 
-import datetime as dt
 import os
+import sys
+import click
+import pandas as pd
 import psycopg2 as pg
+from psycopg2.extras import execute_values
 from sqlalchemy import create_engine
 from execution_logger import ExecutionLogger
 
@@ -36,57 +39,218 @@ DB_CONFIG = {
     "dbname": os.getenv("DB_NAME"),
 }
 
+# Não bufferiza a saída
+sys.stdout.flush()
+
 # Conexão com o banco de dados
 pg_engine = pg.connect(
     f"postgresql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@{DB_CONFIG['host']}:{DB_CONFIG['port']}/{DB_CONFIG['dbname']}"
 )
 
+# Tabela com a marca d'água (última posição vinculada) de cada veículo
+TABELA_ESTADO = "trip_possui_posicao_estado"
+
+# Na primeira execução (veículo sem estado) e no limite máximo, olhamos esse número de dias para trás
+DIAS_ANTERIORES = 5
+
+# As posições são relidas a partir de ultimo_ts - LOOKBACK_MINUTOS, pois o down_pos baixa novamente as posições
+# atrasadas nesse intervalo (mesmo valor de LOOKBACK_MINUTOS em high_water_mark.py)
+LOOKBACK_MINUTOS = 180
+
+# Formato das datas salvas pela Mix (texto ISO)
+FORMATO_DATA_MIX = "%Y-%m-%dT%H:%M:%SZ"
+
 ###################################################################################
 # Funções
 ###################################################################################
 
-def trips_of_position(engine, date):
-    """
-    Insere dados de trips e suas posições no banco para a data especificada.
-    """
-    query = """
-    INSERT INTO trip_possui_posicao 
-    (
-        asset_id, 
-        driver_id, 
-        position_id, 
-        trip_id, 
-        dia_posicao,
-        longitude,
-        latitude
-    ) 
-    SELECT DISTINCT 
+
+def cria_tabela_estado(engine):
+    with engine.cursor() as cursor:
+        cursor.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {TABELA_ESTADO} (
+                asset_id BIGINT PRIMARY KEY,
+                ultimo_ts TIMESTAMPTZ NOT NULL,
+                ultimo_position_id BIGINT,
+                data_atualizacao TIMESTAMPTZ DEFAULT NOW()
+            )
+            """
+        )
+    engine.commit()
+
+
+# Posições do intervalo [inicio, fim) ainda não vinculadas (posterior à marca d'água do veículo menos o lookback)
+# O filtro constante em ts permite o partition pruning, a marca d'água é aplicada por veículo
+# As posições relidas no lookback que já foram vinculadas são ignoradas pelo ON CONFLICT (position_id)
+def get_posicoes_novas(engine, inicio, fim, lookback_minutos=LOOKBACK_MINUTOS):
+    query = f"""
+    SELECT
         pg."AssetId",
         pg."DriverId",
-        pg."PositionId", 
-        ta."TripId",
+        pg."PositionId",
+        pg.ts,
         pg."Timestamp",
         pg."Longitude",
         pg."Latitude"
-    FROM posicao_gps pg 
-    LEFT JOIN trips_api ta 
-        ON ta."AssetId" = pg."AssetId"
-        AND ta."DriverId" = pg."DriverId" 
-    WHERE pg."Timestamp" BETWEEN ta."TripStart" AND ta."TripEnd"
-      AND DATE(pg."Timestamp") = %s
-    ON CONFLICT (position_id) DO NOTHING;
+    FROM posicao_gps pg
+    LEFT JOIN {TABELA_ESTADO} e
+        ON e.asset_id = pg."AssetId"
+    WHERE pg.ts >= %(inicio)s
+      AND pg.ts < %(fim)s
+      AND (e.ultimo_ts IS NULL OR pg.ts >= e.ultimo_ts - %(lookback)s * INTERVAL '1 minute')
+      AND pg."DriverId" IS NOT NULL
     """
-    print(f"Executando query para a data: {date}")
+    return pd.read_sql(query, engine, params={"inicio": inicio, "fim": fim, "lookback": lookback_minutos})
+
+
+# Trips que cruzam o intervalo [inicio, fim) (TripStart/TripEnd são texto ISO, comparamos como texto)
+def get_trips(engine, inicio, fim):
+    query = """
+    SELECT
+        ta."AssetId",
+        ta."DriverId",
+        ta."TripId",
+        ta."TripStart",
+        ta."TripEnd"
+    FROM trips_api ta
+    WHERE ta."TripEnd" >= %(inicio)s
+      AND ta."TripStart" < %(fim)s
+    """
+    df_trips = pd.read_sql(
+        query,
+        engine,
+        params={"inicio": inicio.strftime(FORMATO_DATA_MIX), "fim": fim.strftime(FORMATO_DATA_MIX)},
+    )
+    df_trips["inicio_trip"] = pd.to_datetime(df_trips["TripStart"], utc=True, errors="coerce")
+    df_trips["fim_trip"] = pd.to_datetime(df_trips["TripEnd"], utc=True, errors="coerce")
+
+    return df_trips.dropna(subset=["inicio_trip", "fim_trip"])
+
+
+# Junção ordenada posição -> trip
+# Para cada (veículo, motorista), a trip candidata é a última que começou antes da posição (busca binária
+# no vetor de inícios, via merge_asof), a posição pertence a ela se não passou do fim da trip
+def vincula_posicoes(df_posicoes, df_trips):
+    df_pos_sort = df_posicoes.sort_values("ts", kind="stable")
+    df_trips_sort = df_trips.sort_values("inicio_trip", kind="stable")
+
+    df_vinculo = pd.merge_asof(
+        df_pos_sort,
+        df_trips_sort[["AssetId", "DriverId", "TripId", "inicio_trip", "fim_trip"]],
+        left_on="ts",
+        right_on="inicio_trip",
+        by=["AssetId", "DriverId"],
+        direction="backward",
+    )
+
+    return df_vinculo[df_vinculo["TripId"].notna() & (df_vinculo["ts"] <= df_vinculo["fim_trip"])]
+
+
+# Nova marca d'água de cada veículo: última posição vista que não está além da última trip conhecida
+# As posições depois do fim da última trip do veículo ficam para a próxima execução (a trip pode não ter
+# sido baixada ainda)
+def get_novas_marcas(df_posicoes, df_trips):
+    fim_ultima_trip = df_trips.groupby("AssetId")["fim_trip"].max()
+
+    df_pos = df_posicoes[["AssetId", "PositionId", "ts"]].copy()
+    df_pos["limite"] = df_pos["AssetId"].map(fim_ultima_trip)
+    df_pos = df_pos[df_pos["ts"] <= df_pos["limite"]]
+
+    df_marcas = df_pos.sort_values(["AssetId", "ts", "PositionId"]).groupby("AssetId").tail(1)
+
+    return df_marcas[["AssetId", "ts", "PositionId"]]
+
+
+def salva_vinculos(engine, df_vinculo, df_marcas):
+    registros = list(
+        zip(
+            df_vinculo["AssetId"].astype("int64").tolist(),
+            df_vinculo["DriverId"].astype("int64").tolist(),
+            df_vinculo["PositionId"].astype("int64").tolist(),
+            df_vinculo["TripId"].astype("int64").tolist(),
+            df_vinculo["Timestamp"].tolist(),
+            df_vinculo["Longitude"].tolist(),
+            df_vinculo["Latitude"].tolist(),
+        )
+    )
+    marcas = list(
+        zip(
+            df_marcas["AssetId"].astype("int64").tolist(),
+            df_marcas["ts"].dt.to_pydatetime().tolist(),
+            df_marcas["PositionId"].astype("int64").tolist(),
+        )
+    )
+
+    # Vínculos e marcas d'água na mesma transação
     with engine.cursor() as cursor:
-        cursor.execute(query, (date,))
-        engine.commit()
+        if registros:
+            execute_values(
+                cursor,
+                """
+                INSERT INTO trip_possui_posicao
+                (asset_id, driver_id, position_id, trip_id, dia_posicao, longitude, latitude)
+                VALUES %s
+                ON CONFLICT (position_id) DO NOTHING
+                """,
+                registros,
+                page_size=5000,
+            )
+        if marcas:
+            execute_values(
+                cursor,
+                f"""
+                INSERT INTO {TABELA_ESTADO} (asset_id, ultimo_ts, ultimo_position_id)
+                VALUES %s
+                ON CONFLICT (asset_id) DO UPDATE
+                SET ultimo_ts = GREATEST({TABELA_ESTADO}.ultimo_ts, EXCLUDED.ultimo_ts),
+                    ultimo_position_id = EXCLUDED.ultimo_position_id,
+                    data_atualizacao = NOW()
+                """,
+                marcas,
+            )
+    engine.commit()
+
+
+# Vincula as posições novas do intervalo [inicio, fim)
+def trips_of_position(engine, inicio, fim, lookback_minutos=LOOKBACK_MINUTOS):
+    print(f"Vinculando posições de {inicio} a {fim}")
+
+    df_posicoes = get_posicoes_novas(engine, inicio, fim, lookback_minutos)
+    if df_posicoes.empty:
+        print("SEM POSIÇÕES NOVAS")
+        return
+
+    df_posicoes["ts"] = pd.to_datetime(df_posicoes["ts"], utc=True)
+    df_trips = get_trips(engine, inicio, fim)
+
+    df_vinculo = vincula_posicoes(df_posicoes, df_trips)
+    df_marcas = get_novas_marcas(df_posicoes, df_trips)
+    salva_vinculos(engine, df_vinculo, df_marcas)
+
+    print("POSIÇÕES NOVAS", df_posicoes.shape[0], "VINCULADAS", df_vinculo.shape[0], "VEÍCULOS", df_marcas.shape[0])
+
+
+@click.command()
+@click.option("--dias_anteriores", type=int, default=DIAS_ANTERIORES, help="Número máximo de dias para trás")
+@click.option("--lookback_minutos", type=int, default=LOOKBACK_MINUTOS, help="Relê posições atrasadas")
+@click.option("--reprocessar", is_flag=True, help="Ignora as marcas d'água e reprocessa os dias anteriores")
+def main(dias_anteriores, lookback_minutos, reprocessar):
+    cria_tabela_estado(pg_engine)
+
+    if reprocessar:
+        with pg_engine.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {TABELA_ESTADO}")
+        pg_engine.commit()
 
+    # Processa dia a dia (UTC), a marca d'água é salva ao fim de cada dia
+    hoje = pd.Timestamp.now("UTC").normalize()
+    for i in range(dias_anteriores, -1, -1):
+        inicio = hoje - pd.Timedelta(days=i)
+        trips_of_position(
+            engine=pg_engine, inicio=inicio, fim=inicio + pd.Timedelta(days=1), lookback_minutos=lookback_minutos
+        )
 
-def main(engine_pg):
-    # Loop para os últimos 5 dias (dias -5 até -1)
-    for i in range(5, 0, -1):
-        date_to_process = (dt.date.today() - dt.timedelta(days=i)).isoformat()
-        trips_of_position(engine=engine_pg, date=date_to_process)
 
 ###################################################################################
 # Execução
@@ -99,6 +263,6 @@ if __name__ == "__main__":
     )
     with ExecutionLogger(engine_logger, "mix_down_rel_pos_trip"):
         try:
-            main(engine_pg=pg_engine)
+            main()
         finally:
             pg_engine.close()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Download incremental (delta) dos dados da Mix a partir das marcas d'água (high-water marks) de cada veículo
+# - A marca d'água do veículo é o maior timestamp já salvo na(s) tabela(s) dentro da janela do dia
+# - Cada veículo só pede o intervalo que falta (marca d'água - lookback até o fim da janela), o lookback
+#   cobre os dados que chegam atrasados na Mix
+# - Com várias tabelas baixadas juntas, a marca do veículo é a menor entre as tabelas, e o veículo sem marca em
+#   alguma das tabelas (ex: tipo recém habilitado ou lote que falhou) baixa a janela completa
+# - Veículos com inícios próximos são agrupados (resolução) para continuar baixando em lotes
+# - Nas tabelas particionadas (posicao_gps, tst_combs) a marca d'água é lida da coluna de partição ts (timestamptz),
+#   usando a poda de partições e o índice ("AssetId", ts)
+#
+# Cada pasta de script possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import pandas as pd
+
+# Banco de Dados
+from sqlalchemy import text
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Dados que chegam atrasados são baixados novamente dentro desse intervalo (minutos)
+LOOKBACK_MINUTOS = 180
+
+# Resolução dos agrupamentos de veículos pelo início do intervalo (minutos)
+RESOLUCAO_MINUTOS = 60
+
+# Formato das datas salvas pela Mix (texto ISO)
+FORMATO_DATA_MIX = "%Y-%m-%dT%H:%M:%SZ"
+
+# Coluna de partição (timestamptz) das tabelas particionadas
+COLUNA_PARTICAO = "ts"
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Divide as janelas [(inicio, veículos)] em lotes [(inicio, lote de veículos)] de até tamanho_lote veículos
+def divide_em_lotes(janelas, tamanho_lote):
+    lotes = []
+    for inicio, asset_ids in janelas:
+        for k in range(0, len(asset_ids), tamanho_lote):
+            lotes.append((inicio, asset_ids[k : k + tamanho_lote]))
+
+    return lotes
+
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class HighWaterMarks(object):
+    # Construtor, tabelas pode ser uma tabela ou uma lista de tabelas baixadas juntas (mesma requisição)
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(
+        self,
+        pg_engine,
+        tabelas,
+        coluna_tempo,
+        lookback_minutos=LOOKBACK_MINUTOS,
+        resolucao_minutos=RESOLUCAO_MINUTOS,
+    ):
+        self.pg_engine = pg_engine
+        self.tabelas = [tabelas] if isinstance(tabelas, str) else list(tabelas)
+        self.coluna_tempo = coluna_tempo                                # Ex: Timestamp, StartDateTime, TripEnd
+        self.lookback = pd.Timedelta(minutes=lookback_minutos)          # Margem para os dados atrasados
+        self.resolucao = pd.Timedelta(minutes=resolucao_minutos)        # Agrupamento dos inícios
+    # fmt: on
+
+    # Tabelas que possuem a coluna de partição
+    def __get_tabelas_particionadas(self, conn):
+        query = """
+        SELECT table_name
+        FROM information_schema.columns
+        WHERE table_schema = 'public' AND column_name = :coluna AND table_name = ANY(:tabelas)
+        """
+        parametros = {"coluna": COLUNA_PARTICAO, "tabelas": self.tabelas}
+        df_tabelas = pd.read_sql(text(query), conn, params=parametros)
+
+        return set(df_tabelas["table_name"])
+
+    # Subquery com a marca d'água de cada veículo na tabela (timestamptz)
+    # Nas tabelas particionadas o filtro e o MAX usam a coluna de partição, nas demais o texto ISO (sem CAST)
+    def __get_subquery(self, tabela, particionada):
+        if particionada:
+            return f"""
+            SELECT "AssetId", MAX({COLUNA_PARTICAO}) AS marca
+            FROM "{tabela}"
+            WHERE {COLUNA_PARTICAO} >= CAST(:inicio AS TIMESTAMPTZ) AND {COLUNA_PARTICAO} <= CAST(:fim AS TIMESTAMPTZ)
+            GROUP BY "AssetId"
+            """
+
+        return f"""
+        SELECT "AssetId", CAST(MAX("{self.coluna_tempo}") AS TIMESTAMPTZ) AS marca
+        FROM "{tabela}"
+        WHERE "{self.coluna_tempo}" >= :inicio AND "{self.coluna_tempo}" <= :fim
+        GROUP BY "AssetId"
+        """
+
+    # Maior timestamp salvo por veículo dentro da janela (dict AssetId -> Timestamp)
+    # Com várias tabelas, a menor das marcas das tabelas, apenas para os veículos com marca em todas elas
+    def carrega(self, data_inicio, data_fim):
+        parametros = {
+            "inicio": pd.Timestamp(data_inicio).strftime(FORMATO_DATA_MIX),
+            "fim": pd.Timestamp(data_fim).strftime(FORMATO_DATA_MIX),
+            "num_tabelas": len(self.tabelas),
+        }
+        with self.pg_engine.connect() as conn:
+            particionadas = self.__get_tabelas_particionadas(conn)
+            subqueries = [self.__get_subquery(tabela, tabela in particionadas) for tabela in self.tabelas]
+            query = f"""
+            SELECT "AssetId", MIN(marca) AS marca
+            FROM ({" UNION ALL ".join(subqueries)}) AS marcas
+            GROUP BY "AssetId"
+            HAVING COUNT(*) = :num_tabelas
+            """
+            df_marcas = pd.read_sql(text(query), conn, params=parametros)
+
+        # Timestamp com fuso -> Timestamp UTC sem fuso, mesma referência das datas da API
+        marcas = pd.to_datetime(df_marcas["marca"], utc=True, errors="coerce").dt.tz_convert(None)
+
+        return {int(a): m for a, m in zip(df_marcas["AssetId"], marcas) if pd.notna(m)}
+
+    # Agrupa os veículos pelo início do intervalo que ainda falta baixar
+    # Retorna [(inicio, [veículos])], veículos sem marca d'água baixam a janela completa
+    def get_janelas(self, asset_ids, data_inicio, data_fim):
+        data_inicio = pd.Timestamp(data_inicio)
+        data_fim = pd.Timestamp(data_fim)
+        marcas = self.carrega(data_inicio, data_fim)
+
+        janelas = {}
+        for asset_id in asset_ids:
+            inicio = data_inicio
+            marca = marcas.get(int(asset_id))
+            if marca is not None:
+                inicio = max(data_inicio, marca - self.lookback)
+                inicio = data_inicio + ((inicio - data_inicio) // self.resolucao) * self.resolucao
+
+            janelas.setdefault(inicio, []).append(asset_id)
+
+        # Resumo, horas pedidas versus a janela completa
+        horas_completas = len(asset_ids) * (data_fim - data_inicio) / pd.Timedelta(hours=1)
+        horas_pedidas = sum(len(v) * (data_fim - i) / pd.Timedelta(hours=1) for i, v in janelas.items())
+        print(
+            f"Marcas d'água ({', '.join(self.tabelas)}): {len(marcas)} veículos com dados,",
+            f"{horas_pedidas:.0f} de {horas_completas:.0f} horas-veículo serão baixadas",
+        )
+
+        return sorted(janelas.items())
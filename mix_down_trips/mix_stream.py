@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Leitura em streaming das respostas da API da Mix (lista de objetos JSON)
+# - O JSON é decodificado aos poucos com ijson, direto da conexão, sem materializar o response.json() inteiro
+# - A resposta precisa ser uma lista, outro JSON (ex: objeto de erro da API) levanta ValueError em vez de virar um
+#   DataFrame vazio
+# - Cada objeto é achatado como no pd.json_normalize ("A.B" -> "A_B") e apenas as colunas pedidas são guardadas
+# - Colunas float vão direto para arrays tipados (array "d"), as demais para listas
+# - A memória depende apenas do número de registros e das colunas extraídas, não do tamanho do payload
+#
+# Cada pasta de script possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import array
+import itertools
+import math
+import numpy as np
+import pandas as pd
+
+# Streaming JSON
+import ijson
+
+# Banco de Dados
+from sqlalchemy import Float
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Colunas float de uma tabela refletida (SQLAlchemy)
+def get_colunas_float(tabela):
+    return [c.name for c in tabela.columns if isinstance(c.type, Float)]
+
+
+# Converte um valor do JSON para float, valores inválidos viram NaN
+def para_float(valor):
+    try:
+        return float(valor)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class StreamingColumnReader(object):
+    # Construtor, recebe as colunas (já achatadas, ex: StartPosition_Latitude) que devem ser extraídas
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, colunas, colunas_float=()):
+        self.colunas = list(colunas)                                    # Colunas extraídas (na ordem)
+        self.colunas_set = set(self.colunas)                            # Para busca rápida
+        self.colunas_float = set(colunas_float) & self.colunas_set      # Colunas guardadas em arrays float
+
+        # Prefixos dos objetos aninhados que precisam ser percorridos (ex: StartPosition_)
+        self.prefixos = set()
+        for coluna in self.colunas:
+            partes = coluna.split("_")
+            for i in range(1, len(partes)):
+                self.prefixos.add("_".join(partes[:i]))
+    # fmt: on
+
+    # Lê a resposta (requisição feita com stream=True) e retorna um DataFrame apenas com as colunas pedidas
+    # Colunas que não apareceram em nenhum registro não são incluídas (mesmo comportamento do pd.json_normalize)
+    def le(self, response):
+        valores = {c: array.array("d") if c in self.colunas_float else [] for c in self.colunas}
+        presentes = set()
+        num_registros = 0
+
+        try:
+            # Descomprime (gzip) enquanto lê
+            response.raw.decode_content = True
+
+            # O primeiro token precisa abrir uma lista
+            eventos = ijson.parse(response.raw, use_float=True)
+            primeiro = next(eventos)
+            if primeiro[1] != "start_array":
+                raise ValueError(f"Resposta da API não é uma lista JSON (primeiro token: {primeiro[1]})")
+
+            for item in ijson.items(itertools.chain([primeiro], eventos), "item"):
+                registro = {}
+                self.__achata(item, "", registro)
+                presentes.update(registro.keys())
+
+                for coluna, lista in valores.items():
+                    valor = registro.get(coluna)
+                    if coluna in self.colunas_float:
+                        lista.append(para_float(valor))
+                    else:
+                        lista.append(valor)
+
+                num_registros += 1
+        finally:
+            response.close()
+
+        colunas = [c for c in self.colunas if c in presentes]
+        dados = {}
+        for coluna in colunas:
+            if coluna in self.colunas_float:
+                dados[coluna] = np.frombuffer(valores.pop(coluna), dtype="float64")
+            else:
+                dados[coluna] = valores.pop(coluna)
+
+        return pd.DataFrame(dados, columns=colunas, index=pd.RangeIndex(num_registros))
+
+    # Achata o objeto, percorrendo apenas os objetos aninhados que possuem colunas pedidas
+    def __achata(self, objeto, prefixo, saida):
+        for chave, valor in objeto.items():
+            nome = prefixo + chave
+            if isinstance(valor, dict):
+                if nome in self.prefixos:
+                    self.__achata(valor, nome + "_", saida)
+            elif nome in self.colunas_set:
+                saida[nome] = valor
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Checkpoint do backfill dos downloaders da Mix
+# - Cada unidade concluída (job, dia, veículo, tipo de evento) é registrada na tabela mix_backfill_checkpoint
+# - Ao reiniciar, o backfill consulta as unidades concluídas e baixa apenas o que falta
+# - O registro é por veículo (e não por lote) para que o tamanho dos lotes possa mudar entre execuções
+#
+# Cada pasta de script possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import datetime as dt
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Banco de Dados
+from sqlalchemy import text
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Tabela do checkpoint
+TABELA_CHECKPOINT = "mix_backfill_checkpoint"
+
+# Tipo de evento usado pelos jobs que não separam por evento (posições, trips)
+SEM_TIPO_EVENTO = 0
+
+###################################################################################
+# Funções auxiliares
+###################################################################################
+
+
+# Lista de dias (do mais recente para o mais antigo) entre data_inicio e data_fim (inclusive)
+def get_dias_backfill(data_inicio, data_fim):
+    data_inicio = pd.to_datetime(data_inicio).date()
+    data_fim = pd.to_datetime(data_fim).date()
+
+    num_dias = (data_fim - data_inicio).days
+    return [data_fim - dt.timedelta(days=i) for i in range(num_dias + 1)]
+
+
+# Executa funcao_dia(dia) para cada dia, dias_paralelos ao mesmo tempo
+# funcao_dia retorna a lista de erros do dia, um dia que falhar não interrompe os demais
+def executa_dias_em_paralelo(dias, funcao_dia, dias_paralelos):
+    erros = []
+
+    with ThreadPoolExecutor(max_workers=max(1, dias_paralelos)) as executor:
+        futuros = {executor.submit(funcao_dia, dia): dia for dia in dias}
+
+        for futuro in as_completed(futuros):
+            dia = futuros[futuro]
+            try:
+                erros_dia = futuro.result()
+                erros.extend(erros_dia)
+                print("BACKFILL DIA CONCLUÍDO", dia, "ERROS", len(erros_dia))
+            except Exception as e:
+                print("BACKFILL DIA FALHOU", dia, e)
+                erros.append((dia, "DIA", "ERRO", e))
+
+    return erros
+
+
+###################################################################################
+# Classe
+###################################################################################
+
+
+class BackfillCheckpoint(object):
+    # Construtor, job identifica o downloader (ex: mix_down_pos)
+    # Desliga formatter para não desalinhar comentários
+    # fmt: off
+    def __init__(self, pg_engine, job, tabela=TABELA_CHECKPOINT):
+        self.pg_engine = pg_engine
+        self.job = job          # Nome do downloader
+        self.tabela = tabela    # Tabela do checkpoint
+    # fmt: on
+
+    def cria_tabela(self):
+        with self.pg_engine.begin() as conn:
+            conn.execute(
+                text(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS {self.tabela} (
+                        job TEXT NOT NULL,
+                        dia DATE NOT NULL,
+                        asset_id BIGINT NOT NULL,
+                        event_type_id BIGINT NOT NULL DEFAULT 0,
+                        num_registros_lote INTEGER,
+                        data_conclusao TIMESTAMPTZ DEFAULT NOW(),
+                        PRIMARY KEY (job, dia, event_type_id, asset_id)
+                    )
+                    """
+                )
+            )
+
+    # Veículos já concluídos no dia (e tipo de evento)
+    def get_concluidos(self, dia, event_type_id=SEM_TIPO_EVENTO):
+        with self.pg_engine.connect() as conn:
+            resultado = conn.execute(
+                text(
+                    f"""
+                    SELECT asset_id
+                    FROM {self.tabela}
+                    WHERE job = :job AND dia = :dia AND event_type_id = :event_type_id
+                    """
+                ),
+                {"job": self.job, "dia": dia, "event_type_id": int(event_type_id)},
+            )
+            return set(r[0] for r in resultado)
+
+    # Veículos do dia que ainda não foram concluídos
+    def get_pendentes(self, dia, asset_ids, event_type_id=SEM_TIPO_EVENTO):
+        concluidos = self.get_concluidos(dia, event_type_id)
+        return [asset_id for asset_id in asset_ids if int(asset_id) not in concluidos]
+
+    # Registra o lote como concluído
+    def marca_concluidos(self, dia, asset_ids, event_type_id=SEM_TIPO_EVENTO, num_registros_lote=None):
+        registros = [
+            {
+                "job": self.job,
+                "dia": dia,
+                "asset_id": int(asset_id),
+                "event_type_id": int(event_type_id),
+                "num_registros_lote": num_registros_lote,
+            }
+            for asset_id in asset_ids
+        ]
+        if not registros:
+            return
+
+        with self.pg_engine.begin() as conn:
+            conn.execute(
+                text(
+                    f"""
+                    INSERT INTO {self.tabela} (job, dia, asset_id, event_type_id, num_registros_lote)
+                    VALUES (:job, :dia, :asset_id, :event_type_id, :num_registros_lote)
+                    ON CONFLICT (job, dia, event_type_id, asset_id) DO NOTHING
+                    """
+                ),
+                registros,
+            )
@@ -13,7 +13,6 @@ import sys
 
 # Imports básicos
 import os
-import json
 import pandas as pd
 import time
 
@@ -32,6 +31,19 @@ from sqlalchemy import Table, MetaData
 from sqlalchemy.dialects.postgresql import insert
 from execution_logger import ExecutionLogger
 
+# Cliente da Mix
+from mix_client import MixClient
+
+# Leitura em streaming das respostas
+from mix_stream import StreamingColumnReader, get_colunas_float
+
+# Download incremental (marcas d'água)
+from high_water_mark import HighWaterMarks, LOOKBACK_MINUTOS, divide_em_lotes
+
+# Backfill
+from mix_fetcher import AdaptiveRateLimiter, TAXA_INICIAL, TAXA_MINIMA, STATUS_SOBRECARGA, get_retry_after
+from backfill_checkpoint import BackfillCheckpoint, get_dias_backfill, executa_dias_em_paralelo
+
 # DotEnv
 from dotenv import load_dotenv
 
@@ -61,172 +73,118 @@ DB_NAME = os.getenv("DB_NAME")
 # Criar a conexão com o SQLAlchemy
 pg_engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
 
-# Constantes
-MIX_API_IDENTITY_URL = os.getenv("MIX_API_IDENTITY_URL")
-MIX_API_URL = os.getenv("MIX_API_URL")
-MIX_USERNAME = os.getenv("MIX_USERNAME")
-MIX_PASSWORD = os.getenv("MIX_PASSWORD")
-MIX_API_USERNAME = os.getenv("MIX_API_USERNAME")
-MIX_API_PASSWORD = os.getenv("MIX_API_PASSWORD")
-MIX_GROUP_ID = os.getenv("MIX_GROUP_ID")
+# Cliente da API da Mix (sessão persistente e token compartilhado entre processos)
+cliente_mix = MixClient()
 
 # Tabela
 metadata = MetaData()
 tst_combs_table = Table("tst_combs", metadata, autoload_with=pg_engine)
 
+# Tabela particionada por mês em ts (db_particiona_mix), ts também faz parte da chave de conflito
+TABELA_PARTICIONADA = "ts" in tst_combs_table.columns
+CHAVES_CONFLITO_TST_COMBS = ["EventTypeId", "EventId", "DriverId", "AssetId"] + (["ts"] if TABELA_PARTICIONADA else [])
 
-###################################################################################
-# Autenticação
-###################################################################################
-
-payload = f"""
-grant_type=password&
-username={MIX_USERNAME}&
-password={MIX_PASSWORD}&
-scope=offline_access%20MiX.Integrate
-"""
-headers = {
-    "Content-Type": "application/x-www-form-urlencoded",
-}
-
-TOKEN = None
-AUTH_HEADERS = None
-AUTH_HEADERS_JSON = None
-ULTIMO_LOGIN = None
-
+# Evento que baixamos
+EVENT_ID = 5908754939820782463
 
-def get_auth_token():
-    response = requests.request(
-        "POST",
-        MIX_API_IDENTITY_URL + "/core/connect/token",
-        headers=headers,
-        data=payload,
-        auth=(MIX_API_USERNAME, MIX_API_PASSWORD),
-    )
-    print(response.json())
-    return response.json()["access_token"]
-
-
-def authenticate():
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON, ULTIMO_LOGIN
-
-    if ULTIMO_LOGIN is None:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-    elif (dt.datetime.now() - ULTIMO_LOGIN).seconds > 3000:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-
-    AUTH_HEADERS = {"Authorization": f"Bearer {TOKEN}"}
-    AUTH_HEADERS_JSON = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
+# Backfill: dias baixados ao mesmo tempo e orçamento de requisições por segundo na API (somando todos os dias)
+DIAS_PARALELOS = 4
+REQUISICOES_POR_SEGUNDO = 0.5
 
 
 #### Download de Evento
 def download_evento(asset_ids, event_id, data_inicio, data_fim):
-    global AUTH_HEADERS_JSON
-
-    # Datas
-    data_inicio_str = data_inicio.strftime("%Y%m%d%H%M%S")
-    data_final_str = data_fim.strftime("%Y%m%d%H%M%S")
-
-    # URL
-    url = MIX_API_URL + f"/api/events/assets/from/{data_inicio_str}/to/{data_final_str}"
-
-    # Payload
-    evt_payload = {"EntityIds": list(map(int, asset_ids)), "EventTypeIds": [event_id], "MenuId": "string"}
-
-    # Resposta
-    return requests.request("POST", url, headers=AUTH_HEADERS_JSON, data=json.dumps(evt_payload), timeout=300)
+    return cliente_mix.get_eventos(asset_ids, [event_id], data_inicio, data_fim, timeout=300, stream=True)
 
 
-@click.command()
-@click.option("--data_baixar", type=str, help="Data que irei baixar")
-def main(data_baixar):
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON
-    authenticate()
-
-    # Lista de Veículos
-    url = MIX_API_URL + f"/api/assets/group/{MIX_GROUP_ID}"
-    resp = requests.request("GET", url, headers=AUTH_HEADERS, data={})
-    df_veiculos = pd.json_normalize(resp.json())
-
+# Baixa os eventos do dia (datahoje é o fim do intervalo), retorna a lista de erros
+# No backfill, os veículos já concluídos são pulados, cada lote salvo é registrado no checkpoint
+# e o ritmo é dado pelo limitador (compartilhado entre os dias) ao invés da pausa fixa entre lotes
+# Com as marcas d'água, cada veículo baixa apenas o intervalo que ainda falta (mais o lookback)
+def baixa_dia(datahoje, df_veiculos, leitor, checkpoint=None, limitador=None, marcas=None):
     batch_size = 150
-    n_batches = (df_veiculos.shape[0] // batch_size) + 1
     erros = []
+    dia = pd.to_datetime(datahoje).date()
+    dataontem = datahoje - dt.timedelta(days=1)
 
     # Eventos que tenho que baixar
-    event_id = 5908754939820782463
+    event_id = EVENT_ID
     event_name = "tst_combs"
     print("PROCESSANDO O EVENTO", event_id, event_name)
 
-    # A tabela que iremos inserir
-    tbl_name = event_name
+    veiculos = df_veiculos["AssetId"].values
+    if checkpoint is not None:
+        veiculos = checkpoint.get_pendentes(dia, veiculos, event_id)
 
-    # Step 1: Fetch existing columns from the target table
-    tbl_query = f"""
-    SELECT column_name
-    FROM information_schema.columns
-    WHERE table_name = '{tbl_name}';
-    """
-    tbl_existing_columns = pd.read_sql(tbl_query, pg_engine)["column_name"].tolist()
+    # Intervalo que falta baixar de cada veículo (marcas d'água) ou a janela completa
+    janelas = [(dataontem, veiculos)]
+    if marcas is not None:
+        janelas = marcas.get_janelas(veiculos, dataontem, datahoje)
+
+    lotes = divide_em_lotes(janelas, batch_size)
+    n_batches = len(lotes)
 
     i = 0
     while i < n_batches:
-        # Pega datas
-        datahoje = dt.datetime.now()
-        if data_baixar:
-            datahoje = pd.to_datetime(data_baixar)
-
-        dataontem = datahoje - dt.timedelta(days=1)
+        # Pega dados do batch
+        inicio_janela, asset_ids = lotes[i]
 
         # Printa informações do batch
-        print(datahoje, event_name, f"Batch {i+1} / {n_batches} valores de {i*batch_size} até {(i+1)*batch_size}")
-
-        # Pega dados do batch
-        asset_ids = df_veiculos["AssetId"].values[i * batch_size : (i + 1) * batch_size]
+        print(datahoje, event_name, f"Batch {i+1} / {n_batches} a partir de {inicio_janela}")
         print(datahoje, event_name, f"Tamanho do batch: {len(asset_ids)}")
 
         try:
-            # Autentica novamente para evitar timeout
-            authenticate()
+            # Autentica novamente para evitar timeout (renova apenas se o token estiver perto de expirar)
+            cliente_mix.autentica()
 
-            response = download_evento(asset_ids, event_id, dataontem, datahoje)
+            if limitador is not None:
+                limitador.adquire()
+
+            response = download_evento(asset_ids, event_id, inicio_janela, datahoje)
 
             # Resposta está OK?
             if response.status_code == 200:
-                # Ajusta o dado no pandas
-                df_evt = pd.json_normalize(response.json())
-                df_evt.columns = df_evt.columns.str.replace(".", "_")
+                if limitador is not None:
+                    limitador.sucesso()
 
-                # Remove colunas que não existem na tabela se tbl_existing_columns não for vazio
-                if tbl_existing_columns:
-                    # Filter existing_columns to include only columns that are actually in df_evt
-                    tbl_filtered_columns = [col for col in tbl_existing_columns if col in df_evt.columns]
+                # Ajusta o dado no pandas (apenas as colunas que existem na tabela)
+                df_filtered = leitor.le(response)
 
-                    df_filtered = df_evt[tbl_filtered_columns]
-                else:
-                    df_filtered = df_evt
+                # Coluna de partição (timestamptz), o PostgreSQL direciona o registro para a partição do mês
+                if TABELA_PARTICIONADA and "StartDateTime" in df_filtered.columns:
+                    df_filtered["ts"] = pd.to_datetime(df_filtered["StartDateTime"], utc=True, errors="coerce")
+                    df_filtered = df_filtered[df_filtered["ts"].notna()]
 
                 # Salva no banco
                 pg_engine.dispose()
                 with pg_engine.begin() as conn:
                     # Faz o insert
                     stmt = insert(tst_combs_table).values(df_filtered.to_dict(orient="records"))
-                    stmt = stmt.on_conflict_do_nothing(index_elements=["EventTypeId", "EventId", "DriverId", "AssetId"])
+                    stmt = stmt.on_conflict_do_nothing(index_elements=CHAVES_CONFLITO_TST_COMBS)
                     conn.execute(stmt)
 
+                # Registra o lote no checkpoint (backfill)
+                if checkpoint is not None:
+                    checkpoint.marca_concluidos(dia, asset_ids, event_id, df_filtered.shape[0])
+
                 # Printa informações da operação
                 print(datahoje, event_name, "SALVAMOS ", df_filtered.shape[0], " REGISTROS")
+            elif limitador is not None and response.status_code in STATUS_SOBRECARGA:
+                # API sobrecarregada, diminui o ritmo de todos os dias e tenta o lote novamente
+                print(datahoje, event_name, "API SOBRECARREGADA", response.status_code)
+                limitador.sobrecarga(get_retry_after(response))
+                response.close()
+                continue
 
             # Deu erro de autenticação? Vamos tentar novamente
             if response.status_code == 401:
-                authenticate()
+                cliente_mix.autentica(forcar=True)
                 print(datahoje, event_name, "DEU 401")
                 continue
         except requests.exceptions.Timeout as te:
             print(datahoje, event_name, "DEU TIMEOUT")
             time.sleep(10)
-            authenticate()
+            cliente_mix.autentica()
             continue
         except Exception as e:
             print("Erro no batch", e)
@@ -235,13 +193,74 @@ def main(data_baixar):
         print(datahoje, event_name, "TERMINAMOS O BATCH", i + 1)
         # Incrementa o batch
         i += 1
-        time.sleep(15)
+        if limitador is None:
+            time.sleep(15)
         # Limpa a memória
         gc.collect()
 
     print("TERMINAMOS O EVENTO", event_name)
     print("NUMERO DE ERROS", erros)
 
+    return erros
+
+
+@click.command()
+@click.option("--data_baixar", type=str, help="Data que irei baixar")
+@click.option("--backfill_inicio", type=str, help="Backfill: primeiro dia que irei baixar (retoma do checkpoint)")
+@click.option("--backfill_fim", type=str, help="Backfill: último dia que irei baixar (padrão: hoje)")
+@click.option("--dias_paralelos", type=int, default=DIAS_PARALELOS, help="Backfill: dias baixados ao mesmo tempo")
+@click.option("--requisicoes_por_segundo", type=float, default=REQUISICOES_POR_SEGUNDO, help="Backfill: orçamento da API")
+@click.option("--lookback_minutos", type=int, default=LOOKBACK_MINUTOS, help="Baixa novamente dados atrasados nesse intervalo")
+@click.option("--janela_completa", is_flag=True, help="Ignora as marcas d'água e baixa a janela completa do dia")
+def main(data_baixar, backfill_inicio, backfill_fim, dias_paralelos, requisicoes_por_segundo, lookback_minutos, janela_completa):
+    cliente_mix.autentica()
+
+    # Lista de Veículos
+    df_veiculos = pd.json_normalize(cliente_mix.get_veiculos())
+
+    # A tabela que iremos inserir
+    tbl_name = "tst_combs"
+
+    # Step 1: Fetch existing columns from the target table
+    tbl_query = f"""
+    SELECT column_name
+    FROM information_schema.columns
+    WHERE table_name = '{tbl_name}';
+    """
+    tbl_existing_columns = pd.read_sql(tbl_query, pg_engine)["column_name"].tolist()
+
+    # Lê apenas as colunas da tabela, direto da resposta (streaming)
+    leitor = StreamingColumnReader(tbl_existing_columns, get_colunas_float(tst_combs_table))
+
+    if backfill_inicio:
+        # Backfill: vários dias em paralelo, todos compartilhando o mesmo orçamento de requisições
+        checkpoint = BackfillCheckpoint(pg_engine, "mix_down_tst_combs")
+        checkpoint.cria_tabela()
+        limitador = AdaptiveRateLimiter(
+            taxa=min(TAXA_INICIAL, requisicoes_por_segundo),
+            taxa_minima=min(TAXA_MINIMA, requisicoes_por_segundo),
+            taxa_maxima=requisicoes_por_segundo,
+        )
+
+        dias = get_dias_backfill(backfill_inicio, backfill_fim or dt.date.today())
+        erros = executa_dias_em_paralelo(
+            dias,
+            lambda dia: baixa_dia(pd.to_datetime(dia), df_veiculos, leitor, checkpoint, limitador),
+            dias_paralelos,
+        )
+    else:
+        # Pega datas
+        datahoje = dt.datetime.now()
+        if data_baixar:
+            datahoje = pd.to_datetime(data_baixar)
+
+        # Marcas d'água: maior StartDateTime já salvo de cada veículo
+        marcas = None
+        if not janela_completa:
+            marcas = HighWaterMarks(pg_engine, "tst_combs", "StartDateTime", lookback_minutos)
+
+        erros = baixa_dia(datahoje, df_veiculos, leitor, marcas=marcas)
+
     # Imprime os erros
     print("NUMERO DE ERROS", len(erros))
     print("ERROS -------------------")
@@ -249,7 +268,6 @@ def main(data_baixar):
         print(e)
 
 
-
 if __name__ == "__main__":
     with ExecutionLogger(pg_engine, "mix_down_tst_combs"):
         main()
@@ -1,8 +1,8 @@
 #!/bin/bash
 
-# Faz o loop para baixar o dado de hoje e os dos 4 dias anteriores
-for i in {0..30}
-do
-  DATE=$(date -d "-$i day" +%Y-%m-%d)
-  python -u down_tst_combs.py --data_baixar=$DATE
-done
+# Backfill de hoje e dos 30 dias anteriores
+# Retoma de onde parou (checkpoint em mix_backfill_checkpoint) e baixa vários dias em paralelo
+DATA_INICIO=$(date -d "-30 day" +%Y-%m-%d)
+DATA_FIM=$(date +%Y-%m-%d)
+
+python -u down_tst_combs.py --backfill_inicio=$DATA_INICIO --backfill_fim=$DATA_FIM --dias_paralelos=4 --requisicoes_por_segundo=0.5
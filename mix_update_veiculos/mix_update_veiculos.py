@@ -9,15 +9,12 @@
 import os
 import pandas as pd
 
-# Import de datas
-import datetime as dt
-
 # BD
 from sqlalchemy import create_engine
 from execution_logger import ExecutionLogger
 
-# Requests
-import requests
+# Cliente da Mix
+from mix_client import MixClient
 
 
 # DotEnv
@@ -46,66 +43,14 @@ DB_NAME = os.getenv("DB_NAME")
 # Criar o engine SQLAlchemy
 pg_engine = create_engine(f"postgresql://{DB_USER}:{DB_PASS}@{DB_HOST}:{DB_PORT}/{DB_NAME}")
 
-# Constantes
-MIX_API_IDENTITY_URL = os.getenv("MIX_API_IDENTITY_URL")
-MIX_API_URL = os.getenv("MIX_API_URL")
-MIX_USERNAME = os.getenv("MIX_USERNAME")
-MIX_PASSWORD = os.getenv("MIX_PASSWORD")
-MIX_API_USERNAME = os.getenv("MIX_API_USERNAME")
-MIX_API_PASSWORD = os.getenv("MIX_API_PASSWORD")
-MIX_GROUP_ID = os.getenv("MIX_GROUP_ID")
+# Cliente da API da Mix (sessão persistente e token compartilhado entre processos)
+cliente_mix = MixClient()
 
 
 ###################################################################################
 # Funções
 ###################################################################################
 
-###################################################################################
-# Autenticação
-###################################################################################
-
-payload = f"""
-grant_type=password&
-username={MIX_USERNAME}&
-password={MIX_PASSWORD}&
-scope=offline_access%20MiX.Integrate
-"""
-headers = {
-    "Content-Type": "application/x-www-form-urlencoded",
-}
-
-TOKEN = None
-AUTH_HEADERS = None
-AUTH_HEADERS_JSON = None
-ULTIMO_LOGIN = None
-
-
-def get_auth_token():
-    response = requests.request(
-        "POST",
-        MIX_API_IDENTITY_URL + "/core/connect/token",
-        headers=headers,
-        data=payload,
-        auth=(MIX_API_USERNAME, MIX_API_PASSWORD),
-    )
-    print(response.json())
-    return response.json()["access_token"]
-
-
-def authenticate():
-    global TOKEN, AUTH_HEADERS, AUTH_HEADERS_JSON, ULTIMO_LOGIN
-
-    if ULTIMO_LOGIN is None:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-    elif (dt.datetime.now() - ULTIMO_LOGIN).seconds > 3000:
-        TOKEN = get_auth_token()
-        ULTIMO_LOGIN = dt.datetime.now()
-
-    AUTH_HEADERS = {"Authorization": f"Bearer {TOKEN}"}
-    AUTH_HEADERS_JSON = {"Authorization": f"Bearer {TOKEN}", "Content-Type": "application/json"}
-
-
 ###################################################################################
 # Main
 ###################################################################################
@@ -115,9 +60,7 @@ def get_veiculos_api():
     """
     Pega os veículos da API do Mix.
     """
-    url = MIX_API_URL + f"/api/assets/group/{MIX_GROUP_ID}"
-    resp = requests.request("GET", url, headers=AUTH_HEADERS, data={})
-    df_veiculos = pd.json_normalize(resp.json())
+    df_veiculos = pd.json_normalize(cliente_mix.get_veiculos())
 
     return df_veiculos
 
@@ -132,7 +75,7 @@ def get_veiculos_db():
 
 if __name__ == "__main__":
     with ExecutionLogger(pg_engine, "mix_update_veiculos"):
-        authenticate()
+        cliente_mix.autentica()
 
     df_veiculos_api = get_veiculos_api()
     df_veiculos_db = get_veiculos_db()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Métricas derivadas das geometrias das linhas (KML)
+# - Tamanho da linha em metros (UTM, EPSG:31982)
+# - Coordenadas (longitude/latitude) do primeiro e do último ponto da linha
+# - Geometria projetada para o sistema métrico (EPSG:5641), usada nos buffers das linhas
+#
+# As métricas são calculadas na ingestão do KML (ra_update_linhas_kml) e salvas na tabela rmtc_kml_derivado.
+# As análises leem a tabela e só recalculam, com as mesmas funções, as linhas que ainda não têm as métricas salvas
+#
+# Cada pasta (ingestão e análises) possui uma cópia deste arquivo (cada pasta é um contexto Docker independente)
+
+###################################################################################
+# Imports
+###################################################################################
+
+# Imports básicos
+import json
+import numpy as np
+import pandas as pd
+
+# Biblioteca espaciais
+import shapely
+from shapely.geometry import shape, MultiLineString, MultiPolygon, GeometryCollection
+
+# Projeção das linhas
+from projection import projeta_geometrias, CRS_GPS, CRS_METRICO, CRS_UTM
+
+###################################################################################
+# Constantes
+###################################################################################
+
+# Tabela com as métricas derivadas, chave (origem, id_kml)
+TABELA_KML_DERIVADO = "rmtc_kml_derivado"
+
+# Origem do KML (mesmos nomes usados na chave do snapshot do KML) para cada tabela de KML
+ORIGENS_KML = {
+    "rmtc_kml_via_ra": "via_ra",
+    "rmtc_kml": "kml",
+}
+
+# Colunas com as métricas (a geometria métrica é salva em WKB)
+COLUNAS_EXTREMOS = ["START_LONGITUDE", "START_LATITUDE", "END_LONGITUDE", "END_LATITUDE"]
+COLUNA_TAMANHO = "tamanho_m"
+COLUNA_GEOMETRIA_METRICA = "geometria_metrica"
+COLUNA_GEOMETRIA_METRICA_WKB = "geometria_metrica_wkb"
+
+###################################################################################
+# Funções
+###################################################################################
+
+
+# Converte o GeoJSON (FeatureCollection) da linha em uma única geometria shapely
+def parse_geojson_linha(geojson_str):
+    geojson = json.loads(geojson_str)
+    geometrias = [shape(feature["geometry"]) for feature in geojson["features"] if feature.get("geometry")]
+
+    if len(geometrias) == 1:
+        return geometrias[0]
+    elif all(geom.geom_type == "LineString" for geom in geometrias):
+        return MultiLineString(geometrias)
+    elif all(geom.geom_type == "Polygon" for geom in geometrias):
+        return MultiPolygon(geometrias)
+    else:
+        return GeometryCollection(geometrias)
+
+
+# Coordenadas do primeiro e do último ponto de cada geometria (EPSG:4326), NaN para as geometrias vazias
+def calcula_extremos(geometrias):
+    geometrias = np.asarray(geometrias, dtype=object)
+    extremos = np.full((len(geometrias), 4), np.nan)
+
+    coordenadas, idx_geometrias = shapely.get_coordinates(geometrias, return_index=True)
+    if len(coordenadas) == 0:
+        return extremos
+
+    # Primeira ocorrência de cada geometria e última (primeira no vetor invertido)
+    idx_com_pontos, primeiros = np.unique(idx_geometrias, return_index=True)
+    _, ultimos_invertidos = np.unique(idx_geometrias[::-1], return_index=True)
+    ultimos = len(idx_geometrias) - 1 - ultimos_invertidos
+
+    extremos[idx_com_pontos, 0:2] = coordenadas[primeiros]
+    extremos[idx_com_pontos, 2:4] = coordenadas[ultimos]
+    return extremos
+
+
+# Calcula as métricas das geometrias (EPSG:4326), retorna um DataFrame com as colunas das métricas
+def calcula_metricas_linhas(geometrias, index=None):
+    geometrias = np.asarray(geometrias, dtype=object)
+
+    df_metricas = pd.DataFrame(calcula_extremos(geometrias), columns=COLUNAS_EXTREMOS, index=index)
+    df_metricas[COLUNA_TAMANHO] = shapely.length(projeta_geometrias(geometrias, CRS_GPS, CRS_UTM))
+    df_metricas[COLUNA_GEOMETRIA_METRICA] = projeta_geometrias(geometrias, CRS_GPS, CRS_METRICO)
+
+    return df_metricas
+
+
+# Completa as métricas lidas da tabela derivada (colunas em minúsculo e geometria em WKB)
+# As linhas que ainda não têm as métricas salvas são calculadas a partir da geometria (EPSG:4326)
+def completa_metricas_linhas(gdf_linhas):
+    gdf_linhas = gdf_linhas.rename(columns={c.lower(): c for c in COLUNAS_EXTREMOS})
+
+    wkb = gdf_linhas.get(COLUNA_GEOMETRIA_METRICA_WKB, pd.Series(None, index=gdf_linhas.index, dtype=object))
+    wkb = np.array([bytes(w) if w is not None and not pd.isna(w) else None for w in wkb], dtype=object)
+    gdf_linhas[COLUNA_GEOMETRIA_METRICA] = shapely.from_wkb(wkb)
+    gdf_linhas = gdf_linhas.drop(columns=[COLUNA_GEOMETRIA_METRICA_WKB], errors="ignore")
+
+    faltantes = pd.isna(gdf_linhas[COLUNA_GEOMETRIA_METRICA]).to_numpy()
+    if faltantes.any():
+        df_metricas = calcula_metricas_linhas(gdf_linhas.geometry.values[faltantes], gdf_linhas.index[faltantes])
+        for coluna in df_metricas.columns:
+            if coluna not in gdf_linhas.columns:
+                gdf_linhas[coluna] = None if coluna == COLUNA_GEOMETRIA_METRICA else np.nan
+            gdf_linhas.loc[faltantes, coluna] = df_metricas[coluna]
+
+    return gdf_linhas
+
+
+# Geometrias das linhas no sistema métrico (pré-calculadas ou projetadas na hora)
+def get_geometrias_metricas(gdf_linhas):
+    if COLUNA_GEOMETRIA_METRICA in gdf_linhas.columns:
+        return np.asarray(gdf_linhas[COLUNA_GEOMETRIA_METRICA].values, dtype=object)
+
+    return projeta_geometrias(gdf_linhas.geometry.values, CRS_GPS, CRS_METRICO)
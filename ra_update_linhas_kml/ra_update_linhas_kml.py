@@ -30,10 +30,22 @@ import io
 
 # Geo
 import geojson
+import shapely
 from geojson_length import calculate_distance, Unit
 from fastkml import kml
 from shapely.geometry import mapping
 
+# Métricas derivadas das linhas (tamanho, extremos e geometria métrica)
+from line_metrics import (
+    TABELA_KML_DERIVADO,
+    ORIGENS_KML,
+    COLUNAS_EXTREMOS,
+    COLUNA_TAMANHO,
+    COLUNA_GEOMETRIA_METRICA,
+    parse_geojson_linha,
+    calcula_metricas_linhas,
+)
+
 # DotEnv
 from dotenv import load_dotenv
 
@@ -62,6 +74,9 @@ RA_API_KEY = os.getenv("RA_API_KEY")
 RA_API_KML_URL = os.getenv("RA_API_KML_URL")
 RA_API_KML_KEY = os.getenv("RA_API_KML_KEY")
 
+# Número de KMLs processados por vez ao calcular as métricas derivadas
+TAMANHO_LOTE_DERIVADO = 200
+
 ###################################################################################
 # Funções
 ###################################################################################
@@ -164,7 +179,120 @@ def computa_tamanho_linha_km(kml_linha_geojson):
     return km_total
 
 
-def main(engine_pg):
+###################################################################################
+# Métricas derivadas do KML
+###################################################################################
+
+
+# Cria a tabela com as métricas derivadas de cada KML (rmtc_kml_via_ra e rmtc_kml), lida pelas análises
+def cria_tabela_kml_derivado(engine_pg):
+    with engine_pg.begin() as conn:
+        conn.execute(
+            text(
+                f"""
+                CREATE TABLE IF NOT EXISTS {TABELA_KML_DERIVADO} (
+                    origem TEXT NOT NULL,
+                    id_kml BIGINT NOT NULL,
+                    tamanho_m DOUBLE PRECISION,
+                    start_longitude DOUBLE PRECISION,
+                    start_latitude DOUBLE PRECISION,
+                    end_longitude DOUBLE PRECISION,
+                    end_latitude DOUBLE PRECISION,
+                    geometria_metrica_wkb BYTEA,
+                    atualizado_em TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                    PRIMARY KEY (origem, id_kml)
+                )
+                """
+            )
+        )
+
+
+# Converte NaN (linhas vazias) para NULL
+def para_float_ou_none(valor):
+    return None if pd.isna(valor) else float(valor)
+
+
+# Calcula e salva as métricas dos KMLs que ainda não estão na tabela derivada
+# Cobre os KMLs inseridos nesta execução, os inseridos por outros scripts (ra_insert_new_kml) e o histórico
+def atualiza_kml_derivado(engine_pg, tamanho_lote=TAMANHO_LOTE_DERIVADO):
+    for tabela_kml, origem in ORIGENS_KML.items():
+        with engine_pg.connect() as conn:
+            df_ids = pd.read_sql(
+                text(
+                    f"""
+                    SELECT k.id
+                    FROM {tabela_kml} k
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {TABELA_KML_DERIVADO} d WHERE d.origem = :origem AND d.id_kml = k.id
+                    )
+                    ORDER BY k.id
+                    """
+                ),
+                conn,
+                params={"origem": origem},
+            )
+
+        ids = df_ids["id"].tolist()
+        print(tabela_kml, "KMLS SEM MÉTRICAS DERIVADAS", len(ids))
+
+        for inicio in range(0, len(ids), tamanho_lote):
+            ids_lote = ids[inicio : inicio + tamanho_lote]
+
+            with engine_pg.connect() as conn:
+                df_kml = pd.read_sql(
+                    text(f"SELECT id, geojsondata FROM {tabela_kml} WHERE id = ANY(:ids)"),
+                    conn,
+                    params={"ids": ids_lote},
+                )
+
+            registros = []
+            for _, row in df_kml.iterrows():
+                try:
+                    geometria = parse_geojson_linha(row["geojsondata"])
+                except Exception as e:
+                    print(f"Erro ao ler o GeoJSON do KML {origem}/{row['id']}: {e}")
+                    continue
+
+                metricas = calcula_metricas_linhas([geometria]).iloc[0]
+                registros.append(
+                    {
+                        "origem": origem,
+                        "id_kml": int(row["id"]),
+                        "tamanho_m": para_float_ou_none(metricas[COLUNA_TAMANHO]),
+                        **{c.lower(): para_float_ou_none(metricas[c]) for c in COLUNAS_EXTREMOS},
+                        "geometria_metrica_wkb": shapely.to_wkb(metricas[COLUNA_GEOMETRIA_METRICA]),
+                    }
+                )
+
+            if not registros:
+                continue
+
+            with engine_pg.begin() as conn:
+                conn.execute(
+                    text(
+                        f"""
+                        INSERT INTO {TABELA_KML_DERIVADO}
+                        (origem, id_kml, tamanho_m, start_longitude, start_latitude, end_longitude, end_latitude,
+                         geometria_metrica_wkb)
+                        VALUES
+                        (:origem, :id_kml, :tamanho_m, :start_longitude, :start_latitude, :end_longitude,
+                         :end_latitude, :geometria_metrica_wkb)
+                        ON CONFLICT (origem, id_kml) DO NOTHING
+                        """
+                    ),
+                    registros,
+                )
+
+            print(tabela_kml, "SALVAMOS AS MÉTRICAS DE", len(registros), "KMLS")
+
+
+###################################################################################
+# Main
+###################################################################################
+
+
+# Baixa os KMLs das linhas da API e insere os novos na tabela rmtc_kml_via_ra
+def baixa_linhas_api(engine_pg):
     # Define intervalo de processamento
     # Todos os valores no formato datetime.datetime
     today = dt.date.today()
@@ -257,6 +385,16 @@ def main(engine_pg):
             print(f"Erro ao processar linha {linha_onibus}: {e}")
 
 
+def main(engine_pg):
+    # Baixa os KMLs da API
+    baixa_linhas_api(engine_pg)
+
+    # Métricas derivadas (tamanho em metros, extremos e geometria métrica) dos KMLs que ainda não as possuem
+    # Executado mesmo se a API não retornar linhas, completando os KMLs já salvos (ex: rmtc_kml)
+    cria_tabela_kml_derivado(engine_pg)
+    atualiza_kml_derivado(engine_pg)
+
+
 ###################################################################################
 # Execução
 ###################################################################################